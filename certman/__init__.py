@@ -1,8 +1,9 @@
 #!coding: utf-8
 
-from terminaltables import AsciiTable
+import sys
+
+from datetime import date, datetime
 
-from certman.manager import Manager
 from certman.settings import SETTINGS
 
 class Certman(object):
@@ -13,15 +14,32 @@ class Certman(object):
 
     COMMANDS = (
         ('addcert', 'add new certificate today'),
-        ('report', 'generate this week report'),
+        ('import', 'import certificates from csv, ndjson or yaml file'),
+        ('report', 'generate report for this week or any date range'),
+        ('search', 'find certificates by partial email, enrollment ID or answer'),
         ('delete', 'delete certificate by ID or email'),
+        ('purge', 'delete certificates listed in a file or added within a date range'),
+        ('migrate-store', 'move plain files into the sharded store layout'),
+        ('compact-store', 'reclaim space in the packed store'),
+        ('verify', 'check and repair the database against the file store'),
+        ('stats', 'show certificate totals by day, week, month or year'),
+        ('rebuild-stats', 'recount certificate totals from the database'),
+        ('archive', 'move old certificates into the archive database'),
+        ('changes', 'show inserts and deletes logged after a sequence number'),
+        ('replicate', 'apply logged changes to a replica database'),
+        ('snapshot', 'write every certificate to a compressed snapshot file'),
+        ('restore', 'rebuild an empty database and the store from a snapshot'),
+        ('timings', 'show or export per-operation timings'),
+        ('profile', 'run a command under the profiler'),
         ('settings', 'show current settings'),
         ('help', 'show this help'),
         ('exit', 'exit')
     )
 
-    def __init__(self):
-        self.manager = Manager()
+    def __init__(self, manager=None):
+        from certman.manager import Manager
+
+        self.manager = manager or Manager()
 
     def print_banner(self):
         print "Certificates Manager v.0.1"
@@ -41,35 +59,219 @@ class Certman(object):
 
         return user_input
 
+    def input_period(self, default='this week'):
+        """
+        Asks for a date range, returns ``(None, None)`` for the default one.
+        """
+        start = raw_input('From (YYYY-MM-DD) [%s]: ' % default).strip()
+        if not start:
+            return None, None
+        end = raw_input('To (YYYY-MM-DD) [today]: ').strip()
+        start = datetime.strptime(start, '%Y-%m-%d').date()
+        end = datetime.strptime(end, '%Y-%m-%d').date() if end else date.today()
+        return start, end
+
     def run(self):
         self.print_banner()
         self.print_help()
 
         while True:
-            command = self.input()
+            result = self.dispatch(self.input())
+            if result is not None:
+                return result
+
+    def dispatch(self, command):
+        """
+        Executes a single command, returns the exit code on exit.
+        """
+        if command == 'addcert':
+            count = self.manager.command_addcert()
+            print "Successfully added %s certificates" % count
+
+        elif command == 'import':
+            try:
+                result = self.manager.command_import()
+            except (IOError, ValueError) as e:
+                print "\tImport failed: %s" % e
+                return
+            for line_num, email, reason in result.rejects:
+                print "\tRejected line %s (%s): %s" % (line_num, email or '-', reason)
+            print "Successfully imported %s certificates, %s rejected (%.0f rows/sec)" % (
+                result.imported, len(result.rejects), result.rate)
+
+        elif command == 'settings':
+            print SETTINGS
+            cache_info = self.manager.db_storage.cache_info()
+            if cache_info:
+                print "Lookup cache: %(size)s/%(maxsize)s entries, %(hits)s hits, %(misses)s misses" % cache_info
+            membership_info = self.manager.db_storage.membership_info()
+            if membership_info:
+                print "Email filter: %(count)s/%(capacity)s emails in %(bytes)s bytes, " \
+                      "%(false_positive_rate).2e false positive rate" % membership_info
+
+        elif command == 'help':
+            self.print_banner()
+            self.print_help()
+
+        elif command == 'report':
+            try:
+                start, end = self.input_period()
+            except ValueError:
+                print "\tInvalid date, expected YYYY-MM-DD"
+                return
+            from certman.manager import Reporter
+
+            fmt = raw_input('Format (%s) [table]: ' % ', '.join(Reporter.FORMATS)).strip().lower() or 'table'
+            path = raw_input('Output file [screen]: ').strip()
+            out = open(path, 'w') if path else sys.stdout
+            try:
+                total = self.manager.command_report(start, end, fmt, out)
+            except ValueError as e:
+                print "\t%s" % e
+                return
+            finally:
+                if path:
+                    out.close()
+            print "\nTotal certificates obtained: %s" % total
+
+        elif command == 'search':
+            text = raw_input('Search for: ').strip()
+            page = 1
+            while True:
+                try:
+                    certificates = self.manager.command_search(text, page)
+                except ValueError as e:
+                    print "\t%s" % e
+                    return
+                if len(certificates) < 20 or raw_input('Next page? (y/n): ') != 'y':
+                    return
+                page += 1
+
+        elif command == 'delete':
+            self.manager.command_delete()
+
+        elif command == 'purge':
+            from certman.formats import read_emails
+
+            path = raw_input('File with one email per line [none]: ').strip()
+            try:
+                emails = None
+                if path:
+                    with open(path) as f:
+                        emails = list(read_emails(f))
+                start, end = self.input_period(default='any date')
+                if emails is None and start is None:
+                    print "\tGive a file or a date range"
+                    return
+                count = len(self.manager.command_delete_many(emails, start, end, dry_run=True))
+                if not count or raw_input('Delete %s certificates? (y/n): ' % count) != 'y':
+                    return
+                deleted = self.manager.command_delete_many(emails, start, end)
+            except (IOError, ValueError) as e:
+                print "\t%s" % e
+                return
+            print "Deleted %s certificates" % len(deleted)
+
+        elif command == 'migrate-store':
+            try:
+                moved = self.manager.command_migrate_store()
+            except ValueError as e:
+                print "\t%s" % e
+                return
+            print "Store migrated, %s certificates moved" % moved
+
+        elif command == 'compact-store':
+            try:
+                reclaimed = self.manager.command_compact_store()
+            except ValueError as e:
+                print "\t%s" % e
+                return
+            print "Store compacted, %s bytes reclaimed" % reclaimed
+
+        elif command == 'verify':
+            try:
+                self.manager.command_verify()
+            except ValueError as e:
+                print "\t%s" % e
+
+        elif command == 'stats':
+            period = raw_input('Group by (day, week, month, year) [week]: ').strip().lower() or 'week'
+            try:
+                start, end = self.input_period(default='this year')
+                rows = self.manager.command_stats(period, start, end)
+            except ValueError as e:
+                print "\t%s" % e
+                return
+            for label, total in rows:
+                print "%12s %8s" % (label, total)
+            print "\nTotal certificates obtained: %s" % sum(total for _, total in rows)
+
+        elif command == 'archive':
+            days = raw_input('Archive certificates older than days [%s]: ' % SETTINGS['archive_after_days']).strip()
+            try:
+                moved = self.manager.command_archive(int(days) if days else None)
+            except ValueError as e:
+                print "\t%s" % e
+                return
+            print "Archived %s certificates" % moved
+
+        elif command == 'changes':
+            try:
+                since = int(raw_input('Since sequence number [0]: ').strip() or 0)
+            except ValueError:
+                print "\tInvalid sequence number"
+                return
+            seq = self.manager.command_changes(since)
+            print "\nLast sequence number: %s" % seq
+
+        elif command == 'replicate':
+            path = raw_input('Replica database file: ').strip()
+            if not path:
+                return
+            print "Replica up to date, %s changes applied" % self.manager.command_replicate(path)
+
+        elif command in ('snapshot', 'restore'):
+            path = raw_input('Snapshot file: ').strip()
+            if not path:
+                return
+            try:
+                if command == 'snapshot':
+                    print "Snapshot written, %s certificates" % self.manager.command_snapshot(path)
+                else:
+                    print "Restored %s certificates" % self.manager.command_restore(path)
+            except (IOError, ValueError) as e:
+                print "\t%s" % e
 
-            if command == 'addcert':
-                count = self.manager.command_addcert()
-                print "Successfully added %s certificates" % count
+        elif command == 'rebuild-stats':
+            self.manager.command_rebuild_stats()
+            print "Certificate totals rebuilt"
 
-            elif command == 'settings':
-                print SETTINGS
+        elif command == 'timings':
+            from certman import formats, instrument
+            from certman.instrument import INSTRUMENTATION
 
-            elif command == 'help':
-                self.print_banner()
-                self.print_help()
+            if not INSTRUMENTATION.enabled:
+                print "\tInstrumentation is disabled, set CERTMAN_INSTRUMENT=1"
+                return
+            formats.write_table(INSTRUMENTATION.rows(), instrument.HEADER, 'Operation timings', sys.stdout)
+            path = raw_input('Export JSON to [skip]: ').strip()
+            if path:
+                with open(path, 'w') as f:
+                    f.write(INSTRUMENTATION.to_json())
+                print "Timings exported to %s" % path
 
-            elif command == 'report':
-                rows, week_start, week_end, total = self.manager.command_report()
-                table = AsciiTable(rows, 'Certificates obtained %s-%s' % (week_start, week_end))
-                table.outer_border = False
-                print table.table
-                print "\nTotal certificates obtained: %s" % total
+        elif command == 'profile':
+            from certman.instrument import profile_call
 
-            elif command == 'delete':
-                self.manager.command_delete()
+            name = raw_input('Command: ').strip().lower()
+            if name in ('profile', 'exit'):
+                print "\tCan't profile '%s'" % name
+                return
+            path = raw_input('Dump stats to [skip]: ').strip()
+            profile_call(self.dispatch, (name,), dump_path=path or None)
 
-            elif command == 'exit':
-                return 0
-            else:
-                pass
+        elif command == 'exit':
+            self.manager.close()
+            return 0
+        else:
+            print "\tUnknown command '%s', type help for the list of commands" % command
@@ -0,0 +1,338 @@
+#!coding: utf-8
+"""
+Non-blocking storage API for embedding certman in event-driven services.
+Every call returns a ``Future`` at once and runs on certman's own threads:
+
+- ``AsyncCertificateDBStorage`` owns a connection on a dedicated thread.
+  Queued writes are grouped into one transaction per batch, so concurrent
+  adds share commits.
+- ``AsyncCertificateFileStorage`` runs store calls on a thread pool.
+- ``AsyncManager.add_certificate`` journals the add, then writes the DB
+  row and the store entry concurrently, undoing one when the other fails.
+
+Future callbacks run on certman's threads, so they must not block; an
+event loop gets results through its thread-safe scheduling call, e.g.
+``future.add_done_callback(lambda f: loop.call_soon_threadsafe(...))``.
+"""
+import errno
+import threading
+import traceback
+import types
+import Queue
+
+from certman.instrument import timed
+from certman.manager import CertificateDBStorage, CertificateExists
+
+
+class Future(object):
+    """
+    Result of a call running on another thread, with the part of the
+    ``concurrent.futures.Future`` interface certman needs.
+    """
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+        self._result = None
+        self._exception = None
+
+    def set_result(self, result):
+        self._finish(result, None)
+
+    def set_exception(self, exception):
+        self._finish(None, exception)
+
+    def _finish(self, result, exception):
+        with self._lock:
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            self._call(callback)
+
+    def _call(self, callback):
+        # A failing callback mustn't take down the thread resolving futures
+        try:
+            callback(self)
+        except Exception:
+            traceback.print_exc()
+
+    def add_done_callback(self, callback):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def done(self):
+        return self._event.is_set()
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise RuntimeError('Timed out waiting for the result')
+        return self._exception
+
+    def result(self, timeout=None):
+        exception = self.exception(timeout)
+        if exception is not None:
+            raise exception
+        return self._result
+
+
+def _resolve(future, func, args, kwargs):
+    try:
+        result = func(*args, **kwargs)
+        # Streaming results can't leave the thread owning the cursor
+        if isinstance(result, types.GeneratorType):
+            result = list(result)
+    except Exception as e:
+        future.set_exception(e)
+    else:
+        future.set_result(result)
+
+
+def when_all(futures, callback):
+    """
+    Calls ``callback()`` once every future is done, on the thread finishing
+    the last one.
+    """
+    remaining = [len(futures)]
+    lock = threading.Lock()
+
+    def done(future):
+        with lock:
+            remaining[0] -= 1
+            last = remaining[0] == 0
+        if last:
+            callback()
+
+    for future in futures:
+        future.add_done_callback(done)
+
+
+class AsyncCertificateDBStorage(object):
+    """
+    Runs ``CertificateDBStorage`` calls on a thread owning the connection,
+    in the order they were made. ``storage.get_by_email(email)`` and every
+    other storage method return a ``Future``; generators come back as
+    lists. Writes in ``BATCHED`` queued together share a transaction: a
+    write failing with a constraint error only loses its own statement.
+    """
+
+    BATCHED = ('save', 'open_intent', 'close_intent')
+
+    def __init__(self, db, batch_size=64, **options):
+        self.batch_size = batch_size
+        self._requests = Queue.Queue()
+        started = Future()
+        self._thread = threading.Thread(target=self._run, args=(db, options, started), name='certman-db')
+        self._thread.daemon = True
+        self._thread.start()
+        started.result()
+
+    def submit(self, name, *args, **kwargs):
+        future = Future()
+        self._requests.put((name, args, kwargs, future))
+        return future
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.submit(name, *args, **kwargs)
+
+    def close(self):
+        self._requests.put(None)
+        self._thread.join()
+
+    def _run(self, db, options, started):
+        try:
+            storage = CertificateDBStorage(db, **options)
+        except Exception as e:
+            started.set_exception(e)
+            return
+        started.set_result(None)
+        try:
+            while True:
+                batch = [self._requests.get()]
+                while len(batch) < self.batch_size:
+                    try:
+                        batch.append(self._requests.get_nowait())
+                    except Queue.Empty:
+                        break
+
+                group = []
+                for request in batch:
+                    if request is None:
+                        self._commit(storage, group)
+                        return
+                    if request[0] in self.BATCHED:
+                        group.append(request)
+                        continue
+                    self._commit(storage, group)
+                    group = []
+                    name, args, kwargs, future = request
+                    _resolve(future, getattr(storage, name), args, kwargs)
+                self._commit(storage, group)
+        finally:
+            storage.close()
+
+    @timed('async.db_batch', rows=lambda count: count)
+    def _commit(self, storage, group):
+        """
+        Runs the writes of ``group`` in one transaction. Futures are only
+        resolved once it commits.
+        """
+        if not group:
+            return 0
+        try:
+            storage.begin()
+        except Exception as e:
+            for _, _, _, future in group:
+                future.set_exception(e)
+            return 0
+
+        results = []
+        for name, args, kwargs, future in group:
+            try:
+                results.append((future, getattr(storage, name)(*args, commit=False, **kwargs), None))
+            except Exception as e:
+                results.append((future, None, e))
+        try:
+            storage.commit()
+        except Exception as e:
+            storage.rollback()
+            results = [(future, None, e) for future, _, _ in results]
+
+        for future, result, error in results:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        return len(group)
+
+
+class AsyncCertificateFileStorage(object):
+    """
+    Runs file store calls on a pool of ``workers`` threads, returning a
+    ``Future`` for every call. Meant for the directory store; the pack
+    store isn't safe to write from several threads.
+    """
+
+    def __init__(self, storage, workers=8):
+        self.storage = storage
+        # A plain queue costs less per call than a ThreadPool, whose tasks
+        # and results pass through helper threads
+        self._requests = Queue.Queue()
+        self._workers = [threading.Thread(target=self._run, name='certman-file-%s' % i) for i in range(workers)]
+        for worker in self._workers:
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, name, *args, **kwargs):
+        future = Future()
+        self._requests.put((future, getattr(self.storage, name), args, kwargs))
+        return future
+
+    def __getattr__(self, name):
+        return lambda *args, **kwargs: self.submit(name, *args, **kwargs)
+
+    def _run(self):
+        while True:
+            request = self._requests.get()
+            if request is None:
+                return
+            _resolve(*request)
+
+    def close(self):
+        for _ in self._workers:
+            self._requests.put(None)
+        for worker in self._workers:
+            worker.join()
+        if hasattr(self.storage, 'close'):
+            self.storage.close()
+
+
+def _exists(error):
+    return isinstance(error, CertificateExists) or getattr(error, 'errno', None) == errno.EEXIST
+
+
+class AsyncManager(object):
+    """
+    ``Manager.add_certificate`` for async callers. Once the journal entry
+    has committed, the DB row and the store entry are written at the same
+    time. A crash after that has ``Manager.recover`` finish or undo the
+    add, as for blocking adds.
+
+    Adds of an email already being added wait for that add to finish,
+    as both would otherwise undo each other's half.
+    """
+
+    def __init__(self, db_storage, file_storage):
+        self.db_storage = db_storage
+        self.file_storage = file_storage
+        self._lock = threading.Lock()
+        self._adding = {}
+
+    def add_certificate(self, certificate):
+        """
+        Returns a ``Future`` resolving to True once the certificate is in
+        the DB and the store, or False when either already had it.
+        """
+        done = Future()
+        with self._lock:
+            previous = self._adding.get(certificate.email)
+            self._adding[certificate.email] = done
+        done.add_done_callback(lambda _: self._added(certificate.email, done))
+        if previous is None:
+            self._start_add(certificate, done)
+        else:
+            previous.add_done_callback(lambda _: self._start_add(certificate, done))
+        return done
+
+    def _added(self, email, done):
+        with self._lock:
+            if self._adding.get(email) is done:
+                del self._adding[email]
+
+    def _start_add(self, certificate, done):
+        # Queued along with the intent, the store entry could be written
+        # before the intent's batch commits and outlive a crash unjournaled
+        intent = self.db_storage.open_intent(certificate.email)
+        intent.add_done_callback(lambda _: self._write(certificate, intent, done))
+        return done
+
+    def _write(self, certificate, intent, done):
+        if intent.exception() is not None:
+            done.set_exception(intent.exception())
+            return
+        saved = self.db_storage.save(certificate)
+        written = self.file_storage.save(certificate)
+        when_all([saved, written], lambda: self._finish_add(certificate, intent, saved, written, done))
+
+    def _finish_add(self, certificate, intent, saved, written, done):
+        db_error = saved.exception()
+        file_error = written.exception()
+        undo = []
+        if db_error is None and file_error is not None:
+            undo.append(self.db_storage.delete(certificate.email))
+        elif file_error is None and db_error is not None:
+            undo.append(self.file_storage.delete(certificate.email))
+        undo.append(self.db_storage.close_intent(intent.result()))
+
+        def finish():
+            error = db_error or file_error
+            failed = [f.exception() for f in undo if f.exception() is not None]
+            if error is not None and not _exists(error):
+                done.set_exception(error)
+            elif failed:
+                done.set_exception(failed[0])
+            else:
+                done.set_result(error is None)
+        if undo:
+            when_all(undo, finish)
+        else:
+            finish()
+
+    def close(self):
+        self.file_storage.close()
+        self.db_storage.close()
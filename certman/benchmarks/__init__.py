@@ -0,0 +1,135 @@
+#!coding: utf-8
+"""
+Reproducible benchmarks for the certman storage hot paths.
+
+Run the suite and save the results::
+
+    python -m certman.benchmarks run --sizes 10000,100000,1000000 --output results.json
+
+and check a new run against a stored baseline, exiting with status 1 when
+any metric got worse by more than the threshold::
+
+    python -m certman.benchmarks compare baseline.json results.json --threshold 0.1
+"""
+import argparse
+import json
+import platform
+import random
+import sqlite3
+import sys
+import time
+
+from certman.benchmarks.scenarios import SCENARIOS, Workspace
+
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+
+def run(sizes=DEFAULT_SIZES, scenarios=None, seed=0, max_files=100000, log=None):
+    """
+    Runs the scenarios for every size and returns the results as a
+    JSON-serializable dict: ``results[scenario][size][metric]``.
+    """
+    selected = [(name, scenario) for name, scenario in SCENARIOS if not scenarios or name in scenarios]
+    results = dict((name, {}) for name, _ in selected)
+    for size in sizes:
+        workspace = Workspace(size, seed, max_files)
+        try:
+            for name, scenario in selected:
+                if log:
+                    log('%s @ %s' % (name, size))
+                results[name][str(size)] = scenario(workspace, random.Random(seed))
+                workspace.release()
+        finally:
+            workspace.close()
+
+    return {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'sqlite': sqlite3.sqlite_version,
+            'platform': platform.platform(),
+            'seed': seed,
+            'sizes': list(sizes),
+        },
+        'results': results,
+    }
+
+
+def higher_is_better(metric):
+    return metric.endswith('_per_sec')
+
+
+def compare(baseline, current, threshold=0.1):
+    """
+    Yields ``(scenario, size, metric, baseline, current, change, regressed)``
+    for every timed metric present in both result sets. ``change`` is the
+    relative change, positive when the metric got better.
+    """
+    for scenario, by_size in sorted(current['results'].items()):
+        for size, metrics in sorted(by_size.items(), key=lambda item: int(item[0])):
+            base_metrics = baseline['results'].get(scenario, {}).get(size)
+            if not base_metrics:
+                continue
+            for metric, value in sorted(metrics.items()):
+                base = base_metrics.get(metric)
+                if not base or not (metric.endswith('_us') or metric.endswith('_per_sec')):
+                    continue
+                if higher_is_better(metric):
+                    change = (value - base) / float(base)
+                else:
+                    change = (base - value) / float(base)
+                yield scenario, size, metric, base, value, change, change < -threshold
+
+
+def print_results(results, out=sys.stdout):
+    for scenario, by_size in sorted(results['results'].items()):
+        for size, metrics in sorted(by_size.items(), key=lambda item: int(item[0])):
+            for metric, value in sorted(metrics.items()):
+                out.write('%-14s %10s %-28s %14.1f\n' % (scenario, size, metric, value))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='python -m certman.benchmarks')
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help='run the benchmark scenarios')
+    run_parser.add_argument('--sizes', default=','.join(str(size) for size in DEFAULT_SIZES),
+                            help='comma separated numbers of certificates')
+    run_parser.add_argument('--scenarios', default='',
+                            help='comma separated scenarios, all by default: %s' % ', '.join(n for n, _ in SCENARIOS))
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--max-files', type=int, default=100000,
+                            help='cap on entries created in the file store')
+    run_parser.add_argument('--output', help='write results as JSON to this file')
+
+    compare_parser = commands.add_parser('compare', help='flag regressions against a baseline')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--threshold', type=float, default=0.1,
+                                help='relative slowdown reported as a regression')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'run':
+        sizes = [int(size) for size in args.sizes.split(',')]
+        scenarios = [name for name in args.scenarios.split(',') if name]
+        results = run(sizes, scenarios, args.seed, args.max_files,
+                      log=lambda message: sys.stderr.write(message + '\n'))
+        print_results(results)
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    regressions = 0
+    for scenario, size, metric, base, value, change, regressed in compare(baseline, current, args.threshold):
+        regressions += regressed
+        print '%-14s %10s %-28s %14.1f %14.1f %+7.1f%%%s' % (
+            scenario, size, metric, base, value, change * 100, '  REGRESSION' if regressed else '')
+    print '\n%s regressions' % regressions
+    return 1 if regressions else 0
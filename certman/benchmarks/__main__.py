@@ -0,0 +1,5 @@
+import sys
+
+from certman.benchmarks import main
+
+sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,38 @@
+#!coding: utf-8
+"""
+Seeded synthetic certificates. The same seed and count always produce the
+same certificates, so runs on different machines or commits are comparable.
+"""
+import random
+
+from datetime import date, timedelta
+
+from certman.manager import Certificate
+
+
+START = date(2016, 1, 1)
+DAYS = 365
+
+
+def email_for(i):
+    return 'user%08d@example.com' % i
+
+
+def generate_certificates(count, seed=0, start=START, days=DAYS):
+    rnd = random.Random(seed)
+    for i in xrange(count):
+        yield Certificate(email=email_for(i),
+                          password='pass%06d' % rnd.randint(0, 999999),
+                          questions=['answer %s' % rnd.randint(0, 99999) for _ in range(4)],
+                          enrollment_id='ENR%08d' % i,
+                          date_obtained=start + timedelta(days=rnd.randint(0, days - 1)))
+
+
+def populate(storage, count, seed=0, chunk_size=10000):
+    chunk = []
+    for certificate in generate_certificates(count, seed):
+        chunk.append(certificate)
+        if len(chunk) >= chunk_size:
+            storage.save_many(chunk)
+            chunk = []
+    storage.save_many(chunk)
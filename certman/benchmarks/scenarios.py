@@ -0,0 +1,529 @@
+#!coding: utf-8
+"""
+Timed scenarios over the storage hot paths. Every scenario takes a
+``Workspace`` and a seeded ``random.Random`` and returns a dict of metrics:
+names ending in ``_us`` are microseconds per call (lower is better), names
+ending in ``_per_sec`` are throughputs (higher is better).
+"""
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from datetime import date, timedelta
+from itertools import islice
+from timeit import default_timer as timer
+
+from certman.benchmarks.data import DAYS, START, email_for, generate_certificates, populate
+from certman.manager import Certificate, CertificateDBStorage, CertificateFileStorage, Manager, Reporter
+
+
+class Workspace(object):
+    """
+    Temporary directory holding a DB populated with ``size`` synthetic
+    certificates. The DB is built once and copied for every scenario, so
+    scenarios that write don't affect each other.
+    """
+
+    def __init__(self, size, seed=0, max_files=100000):
+        self.size = size
+        self.seed = seed
+        self.max_files = max_files
+        self.path = tempfile.mkdtemp(prefix='certman-bench-')
+        self._template = None
+        self._copies = []
+        self._storages = []
+        self.populate_per_sec = None
+
+    def db_path(self):
+        """
+        Path of a fresh copy of the populated DB.
+        """
+        if self._template is None:
+            self._template = os.path.join(self.path, 'template.db')
+            storage = CertificateDBStorage(self._template)
+            started = timer()
+            populate(storage, self.size, self.seed)
+            self.populate_per_sec = self.size / (timer() - started)
+            storage.close()
+
+        path = os.path.join(self.path, 'copy%s.db' % len(self._copies))
+        shutil.copyfile(self._template, path)
+        self._copies.append(path)
+        return path
+
+    def db(self):
+        storage = CertificateDBStorage(self.db_path())
+        self._storages.append(storage)
+        return storage
+
+    def release(self):
+        """
+        Closes and removes the DB copies handed out so far.
+        """
+        for storage in self._storages:
+            storage.close()
+        for path in self._copies:
+            for suffix in ('', '-wal', '-shm'):
+                if os.path.exists(path + suffix):
+                    os.remove(path + suffix)
+        self._storages = []
+        self._copies = []
+
+    def store_path(self):
+        path = os.path.join(self.path, 'store')
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        os.mkdir(path)
+        return path
+
+    def close(self):
+        shutil.rmtree(self.path)
+
+
+def timed(func, args_list):
+    """
+    Average seconds per call of ``func`` over the argument tuples.
+    """
+    started = timer()
+    for args in args_list:
+        func(*args)
+    return (timer() - started) / len(args_list)
+
+
+def existing_emails(size, rnd, count):
+    return [email_for(rnd.randint(0, size - 1)) for _ in range(count)]
+
+
+def db_write(workspace, rnd, calls=1000):
+    storage = workspace.db()
+    new = islice(generate_certificates(workspace.size + calls, workspace.seed), workspace.size, None)
+    return {
+        'save_many_per_sec': workspace.populate_per_sec,
+        'save_us': timed(storage.save, [(certificate,) for certificate in new]) * 1e6,
+    }
+
+
+def db_read(workspace, rnd, calls=2000):
+    storage = workspace.db()
+    emails = existing_emails(workspace.size, rnd, calls)
+    days = [(START + timedelta(days=rnd.randint(0, DAYS - 1)),) * 2 for _ in range(calls // 10)]
+    return {
+        'get_by_email_us': timed(storage.get_by_email, [(email,) for email in emails]) * 1e6,
+        'get_by_id_us': timed(storage.get_by_id, [(rnd.randint(1, workspace.size),) for _ in range(calls)]) * 1e6,
+        'check_exist_hit_us': timed(storage.check_exist, [(Certificate(email=email),) for email in emails]) * 1e6,
+        'check_exist_miss_us': timed(storage.check_exist,
+                                     [(Certificate(email='missing%s@example.com' % i),) for i in range(calls)]) * 1e6,
+        'get_by_date_day_us': timed(lambda start, end: list(storage.get_by_date(start, end)), days) * 1e6,
+    }
+
+
+def membership(workspace, rnd, calls=2000, error_rate=0.01):
+    """
+    Building the email filter and duplicate checks answered with it,
+    against the same checks without it. The false positive rate is measured
+    over emails known to be missing.
+    """
+    plain = workspace.db()
+    storage = CertificateDBStorage(workspace.db_path(), membership_error_rate=error_rate)
+    workspace._storages.append(storage)
+    started = timer()
+    storage.might_exist(email_for(0))
+    build = timer() - started
+    missing = ['missing%s@example.com' % i for i in range(calls * 10)]
+    hits = [(Certificate(email=email),) for email in existing_emails(workspace.size, rnd, calls)]
+    misses = [(Certificate(email=email),) for email in missing[:calls]]
+    info = storage.membership_info()
+    return {
+        'build_per_sec': workspace.size / build,
+        'bytes_per_email': info['bytes'] / float(workspace.size),
+        'false_positive_rate': sum(1 for email in missing if storage.might_exist(email)) / float(len(missing)),
+        'check_exist_hit_us': timed(storage.check_exist, hits) * 1e6,
+        'check_exist_miss_us': timed(storage.check_exist, misses) * 1e6,
+        'unfiltered_check_exist_hit_us': timed(plain.check_exist, hits) * 1e6,
+        'unfiltered_check_exist_miss_us': timed(plain.check_exist, misses) * 1e6,
+    }
+
+
+def db_delete(workspace, rnd, calls=1000):
+    storage = workspace.db()
+    emails = list(set(existing_emails(workspace.size, rnd, calls)))
+    delete_us = timed(storage.delete, [(email,) for email in emails]) * 1e6
+
+    storage = workspace.db()
+    started = timer()
+    count = len(storage.delete_many(start=START, end=START + timedelta(days=DAYS // 4)))
+    return {
+        'delete_us': delete_us,
+        'delete_many_per_sec': count / (timer() - started),
+    }
+
+
+def db_session(workspace, rnd, calls=200):
+    path = workspace.db_path()
+
+    def command(email):
+        storage = CertificateDBStorage(path)
+        storage.get_by_email(email)
+        storage.close()
+
+    return {
+        'open_and_lookup_us': timed(command, [(email,) for email in existing_emails(workspace.size, rnd, calls)]) * 1e6,
+    }
+
+
+def db_decode(workspace, rnd):
+    storage = workspace.db()
+    started = timer()
+    count = sum(1 for _ in storage.get_by_date(START, START + timedelta(days=DAYS)))
+    return {
+        'get_by_date_rows_per_sec': count / (timer() - started),
+    }
+
+
+def search(workspace, rnd, calls=200):
+    """
+    Email and enrollment ID prefix lookups and a term matching every row,
+    the first results page of each.
+    """
+    storage = workspace.db()
+    ids = [rnd.randint(0, workspace.size - 1) for _ in range(calls)]
+    return {
+        'email_fragment_us': timed(storage.search, [(email_for(i)[:10],) for i in ids]) * 1e6,
+        'enrollment_fragment_us': timed(storage.search, [(('ENR%08d' % i)[:9],) for i in ids]) * 1e6,
+        'common_term_us': timed(storage.search, [('example',)] * (calls // 10)) * 1e6,
+    }
+
+
+def archive(workspace, rnd, calls=2000):
+    """
+    Moving the older half of the workspace into the archive, and lookups
+    hitting either tier afterwards.
+    """
+    path = workspace.db_path()
+    storage = CertificateDBStorage(path, archive=path + '.archive')
+    workspace._storages.append(storage)
+    workspace._copies.append(path + '.archive')
+    size_before = os.path.getsize(path)
+    middle = START + timedelta(days=DAYS // 2)
+    started = timer()
+    count = storage.archive_before(middle)
+    archive_per_sec = count / (timer() - started)
+    storage.vacuum()
+
+    hot, cold = [], []
+    for email in existing_emails(workspace.size, rnd, calls):
+        (cold if storage.get_by_email(email).date_obtained < middle else hot).append((email,))
+    return {
+        'archive_rows_per_sec': archive_per_sec,
+        'hot_size_ratio': os.path.getsize(path) / float(size_before),
+        'hot_get_by_email_us': timed(storage.get_by_email, hot) * 1e6,
+        'archived_get_by_email_us': timed(storage.get_by_email, cold) * 1e6,
+        'hot_week_count_us': timed(storage.count_by_date, [(middle, middle + timedelta(days=6))] * 100) * 1e6,
+    }
+
+
+def changes(workspace, rnd, calls=1000):
+    """
+    Reading the change log from the start, as a new consumer does, a full
+    replica sync and an incremental one after ``calls`` deletes.
+    """
+    storage = workspace.db()
+    started = timer()
+    count = sum(1 for _ in storage.changes())
+    read_per_sec = count / (timer() - started)
+
+    replica = workspace.db_path()
+    os.remove(replica)
+    replica = CertificateDBStorage(replica)
+    workspace._storages.append(replica)
+    started = timer()
+    count = replica.replicate_from(storage, 'bench')
+    replicate_per_sec = count / (timer() - started)
+
+    storage.delete_many(emails=existing_emails(workspace.size, rnd, calls))
+    started = timer()
+    replica.replicate_from(storage, 'bench')
+    return {
+        'read_rows_per_sec': read_per_sec,
+        'replicate_rows_per_sec': replicate_per_sec,
+        'incremental_sync_us': (timer() - started) * 1e6,
+    }
+
+
+def snapshot(workspace, rnd):
+    """
+    Writing a snapshot of the whole workspace and restoring it into an
+    empty DB. The restore writes the entries into a packed JSON store, a
+    directory per certificate being impractical at a million rows.
+    """
+    from certman.packstore import CertificatePackStorage
+    from certman.snapshot import restore_snapshot, write_snapshot
+
+    path = os.path.join(workspace.path, 'snapshot.gz')
+    storage = workspace.db()
+    started = timer()
+    count = write_snapshot(storage, path)
+    write_per_sec = count / (timer() - started)
+
+    restored = workspace.db_path()
+    os.remove(restored)
+    restored = CertificateDBStorage(restored)
+    workspace._storages.append(restored)
+    store = CertificatePackStorage(workspace.store_path(), codec='json')
+    try:
+        started = timer()
+        restore_snapshot(restored, store, path)
+        restore_per_sec = count / (timer() - started)
+    finally:
+        store.close()
+    metrics = {
+        'write_rows_per_sec': write_per_sec,
+        'bytes_per_row': os.path.getsize(path) / float(count),
+        'restore_rows_per_sec': restore_per_sec,
+    }
+    os.remove(path)
+    return metrics
+
+
+def file_storage(workspace, rnd, calls=2000, shard_levels=2):
+    """
+    The file store is filled with at most ``max_files`` entries of the
+    workspace, a million directories being impractical on most test boxes.
+    """
+    count = min(workspace.size, workspace.max_files)
+    storage = CertificateFileStorage(workspace.store_path(), shard_levels=shard_levels)
+    save_us = timed(storage.save, [(certificate,) for certificate in generate_certificates(count, workspace.seed)])
+    return {
+        'files': count,
+        'save_us': save_us * 1e6,
+        'check_exist_us': timed(storage.check_exist,
+                                [(Certificate(email=email),) for email in existing_emails(count, rnd, calls)]) * 1e6,
+    }
+
+
+class TableOutput(object):
+    """
+    Discards output, remembering when the first page was flushed.
+    """
+
+    first_flush = None
+
+    def write(self, data):
+        pass
+
+    def flush(self):
+        if self.first_flush is None:
+            self.first_flush = timer()
+
+
+def report(workspace, rnd, weeks=20):
+    reporter = Reporter(workspace.db())
+
+    def week_report(start):
+        rows, total = reporter.generate_report(start, start + timedelta(days=6))
+        for _ in rows:
+            pass
+
+    started = timer()
+    rows, total = reporter.generate_report(START, START + timedelta(days=DAYS))
+    count = sum(1 for _ in rows)
+    rows_per_sec = count / (timer() - started)
+
+    out = TableOutput()
+    started = timer()
+    reporter.write_report(out, 'table', START, START + timedelta(days=DAYS))
+    elapsed = timer() - started
+    return {
+        'year_rows_per_sec': rows_per_sec,
+        'year_table_rows_per_sec': count / elapsed,
+        'year_table_first_page_us': (out.first_flush - started) * 1e6,
+        'week_report_us': timed(week_report,
+                                [(START + timedelta(days=rnd.randint(0, DAYS - 7)),) for _ in range(weeks)]) * 1e6,
+    }
+
+
+def add_certificates(db_path, store_path, emails, results):
+    manager = Manager(CertificateDBStorage(db_path), CertificateFileStorage(store_path, shard_levels=2))
+    added = 0
+    try:
+        for email in emails:
+            added += manager.add_certificate(Certificate(email=email, password='password',
+                                                         enrollment_id='1', questions=['answer']))
+    finally:
+        manager.close()
+        results.put(added)
+
+
+def concurrent_writes(workspace, rnd, processes=4, calls=500):
+    """
+    ``processes`` writers adding ``calls`` certificates each to the same DB
+    and store. A quarter of every writer's emails are shared with the other
+    writers, so they race for the same rows.
+    """
+    db_path = workspace.db_path()
+    store_path = workspace.store_path()
+    shared = ['shared%s@bench.example.com' % i for i in range(calls // 4)]
+    results = multiprocessing.Queue()
+    writers = []
+    for number in range(processes):
+        emails = shared + ['writer%s-%s@bench.example.com' % (number, i) for i in range(calls - len(shared))]
+        rnd.shuffle(emails)
+        writers.append(multiprocessing.Process(target=add_certificates, args=(db_path, store_path, emails, results)))
+
+    started = timer()
+    for writer in writers:
+        writer.start()
+    added = sum(results.get() for _ in writers)
+    elapsed = timer() - started
+    for writer in writers:
+        writer.join()
+
+    storage = CertificateDBStorage(db_path)
+    rows = storage.count_by_date(date.today(), date.today())
+    storage.close()
+    entries = sum(1 for _ in CertificateFileStorage(store_path, shard_levels=2).iter_emails())
+    expected = len(shared) + processes * (calls - len(shared))
+    if not added == rows == entries == expected:
+        raise RuntimeError('%s adds, %s rows and %s store entries for %s certificates'
+                           % (added, rows, entries, expected))
+    return {
+        'writers': processes,
+        'writes_per_sec': added / elapsed,
+        'attempts_per_sec': processes * calls / elapsed,
+    }
+
+
+def write_behind(workspace, rnd, calls=1000):
+    """
+    Adds through the manager with the store written inline and behind.
+    Latency is until ``add_certificate`` returns, the queue being large
+    enough for the whole burst; the write-behind rate includes waiting for
+    the queue to drain, fsyncs included, which the inline writes skip.
+    """
+    from certman.writebehind import WriteBehindStorage
+
+    def adds(manager, prefix):
+        return [(Certificate(email='%s%s@bench.example.com' % (prefix, i), password='password',
+                             enrollment_id='1', questions=['answer']),) for i in range(calls)]
+
+    manager = Manager(workspace.db(), CertificateFileStorage(workspace.store_path(), shard_levels=2))
+    inline_us = timed(manager.add_certificate, adds(manager, 'inline')) * 1e6
+
+    manager = Manager(workspace.db(), WriteBehindStorage(CertificateFileStorage(workspace.store_path(),
+                                                                                shard_levels=2), queue_size=calls))
+    started = timer()
+    behind_us = timed(manager.add_certificate, adds(manager, 'behind')) * 1e6
+    failures = manager.flush_writes()
+    elapsed = timer() - started
+    manager.close()
+    if failures:
+        raise RuntimeError('%s store writes failed' % len(failures))
+    return {
+        'inline_add_us': inline_us,
+        'write_behind_add_us': behind_us,
+        'write_behind_adds_per_sec': calls / elapsed,
+    }
+
+
+def async_adds(workspace, rnd, calls=1000, concurrency=(1, 16, 128)):
+    """
+    Load test of the async API: adds are made as fast as completions allow
+    while keeping up to ``concurrency`` of them in flight, like as many
+    clients of an intake service. Compared with adds one at a time through
+    the blocking manager: the async API frees the caller's thread but adds
+    no throughput: ``cN_vs_sync`` stays at 1 or below.
+    """
+    import threading
+
+    from certman.asyncstorage import AsyncCertificateDBStorage, AsyncCertificateFileStorage, AsyncManager
+
+    def certificates(prefix):
+        return [Certificate(email='%s%s@bench.example.com' % (prefix, i), password='password',
+                            enrollment_id='1', questions=['answer']) for i in range(calls)]
+
+    manager = Manager(workspace.db(), CertificateFileStorage(workspace.store_path(), shard_levels=2))
+    started = timer()
+    for certificate in certificates('sync'):
+        manager.add_certificate(certificate)
+    metrics = {'sync_adds_per_sec': calls / (timer() - started)}
+
+    for level in concurrency:
+        manager = AsyncManager(AsyncCertificateDBStorage(workspace.db_path()),
+                               AsyncCertificateFileStorage(CertificateFileStorage(workspace.store_path(),
+                                                                                  shard_levels=2)))
+        slots = threading.Semaphore(level)
+        latencies = []
+        failures = []
+
+        def finished(future, started):
+            latencies.append(timer() - started)
+            if future.exception() is not None or not future.result():
+                failures.append(future)
+            slots.release()
+
+        started = timer()
+        for certificate in certificates('async%s-' % level):
+            slots.acquire()
+            manager.add_certificate(certificate).add_done_callback(lambda f, started=timer(): finished(f, started))
+        for _ in range(level):
+            slots.acquire()
+        elapsed = timer() - started
+        manager.close()
+        if failures:
+            raise RuntimeError('%s async adds failed' % len(failures))
+        latencies.sort()
+        metrics['c%s_adds_per_sec' % level] = calls / elapsed
+        metrics['c%s_vs_sync' % level] = calls / elapsed / metrics['sync_adds_per_sec']
+        metrics['c%s_p99_us' % level] = latencies[int(len(latencies) * 0.99)] * 1e6
+    return metrics
+
+
+def first_output(argv, env):
+    """
+    Seconds from starting a fresh interpreter running ``argv`` until its
+    first line of output.
+    """
+    started = timer()
+    process = subprocess.Popen([sys.executable, '-m', 'certman.cli'] + argv, env=env,
+                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    process.stdout.readline()
+    elapsed = timer() - started
+    process.communicate()
+    return elapsed
+
+
+def cold_start(workspace, rnd, calls=5):
+    """
+    Startup cost of one-shot CLI commands, as paid by every cron job.
+    """
+    env = dict(os.environ, CERTMAN_DB=workspace.db_path(), CERTMAN_STORE_PATH=workspace.store_path(),
+               CERTMAN_DEFAULT_PASSWORD='benchmark')
+    day = START + timedelta(days=rnd.randint(0, DAYS - 1))
+    report = ['report', '--from', day.strftime('%Y-%m-%d'), '--to', day.strftime('%Y-%m-%d'), '--format', 'csv']
+    return {
+        'help_first_output_us': timed(first_output, [(['--help'], env)] * calls) * 1e6,
+        'report_first_output_us': timed(first_output, [(report, env)] * calls) * 1e6,
+    }
+
+
+SCENARIOS = (
+    ('db_write', db_write),
+    ('db_read', db_read),
+    ('membership', membership),
+    ('db_delete', db_delete),
+    ('db_session', db_session),
+    ('concurrent_writes', concurrent_writes),
+    ('write_behind', write_behind),
+    ('async_adds', async_adds),
+    ('db_decode', db_decode),
+    ('search', search),
+    ('archive', archive),
+    ('changes', changes),
+    ('snapshot', snapshot),
+    ('file_storage', file_storage),
+    ('report', report),
+    ('cold_start', cold_start),
+)
@@ -0,0 +1,59 @@
+#!coding: utf-8
+from collections import OrderedDict
+
+
+class CertificateCache(object):
+    """
+    Bounded LRU cache of decoded certificates. The same certificate may be
+    cached under several keys (e.g. its email and its DB id); all of them
+    are dropped together by ``invalidate``. Cached certificates are shared
+    between callers and must be treated as read-only.
+    """
+
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._keys_by_email = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        try:
+            certificate = self._entries.pop(key)
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries[key] = certificate
+        self.hits += 1
+        return certificate
+
+    def put(self, key, certificate):
+        self._entries.pop(key, None)
+        self._entries[key] = certificate
+        self._keys_by_email.setdefault(certificate.email, set()).add(key)
+        while len(self._entries) > self.maxsize:
+            old_key, old = self._entries.popitem(last=False)
+            keys = self._keys_by_email.get(old.email)
+            if keys is not None:
+                keys.discard(old_key)
+                if not keys:
+                    del self._keys_by_email[old.email]
+
+    def invalidate(self, email):
+        for key in self._keys_by_email.pop(email, ()):
+            self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._keys_by_email.clear()
+
+    def info(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize,
+        }
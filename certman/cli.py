@@ -0,0 +1,256 @@
+#!coding: utf-8
+"""
+Non-interactive entry point: every subcommand runs one command and exits,
+so certman can be scripted from cron::
+
+    certman report --from 2016-01-04 --to 2016-01-10 --format csv --output week.csv
+    certman add --from-file new.ndjson
+    certman delete first@mail.ru second@mail.ru
+    certman delete --to 2015-12-31 --dry-run
+    certman changes --since 1200 > changes.ndjson
+    certman replicate /var/lib/certman/replica.db --follow
+    certman snapshot /backup/certman-2016-01-10.gz
+
+Without a subcommand the interactive shell is started. Storage modules are
+only imported once a command needs them, which keeps ``--help`` and
+argument errors instant.
+"""
+import argparse
+import signal
+import sys
+
+from datetime import datetime
+
+
+REPORT_FORMATS = ('table', 'csv', 'ndjson')
+PERIODS = ('day', 'week', 'month', 'year')
+
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise argparse.ArgumentTypeError("invalid date '%s', expected YYYY-MM-DD" % value)
+
+
+def period_args(args):
+    """
+    The ``--from``/``--to`` pair, ``(None, None)`` for the command default.
+    """
+    if args.start is None:
+        return None, None
+    return args.start, args.end or datetime.now().date()
+
+
+def run_shell(manager, args):
+    from certman import Certman
+
+    return Certman(manager).run()
+
+
+def run_report(manager, args):
+    start, end = period_args(args)
+    out = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        total = manager.command_report(start, end, args.format, out)
+    finally:
+        if args.output:
+            out.close()
+    sys.stderr.write('Total certificates obtained: %s\n' % total)
+
+
+def run_add(manager, args):
+    if not args.from_file:
+        count = manager.command_addcert()
+        print "Successfully added %s certificates" % count
+        return
+    result = manager.command_import(args.from_file)
+    for line_num, email, reason in result.rejects:
+        sys.stderr.write('Rejected line %s (%s): %s\n' % (line_num, email or '-', reason))
+    print "Successfully imported %s certificates, %s rejected" % (result.imported, len(result.rejects))
+    return 1 if result.rejects else 0
+
+
+def run_delete(manager, args):
+    from certman.formats import read_emails
+
+    if args.from_file:
+        with open(args.from_file) as f:
+            deleted = manager.command_delete_many(read_emails(f), args.start, args.end, args.dry_run)
+    else:
+        deleted = manager.command_delete_many(args.emails or None, args.start, args.end, args.dry_run)
+    if args.dry_run:
+        print "%s certificates would be deleted" % len(deleted)
+    else:
+        print "Deleted %s certificates" % len(deleted)
+    return 0 if deleted else 1
+
+
+def run_search(manager, args):
+    certificates = manager.command_search(' '.join(args.terms), args.page, args.per_page, args.format)
+    return 0 if certificates else 1
+
+
+def run_stats(manager, args):
+    start, end = period_args(args)
+    rows = manager.command_stats(args.by, start, end)
+    for label, total in rows:
+        print "%12s %8s" % (label, total)
+    print "\nTotal certificates obtained: %s" % sum(total for _, total in rows)
+
+
+def run_verify(manager, args):
+    result = manager.command_verify(args.incremental, args.repair, args.orphans)
+    return 1 if result.issues and not args.repair else 0
+
+
+def run_migrate_store(manager, args):
+    print "Store migrated, %s certificates moved" % manager.command_migrate_store()
+
+
+def run_compact_store(manager, args):
+    print "Store compacted, %s bytes reclaimed" % manager.command_compact_store()
+
+
+def run_archive(manager, args):
+    print "Archived %s certificates" % manager.command_archive(args.older_than, not args.no_vacuum)
+
+
+def run_changes(manager, args):
+    seq = manager.command_changes(args.since, args.limit)
+    sys.stderr.write('Next: certman changes --since %s\n' % seq)
+
+
+def run_replicate(manager, args):
+    log = lambda message: sys.stderr.write(message + '\n')
+    try:
+        applied = manager.command_replicate(args.replica, args.batch_size, args.follow, args.interval, log)
+    except KeyboardInterrupt:
+        return 0
+    print "Replica up to date, %s changes applied" % applied
+
+
+def run_snapshot(manager, args):
+    print "Snapshot written, %s certificates" % manager.command_snapshot(args.path)
+
+
+def run_restore(manager, args):
+    print "Restored %s certificates" % manager.command_restore(args.path)
+
+
+def run_rebuild_stats(manager, args):
+    manager.command_rebuild_stats()
+    print "Certificate totals rebuilt"
+
+
+def add_period_arguments(parser):
+    parser.add_argument('--from', dest='start', type=parse_day, help='first day, YYYY-MM-DD')
+    parser.add_argument('--to', dest='end', type=parse_day, help='last day, YYYY-MM-DD, today by default')
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='certman', description='Certificates Manager')
+    commands = parser.add_subparsers(dest='command')
+
+    commands.add_parser('shell', help='start the interactive shell').set_defaults(run=run_shell)
+
+    report = commands.add_parser('report', help='report certificates for this week or a date range')
+    add_period_arguments(report)
+    report.add_argument('--format', choices=REPORT_FORMATS, default='table')
+    report.add_argument('--output', help='write the report to this file instead of stdout')
+    report.set_defaults(run=run_report)
+
+    add = commands.add_parser('add', help='add certificates interactively or from a file')
+    add.add_argument('--from-file', help='csv, ndjson or yaml file to import')
+    add.set_defaults(run=run_add)
+
+    delete = commands.add_parser('delete', help='delete certificates by email or date range')
+    delete.add_argument('emails', nargs='*', metavar='EMAIL')
+    delete.add_argument('--from-file', help='file with one email per line')
+    add_period_arguments(delete)
+    delete.add_argument('--dry-run', action='store_true', help='only count the certificates to delete')
+    delete.set_defaults(run=run_delete)
+
+    search = commands.add_parser('search', help='find certificates by partial email, enrollment ID or answer')
+    search.add_argument('terms', nargs='+', metavar='TERM')
+    search.add_argument('--page', type=int, default=1)
+    search.add_argument('--per-page', type=int, default=20)
+    search.add_argument('--format', choices=REPORT_FORMATS, default='table')
+    search.set_defaults(run=run_search)
+
+    stats = commands.add_parser('stats', help='certificate totals by day, week, month or year')
+    stats.add_argument('--by', choices=PERIODS, default='week')
+    add_period_arguments(stats)
+    stats.set_defaults(run=run_stats)
+
+    verify = commands.add_parser('verify', help='check the database against the file store')
+    verify.add_argument('--incremental', action='store_true', help='only check changes since the last run')
+    verify.add_argument('--repair', action='store_true')
+    verify.add_argument('--orphans', choices=('restore', 'delete'), default='restore',
+                        help='what to do with store entries missing from the database')
+    verify.set_defaults(run=run_verify)
+
+    commands.add_parser('migrate-store', help='move plain files into the sharded store layout') \
+        .set_defaults(run=run_migrate_store)
+    commands.add_parser('compact-store', help='reclaim space in the packed store') \
+        .set_defaults(run=run_compact_store)
+    archive = commands.add_parser('archive', help='move old certificates into the archive database and prune '
+                                                  'the change log')
+    archive.add_argument('--older-than', type=int, metavar='DAYS',
+                         help='age of archived certificates, CERTMAN_ARCHIVE_AFTER_DAYS by default')
+    archive.add_argument('--no-vacuum', action='store_true', help="don't shrink the database file afterwards")
+    archive.set_defaults(run=run_archive)
+
+    changes = commands.add_parser('changes', help='stream inserts and deletes logged after a sequence number')
+    changes.add_argument('--since', type=int, default=0, metavar='SEQ',
+                         help='last sequence number already seen, 0 for the whole log')
+    changes.add_argument('--limit', type=int, help='at most this many changes')
+    changes.set_defaults(run=run_changes)
+
+    replicate = commands.add_parser('replicate', help='apply logged changes to a replica database')
+    replicate.add_argument('replica', help='replica database file, created on first run')
+    replicate.add_argument('--batch-size', type=int, default=1000, help='changes applied per transaction')
+    replicate.add_argument('--follow', action='store_true', help='keep applying new changes until interrupted')
+    replicate.add_argument('--interval', type=float, default=5.0, help='seconds between polls with --follow')
+    replicate.set_defaults(run=run_replicate)
+
+    snapshot = commands.add_parser('snapshot', help='write every certificate to a compressed snapshot file')
+    snapshot.add_argument('path', help='snapshot file, replaced once complete')
+    snapshot.set_defaults(run=run_snapshot)
+
+    restore = commands.add_parser('restore', help='rebuild an empty database and the store from a snapshot')
+    restore.add_argument('path', help='snapshot file')
+    restore.set_defaults(run=run_restore)
+
+    commands.add_parser('rebuild-stats', help='recount certificate totals from the database') \
+        .set_defaults(run=run_rebuild_stats)
+    return parser
+
+
+def terminate(signum, frame):
+    raise SystemExit(128 + signum)
+
+
+def main(argv):
+    # argparse of Python 2 has no optional subcommands
+    args = build_parser().parse_args(argv or ['shell'])
+
+    from certman.manager import Manager
+    from certman.settings import SettingsError
+
+    # Being killed unwinds like an interrupt, so queued store writes are
+    # flushed by closing the manager
+    previous = signal.signal(signal.SIGTERM, terminate)
+    manager = Manager()
+    try:
+        return args.run(manager, args) or 0
+    except (SettingsError, IOError, ValueError) as e:
+        sys.stderr.write('certman %s: %s\n' % (args.command, e))
+        return 1
+    finally:
+        manager.close()
+        signal.signal(signal.SIGTERM, previous)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,197 @@
+#!coding: utf-8
+"""
+Streaming readers and writers for certificate data. Every reader yields
+``(line_number, record)`` pairs one by one, so input files of any size are
+never loaded into memory as a whole. Records that cannot be parsed are
+yielded as exception instances so the caller can reject them and carry on.
+Writers consume iterables row by row in the same way.
+"""
+import csv
+import json
+import os
+import textwrap
+
+from itertools import chain, islice
+
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_to_str(item) for item in value]
+    return value
+
+
+def _normalize(record):
+    if 'certificate' in record and isinstance(record['certificate'], dict):
+        record = record['certificate']
+    return dict((_to_str(key), _to_str(value)) for key, value in record.items())
+
+
+def read_csv(f):
+    """
+    CSV with a header row. Answers are taken from every column whose name
+    starts with ``question`` in the order they appear in the header.
+    """
+    reader = csv.DictReader(f)
+    question_columns = [name for name in reader.fieldnames or [] if name.startswith('question')]
+    for row in reader:
+        record = dict((key, value) for key, value in row.items() if key not in question_columns)
+        record['questions'] = [row[name] for name in question_columns if row[name]]
+        yield reader.line_num, record
+
+
+def read_ndjson(f):
+    for line_num, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError as e:
+            yield line_num, ValueError('invalid JSON: %s' % e)
+            continue
+        yield line_num, _normalize(record)
+
+
+def read_yaml(f):
+    """
+    Multi-document YAML stream, one certificate per document. Documents may
+    be either plain mappings or ``credentials.yaml`` style ``certificate:``
+    mappings.
+    """
+    import yaml
+
+    for doc_num, document in enumerate(yaml.safe_load_all(f), 1):
+        if document is None:
+            continue
+        yield doc_num, _normalize(document)
+
+
+def read_emails(f):
+    """
+    Plain list of emails, one per line. Blank lines and lines starting with
+    ``#`` are skipped.
+    """
+    for line in f:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            yield line
+
+
+READERS = {
+    '.csv': read_csv,
+    '.ndjson': read_ndjson,
+    '.jsonl': read_ndjson,
+    '.json': read_ndjson,
+    '.yaml': read_yaml,
+    '.yml': read_yaml,
+}
+
+
+def reader_for(path):
+    _, ext = os.path.splitext(path)
+    try:
+        return READERS[ext.lower()]
+    except KeyError:
+        raise ValueError("Unsupported input format '%s'" % ext)
+
+
+def certificate_record(certificate):
+    return {
+        'date_obtained': certificate.date_obtained.strftime('%Y-%m-%d'),
+        'email': certificate.email,
+        'password': certificate.password,
+        'enrollment_id': certificate.enrollment_id,
+        'questions': certificate.questions,
+    }
+
+
+def write_csv(certificates, out):
+    writer = csv.writer(out)
+    writer.writerow(['date_obtained', 'email', 'password', 'enrollment_id', 'answers'])
+    for certificate in certificates:
+        writer.writerow([_to_str(value) for value in (
+            certificate.date_obtained.strftime('%Y-%m-%d'), certificate.email, certificate.password,
+            certificate.enrollment_id, '\n'.join(certificate.questions))])
+
+
+def write_ndjson(certificates, out):
+    """
+    One JSON object per line, in the same shape ``read_ndjson`` accepts.
+    """
+    for certificate in certificates:
+        out.write(json.dumps(certificate_record(certificate), sort_keys=True))
+        out.write('\n')
+
+
+def write_changes(changes, out):
+    """
+    One JSON object per change, the certificate in ``read_ndjson`` shape
+    for inserts. Returns the sequence number of the last change written.
+    """
+    seq = None
+    for change in changes:
+        record = {'seq': change.seq, 'op': change.op, 'email': change.email, 'changed_at': change.changed_at}
+        if change.certificate is not None:
+            record['certificate'] = certificate_record(change.certificate)
+        out.write(json.dumps(record, sort_keys=True))
+        out.write('\n')
+        seq = change.seq
+    return seq
+
+
+def _cell_lines(value, width, max_lines):
+    if value is None:
+        value = ''
+    elif not isinstance(value, basestring):
+        value = str(value)
+    lines = []
+    for line in value.splitlines() or ['']:
+        if len(line) <= width:
+            lines.append(line)
+        else:
+            lines.extend(textwrap.wrap(line, width))
+    if len(lines) > max_lines:
+        lines = lines[:max_lines]
+        lines[-1] = lines[-1][:width - 3] + '...'
+    return lines
+
+
+def _table_line(cells, widths):
+    return ' ' + ' | '.join(cell + ' ' * (width - len(cell)) for cell, width in zip(cells, widths)) + ' \n'
+
+
+def write_table(rows, header, title, out, page_size=50, max_width=40, max_lines=8, sample_size=100):
+    """
+    Streams rows as a text table. Column widths are measured on the header
+    and the first ``sample_size`` rows and capped at ``max_width``, longer
+    cells are wrapped and cut after ``max_lines`` lines. Output is flushed
+    and the header repeated every ``page_size`` rows, so the first page
+    shows up while the rest are still being read.
+    """
+    rows = iter(rows)
+    sample = list(islice(rows, sample_size))
+    widths = [len(name) for name in header]
+    for row in sample:
+        for i, value in enumerate(row):
+            for line in _cell_lines(value, max_width, max_lines):
+                widths[i] = max(widths[i], len(line))
+    separator = '+'.join('-' * (width + 2) for width in widths) + '\n'
+
+    out.write(title + '\n\n')
+    count = 0
+    for row in chain(sample, rows):
+        if count % page_size == 0:
+            if count:
+                out.write('\n')
+                out.flush()
+            out.write(_table_line(header, widths) + separator)
+        cells = [_cell_lines(value, width, max_lines) for value, width in zip(row, widths)]
+        for line_number in range(max(len(lines) for lines in cells)):
+            out.write(_table_line([lines[line_number] if line_number < len(lines) else '' for lines in cells],
+                                  widths))
+        count += 1
+    if not count:
+        out.write(_table_line(header, widths) + separator)
+    out.flush()
@@ -0,0 +1,205 @@
+#!coding: utf-8
+"""
+Lightweight operation timers, SQL tracing and profiling.
+
+Methods decorated with ``timed`` record their call count, latency and the
+number of rows they touched into the process-wide ``INSTRUMENTATION``
+registry. Latency percentiles are computed over a bounded window of recent
+calls, so memory use doesn't grow with the number of calls.
+"""
+import functools
+import inspect
+import json
+import sqlite3
+import sys
+import time
+
+from collections import deque
+from timeit import default_timer as timer
+
+from certman.settings import SETTINGS
+
+
+class OperationStats(object):
+    WINDOW = 2048
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.rows = 0
+        self.samples = deque(maxlen=self.WINDOW)
+
+    def add(self, elapsed, rows):
+        self.count += 1
+        self.total += elapsed
+        self.rows += rows
+        self.samples.append(elapsed)
+
+    def percentile(self, p):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'total_ms': self.total * 1e3,
+            'p50_ms': self.percentile(0.5) * 1e3,
+            'p99_ms': self.percentile(0.99) * 1e3,
+            'rows': self.rows,
+        }
+
+
+class Instrumentation(object):
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.operations = {}
+        self.started = time.time()
+
+    def record(self, name, elapsed, rows=0):
+        stats = self.operations.get(name)
+        if stats is None:
+            stats = self.operations[name] = OperationStats()
+        stats.add(elapsed, rows)
+
+    def reset(self):
+        self.operations = {}
+        self.started = time.time()
+
+    def snapshot(self):
+        return {
+            'since': self.started,
+            'timestamp': time.time(),
+            'operations': dict((name, stats.as_dict()) for name, stats in self.operations.items()),
+        }
+
+    def to_json(self):
+        return json.dumps(self.snapshot(), indent=2, sort_keys=True)
+
+    def rows(self):
+        """
+        Table rows for display, slowest operations by total time first.
+        """
+        result = []
+        for name, stats in sorted(self.operations.items(), key=lambda item: -item[1].total):
+            values = stats.as_dict()
+            result.append([name, str(values['count']), '%.2f' % values['total_ms'],
+                           '%.3f' % values['p50_ms'], '%.3f' % values['p99_ms'], str(values['rows'])])
+        return result
+
+
+INSTRUMENTATION = Instrumentation(enabled=SETTINGS['instrument'])
+
+HEADER = ['Operation', 'Calls', 'Total ms', 'p50 ms', 'p99 ms', 'Rows']
+
+
+def found(result):
+    return 0 if result is None else 1
+
+
+def hit(result):
+    return 1 if result else 0
+
+
+def timed(name, rows=None):
+    """
+    Records calls of the decorated function under ``name``. ``rows`` is the
+    number of rows a call touches, or a function computing it from the
+    result. Generator functions are timed only while producing items, and
+    every item counts as a row.
+    """
+    def decorator(func):
+        if inspect.isgeneratorfunction(func):
+            @functools.wraps(func)
+            def generator_wrapper(*args, **kwargs):
+                if not INSTRUMENTATION.enabled:
+                    for item in func(*args, **kwargs):
+                        yield item
+                    return
+                elapsed = 0.0
+                count = 0
+                iterator = func(*args, **kwargs)
+                try:
+                    while True:
+                        started = timer()
+                        try:
+                            item = next(iterator)
+                        except StopIteration:
+                            return
+                        finally:
+                            elapsed += timer() - started
+                        count += 1
+                        yield item
+                finally:
+                    INSTRUMENTATION.record(name, elapsed, count)
+            return generator_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION.enabled:
+                return func(*args, **kwargs)
+            started = timer()
+            try:
+                result = func(*args, **kwargs)
+            except:
+                INSTRUMENTATION.record(name, timer() - started)
+                raise
+            INSTRUMENTATION.record(name, timer() - started, rows(result) if callable(rows) else rows or 0)
+            return result
+        return wrapper
+    return decorator
+
+
+class TracingCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = timer()
+        try:
+            return sqlite3.Cursor.execute(self, sql, parameters)
+        finally:
+            self.connection.trace(sql, parameters, timer() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = timer()
+        try:
+            return sqlite3.Cursor.executemany(self, sql, seq_of_parameters)
+        finally:
+            self.connection.trace(sql, '<%s rows>' % self.rowcount, timer() - started)
+
+
+class TracingConnection(sqlite3.Connection):
+    """
+    Connection that logs every statement with its parameters and duration
+    to ``trace_out``. The sqlite3 module of Python 2 has no trace callback,
+    so statements are caught at the cursor level instead.
+    """
+
+    trace_out = sys.stderr
+
+    def cursor(self, factory=TracingCursor):
+        return sqlite3.Connection.cursor(self, factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def trace(self, sql, parameters, elapsed):
+        self.trace_out.write('%8.3fms %s %r\n' % (elapsed * 1e3, ' '.join(sql.split()), parameters))
+        self.trace_out.flush()
+
+
+def profile_call(func, args=(), out=sys.stdout, limit=25, dump_path=None):
+    """
+    Runs ``func(*args)`` under cProfile, prints the top ``limit`` entries by
+    cumulative time and optionally dumps the raw stats for later analysis.
+    """
+    import cProfile
+    import pstats
+
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(func, *args)
+    finally:
+        if dump_path:
+            profiler.dump_stats(dump_path)
+        stats = pstats.Stats(profiler, stream=out)
+        stats.sort_stats('cumulative').print_stats(limit)
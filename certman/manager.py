@@ -1,14 +1,23 @@
-import yaml
+import errno
+import hashlib
+import json
 import os
+import random
 import re
 import sqlite3
 import shutil
+import sys
 import time
 
 from datetime import datetime, timedelta, date
 from email.utils import parseaddr
 
-from certman.settings import SETTINGS
+from certman.cache import CertificateCache
+from certman.instrument import TracingConnection, found, hit, timed
+from certman.membership import EmailFilter
+from certman.schema import ARCHIVE_MIGRATIONS, migrate, rebuild_counts, search_index_kind
+from certman.serializers import CODECS, get_codec
+from certman.settings import SETTINGS, require
 
 
 def get_current_week():
@@ -18,7 +27,64 @@ def get_current_week():
     return start, end
 
 
+def parse_date(date_string, _parsed={}):
+    """
+    Decodes a ``YYYY-MM-DD`` string. Rows share few distinct days, so
+    decoded dates are memoized.
+    """
+    try:
+        return _parsed[date_string]
+    except KeyError:
+        parsed = date(int(date_string[:4]), int(date_string[5:7]), int(date_string[8:10]))
+        _parsed[date_string] = parsed
+        return parsed
+
+
+def decode_text(value):
+    """
+    Text read from files and terminals comes as UTF-8 byte strings, which
+    sqlite3 only binds when they are ASCII.
+    """
+    return value.decode('utf-8') if isinstance(value, str) else value
+
+
+class CertificateExists(sqlite3.IntegrityError):
+    pass
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class Change(object):
+    """
+    An entry of the change log: an insert carrying the certificate as it
+    is stored now, or None once it is gone, or a delete carrying only the
+    email.
+    """
+    __slots__ = ('seq', 'op', 'email', 'certificate', 'changed_at')
+
+    INSERT = 'insert'
+    DELETE = 'delete'
+
+    def __init__(self, seq, op, email, certificate=None, changed_at=None):
+        self.seq = seq
+        self.op = op
+        self.email = email
+        self.certificate = certificate
+        self.changed_at = changed_at
+
+    def __repr__(self):
+        return '<Change %s %s %s>' % (self.seq, self.op, self.email)
+
+
 class Certificate(object):
+    __slots__ = ('email', 'password', 'questions', 'enrollment_id', 'date_obtained')
+
     def __init__(self, email, password=None, questions=None, enrollment_id=None, date_obtained=None):
         self.email = email
         self.password = password
@@ -30,7 +96,13 @@ class Certificate(object):
         return '%s:%s / %s / %s' % (self.email, self.password, self.enrollment_id, self.date_obtained)
 
     def __eq__(self, obj):
-        return self.__dict__ == obj.__dict__
+        return isinstance(obj, Certificate) and self.as_dict() == obj.as_dict()
+
+    def __ne__(self, obj):
+        return not self == obj
+
+    def as_dict(self):
+        return dict((name, getattr(self, name)) for name in self.__slots__)
 
     def is_bound(self):
         all_fields_not_empty = all((self.email, self.password, self.questions, self.enrollment_id))
@@ -39,32 +111,372 @@ class Certificate(object):
 
 
 class CertificateFileStorage(object):
-    def __init__(self, store_path):
+    """
+    Keeps a ``credentials.yaml`` (or ``credentials.json``, depending on the
+    codec) per certificate in a directory named after its email. With
+    ``shard_levels`` set, directories are spread over nested hash-prefix
+    subdirectories (``ab/cd/email``) instead of living directly under
+    ``store_path``.
+
+    Until a flat store has been moved over with ``migrate_layout``, lookups
+    fall back to the flat location, so the store stays usable during the
+    migration.
+    """
+
+    MIGRATED_MARKER = '.sharded'
+
+    def __init__(self, store_path, shard_levels=0, shard_width=2, codec='yaml'):
         self.store_path = store_path
+        self.shard_levels = shard_levels
+        self.shard_width = shard_width
+        self.codec = get_codec(codec)
+        self.legacy_fallback = shard_levels > 0 and \
+            not os.path.exists(os.path.join(store_path, self.MIGRATED_MARKER))
+
+    def sharded_path(self, email):
+        if not self.shard_levels:
+            return os.path.join(self.store_path, email)
+        key = email.encode('utf-8') if isinstance(email, unicode) else email
+        digest = hashlib.md5(key).hexdigest()
+        w = self.shard_width
+        shards = [digest[i * w:(i + 1) * w] for i in range(self.shard_levels)]
+        return os.path.join(self.store_path, *(shards + [email]))
+
+    def path_for(self, email):
+        path = self.sharded_path(email)
+        if self.legacy_fallback and not os.path.exists(path):
+            flat_path = os.path.join(self.store_path, email)
+            if os.path.exists(flat_path):
+                return flat_path
+        return path
+
+    @timed('file.save', rows=1)
+    def save(self, certificate, sync=False):
+        """
+        Writes the entry into a temporary directory renamed into place, so
+        readers and crashes never see a half written entry. Raises OSError
+        with EEXIST when the entry exists, in either layout until the store
+        is migrated. With ``sync`` the entry is on disk on return, see
+        ``sync`` for doing that in batches.
+        """
+        new_path = self.sharded_path(certificate.email)
+        if self.legacy_fallback:
+            flat_path = os.path.join(self.store_path, certificate.email)
+            if os.path.exists(flat_path):
+                raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), flat_path)
+        parent = os.path.dirname(new_path)
+        if self.shard_levels and not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+        if os.path.exists(new_path):
+            raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), new_path)
+
+        # Temporary names have no @, so listings skip them
+        temp_path = os.path.join(parent, '.tmp-' + os.urandom(8).encode('hex'))
+        os.mkdir(temp_path)
+        try:
+            with open(os.path.join(temp_path, 'credentials.' + self.codec.extension), 'w') as f:
+                store_obj = {
+                    'certificate': certificate.as_dict()
+                }
+                f.write(self.codec.dumps(store_obj))
+                if sync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            try:
+                os.rename(temp_path, new_path)
+            except OSError as e:
+                if e.errno == errno.ENOTEMPTY:
+                    raise OSError(errno.EEXIST, os.strerror(errno.EEXIST), new_path)
+                raise
+        except:
+            shutil.rmtree(temp_path, ignore_errors=True)
+            raise
+        if sync:
+            self._sync_paths([new_path, parent])
+
+    def _sync_paths(self, paths):
+        for path in paths:
+            fd = os.open(path, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+    @timed('file.sync')
+    def sync(self, emails):
+        """
+        Flushes the entries of ``emails`` to disk, along with the directories
+        linking them. Syncing a batch of entries written without ``sync``
+        costs far less than syncing every write.
+        """
+        paths = []
+        directories = set()
+        for email in emails:
+            path = self.path_for(email)
+            paths.append(os.path.join(path, 'credentials.' + self.codec.extension))
+            directories.add(path)
+            directories.add(os.path.dirname(path))
+        self._sync_paths(paths + sorted(directories))
+
+    def _save_new(self, certificate):
+        try:
+            self.save(certificate)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+            return 0
+        return 1
 
-    def save(self, certificate):
-        new_path = os.path.join(self.store_path, certificate.email)
-        os.mkdir(new_path)
-        with open(new_path + '/credentials.yaml', 'w') as f:
-            store_obj = {
-                'certificate': certificate.__dict__
-            }
-            f.write(yaml.dump(store_obj, default_flow_style=False))
+    @timed('file.save_many', rows=lambda count: count)
+    def save_many(self, certificates, workers=8):
+        """
+        Writes entries for ``certificates`` on a pool of threads, returns
+        how many were written. Entries that already exist are left alone.
+        Nothing is synced, see ``sync``.
+        """
+        from multiprocessing.pool import ThreadPool
 
+        pool = ThreadPool(workers)
+        try:
+            return sum(pool.imap_unordered(self._save_new, certificates, 16))
+        finally:
+            pool.terminate()
+
+    @timed('file.delete', rows=1)
     def delete(self, email):
-        path = os.path.join(self.store_path, email)
+        path = self.path_for(email)
         shutil.rmtree(path)
 
+    def _remove(self, email):
+        try:
+            shutil.rmtree(self.path_for(email))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return None
+        return email
+
+    @timed('file.delete_many')
+    def delete_many(self, emails, workers=8):
+        """
+        Removes the entries of ``emails`` on a pool of threads, yielding each
+        email once its entry is gone. Emails without an entry are skipped.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(workers)
+        try:
+            for email in pool.imap_unordered(self._remove, emails, 16):
+                if email is not None:
+                    yield email
+        finally:
+            pool.terminate()
+
+    @timed('file.check_exist', rows=hit)
     def check_exist(self, certificate):
-        new_path = os.path.join(self.store_path, certificate.email)
+        new_path = self.path_for(certificate.email)
         return os.path.exists(new_path)
 
+    def _load_path(self, path):
+        # Entries written with another codec stay readable
+        for codec in [self.codec] + [c for c in CODECS.values() if c is not self.codec]:
+            file_path = os.path.join(path, 'credentials.' + codec.extension)
+            try:
+                with open(file_path, 'r') as f:
+                    store_obj = codec.loads(f.read())
+            except IOError:
+                continue
+            return Certificate(**store_obj['certificate'])
+        return None
+
+    @timed('file.load', rows=found)
+    def load(self, email):
+        return self._load_path(self.path_for(email))
+
+    def iter_paths(self):
+        """
+        Yields the directories of all stored certificates, flat and sharded.
+        """
+        pending = [(self.store_path, 0)]
+        while pending:
+            path, depth = pending.pop()
+            for name in os.listdir(path):
+                entry = os.path.join(path, name)
+                if '@' in name:
+                    yield entry
+                elif depth < self.shard_levels and os.path.isdir(entry):
+                    pending.append((entry, depth + 1))
+
+    def _list_emails(self, path, depth, since=None):
+        """
+        Emails stored below a shard directory. With ``since`` set, only
+        entries modified after that timestamp are listed, and leaf shards
+        that haven't changed since are not listed at all.
+        """
+        emails = []
+        pending = [(path, depth)]
+        while pending:
+            path, depth = pending.pop()
+            if since is not None and depth == self.shard_levels and os.path.getmtime(path) <= since:
+                continue
+            for name in os.listdir(path):
+                entry = os.path.join(path, name)
+                if '@' in name:
+                    if since is None or os.path.getmtime(entry) > since:
+                        emails.append(name)
+                elif depth < self.shard_levels and os.path.isdir(entry):
+                    pending.append((entry, depth + 1))
+        return emails
+
+    @timed('file.iter_emails')
+    def iter_emails(self, workers=8, since=None):
+        """
+        Yields stored emails in no particular order, listing the top-level
+        shards in parallel.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        shards = []
+        for name in os.listdir(self.store_path):
+            entry = os.path.join(self.store_path, name)
+            if '@' in name:
+                if since is None or os.path.getmtime(entry) > since:
+                    yield name
+            elif self.shard_levels and os.path.isdir(entry):
+                shards.append(entry)
+
+        if not shards:
+            return
+        pool = ThreadPool(workers)
+        try:
+            for emails in pool.imap_unordered(lambda shard: self._list_emails(shard, 1, since), shards):
+                for email in emails:
+                    yield email
+        finally:
+            pool.terminate()
+
+    @timed('file.iter_all')
+    def iter_all(self, workers=8, chunksize=64):
+        """
+        Loads every stored certificate, reading files on a pool of threads.
+        Certificates come out in no particular order.
+        """
+        from multiprocessing.pool import ThreadPool
+
+        pool = ThreadPool(workers)
+        try:
+            for certificate in pool.imap_unordered(self._load_path, self.iter_paths(), chunksize):
+                if certificate is not None:
+                    yield certificate
+        finally:
+            pool.terminate()
+
+    def migrate_layout(self):
+        """
+        Moves certificate directories from the flat layout into shards,
+        yielding each moved email. Every move is a single rename, so the
+        migration can run next to a live store and be interrupted and
+        restarted at any point; the store is marked as migrated only once
+        a full pass completes. An entry already in its shard is the one
+        lookups return, the flat copy next to it is removed.
+        """
+        if not self.shard_levels:
+            raise ValueError('Store sharding is not configured')
+
+        for name in os.listdir(self.store_path):
+            source = os.path.join(self.store_path, name)
+            # Shard directories are hex prefixes, certificates are emails
+            if '@' not in name or not os.path.isdir(source):
+                continue
+            target = self.sharded_path(name)
+            parent = os.path.dirname(target)
+            if not os.path.isdir(parent):
+                os.makedirs(parent)
+            try:
+                os.rename(source, target)
+            except OSError as e:
+                if e.errno not in (errno.ENOTEMPTY, errno.EEXIST):
+                    raise
+                shutil.rmtree(source)
+                continue
+            yield name
+
+        open(os.path.join(self.store_path, self.MIGRATED_MARKER), 'w').close()
+        self.legacy_fallback = False
+
 
 class CertificateDBStorage(object):
-    def __init__(self, db):
-        self.conn = sqlite3.connect(db)
+    # Applied to every new connection. WAL lets readers run alongside a
+    # writer, and NORMAL sync is durable enough under WAL.
+    PRAGMAS = (
+        ('journal_mode', 'WAL'),
+        ('synchronous', 'NORMAL'),
+        ('cache_size', -16000),
+        ('mmap_size', 268435456),
+    )
+
+    # Rows fetched from the cursor at a time by streaming queries.
+    FETCH_SIZE = 500
+
+    # Matches ranked by a full-text search.
+    SEARCH_WINDOW = 1000
+
+    # Seconds a statement waits for a lock held by another process, and how
+    # often taking the write lock is retried after that, backing off
+    # exponentially from BUSY_BACKOFF seconds.
+    BUSY_TIMEOUT = 30.0
+    BUSY_RETRIES = 5
+    BUSY_BACKOFF = 0.05
+
+    INSERT = "INSERT INTO certificates VALUES (NULL, date(?), ?, ?, ?, ?);"
+    ARCHIVE_INSERT = "INSERT INTO archive.certificates VALUES (NULL, date(?), ?, ?, ?, ?);"
+    INSERT_WITH_ID = "INSERT INTO %scertificates VALUES (?, date(?), ?, ?, ?, ?);"
+    LOG_INSERT = "INSERT INTO certificate_changes (op, email) VALUES ('insert', ?);"
+    LOG_DELETE = "INSERT INTO certificate_changes (op, email) VALUES ('delete', ?);"
+
+    def __init__(self, db, cached_statements=200, cache_size=0, trace=None, timeout=BUSY_TIMEOUT, archive=None,
+                 membership_error_rate=None):
+        # Write transactions take the write lock when they begin, so they
+        # never fail half way on a lock upgrade held up by another writer
+        options = dict(cached_statements=cached_statements, timeout=timeout, isolation_level='IMMEDIATE')
+        if trace is None:
+            self.conn = sqlite3.connect(db, **options)
+        else:
+            self.conn = sqlite3.connect(db, factory=TracingConnection, **options)
+            self.conn.trace_out = trace
+        self.cache = CertificateCache(cache_size) if cache_size else None
+        # The email filter is built on the first duplicate check, so commands
+        # making none don't pay for the scan
+        self.membership_error_rate = membership_error_rate
+        self.membership = None
+        self._membership_seq = 0
+        self._seen_version = None
+        self._apply_pragmas()
         self._apply_schema()
 
+        # The archive DB is only created by the first archiving, and
+        # attached once it exists. ATTACH commits the open transaction, so
+        # an archive created by another process is looked for when this
+        # connection isn't writing. Its pages are only read by queries
+        # reaching past the hot tier.
+        self.archive = archive
+        self.archive_attached = False
+        self.archived_until = None
+        self._writing = False
+        self._find_archive()
+
+    def _apply_pragmas(self):
+        c = self.conn.cursor()
+        for name, value in self.PRAGMAS:
+            c.execute('PRAGMA %s=%s;' % (name, value))
+
+    def close(self):
+        self.conn.close()
+
     @classmethod
     def format_questions(cls, questions):
         result = ''.join(['question%s: "%s"\n' % (i, questions[i-1]) for i in range(1, len(questions) + 1)])
@@ -74,146 +486,1345 @@ class CertificateDBStorage(object):
     def parse_questions(cls, questions_str):
         return [m.group(1) for m in re.finditer(r'"([^"]+)"', questions_str)]
 
+    @classmethod
+    def encode_questions(cls, questions):
+        return json.dumps(questions)
+
+    @classmethod
+    def decode_questions(cls, questions_json):
+        return json.loads(questions_json)
+
     def _apply_schema(self):
+        migrate(self.conn)
+        self.search_kind = search_index_kind(self.conn)
+
+    def attach_archive(self):
+        """
+        Attaches the archive DB, creating it if needed. ATTACH commits the
+        open transaction, so this has to run before one is begun.
+        """
+        if not self.archive or self.archive_attached:
+            return
+        # The archive is a certificates DB of its own, without the search
+        # index and the change log of the hot DB
+        conn = sqlite3.connect(self.archive)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL;')
+            migrate(conn, ARCHIVE_MIGRATIONS)
+        finally:
+            conn.close()
+        self.conn.execute('ATTACH DATABASE ? AS archive;', (self.archive,))
+        self.archive_attached = True
+        self._update_archived_until()
+
+        # Archived rows keep their IDs, new rows mustn't get them again
+        # even when the hot table was created after they were archived
+        c = self.conn.cursor()
+        archived = c.execute('SELECT MAX(id) FROM archive.certificates;').fetchone()[0]
+        hot = c.execute("SELECT seq FROM main.sqlite_sequence WHERE name = 'certificates';").fetchone()
+        if archived and (hot is None or hot[0] < archived):
+            c.execute("DELETE FROM main.sqlite_sequence WHERE name = 'certificates';")
+            c.execute("INSERT INTO main.sqlite_sequence VALUES ('certificates', ?);", (archived,))
+            self.commit()
+
+    def _find_archive(self):
+        if self.archive and not self.archive_attached and os.path.exists(self.archive):
+            self.attach_archive()
+
+    def _update_archived_until(self):
+        day = self.conn.execute('SELECT MAX(day) FROM archive.certificate_counts;').fetchone()[0]
+        self.archived_until = parse_date(day) if day else None
+
+    def _schemas(self, start=None):
+        """
+        Prefixes of the certificate tables a query has to read. The archive
+        is skipped while it is empty, and for date ranges starting after the
+        last archived day.
+        """
+        if self.archived_until is None or (start is not None and start > self.archived_until):
+            return ('',)
+        return ('', 'archive.')
+
+    @timed('db.save_many', rows=lambda count: count)
+    def save_many(self, certificates, commit=True, archived=False, ids=None):
+        """
+        Inserts certificates with a single executemany call. With
+        ``commit=False`` the rows stay in the currently open transaction, so
+        several batches can be committed (or rolled back) together. With
+        ``archived`` the rows go into the attached archive DB, as restoring
+        a snapshot does; the change log gets them like any insert. Restores
+        pass the rows' ``ids`` too, which new rows of the hot DB then never
+        reuse, so archiving doesn't run into them.
+        """
+        rows = [self._certificate_to_db(certificate) for certificate in self._invalidating(certificates)]
+        c = self.conn.cursor()
+        schema = 'archive.' if archived and self.archive_attached else ''
+        if ids is not None:
+            c.executemany(self.INSERT_WITH_ID % schema, [(row_id,) + row for row_id, row in zip(ids, rows)])
+        elif schema:
+            c.executemany(self.ARCHIVE_INSERT, rows)
+        else:
+            c.executemany(self.INSERT, rows)
+        count = c.rowcount
+        if ids:
+            c.execute("INSERT INTO main.sqlite_sequence (name, seq) SELECT 'certificates', 0 "
+                      "WHERE NOT EXISTS (SELECT 1 FROM main.sqlite_sequence WHERE name = 'certificates');")
+            c.execute("UPDATE main.sqlite_sequence SET seq = MAX(seq, ?) WHERE name = 'certificates';", (max(ids),))
+        c.executemany(self.LOG_INSERT, ((row[1],) for row in rows))
+        self._remember(row[1] for row in rows)
+        if archived and self.archive_attached:
+            self._update_archived_until()
+        if commit:
+            self.commit()
+        return count
+
+    @timed('db.iter_emails')
+    def iter_emails(self, since=None):
+        """
+        Streams stored emails in byte order, optionally only those added on
+        or after the ``since`` date.
+        """
+        self._catch_up()
         c = self.conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS certificates
-            (id integer primary key, when_added date, email text, password text, enrollment_id text, questions text);''')
+        if since is None:
+            selects = ["SELECT email FROM %scertificates" % schema for schema in self._schemas()]
+            c.execute(' UNION ALL '.join(selects) + ' ORDER BY email;')
+        else:
+            selects = ["SELECT email FROM %scertificates WHERE when_added >= ?" % schema
+                       for schema in self._schemas(since)]
+            c.execute(' UNION ALL '.join(selects) + ' ORDER BY email;', (since.strftime('%Y-%m-%d'),) * len(selects))
+        while True:
+            records = c.fetchmany(self.FETCH_SIZE)
+            if not records:
+                break
+            for record in records:
+                yield record[0]
+
+    @timed('db.iter_rows')
+    def iter_rows(self):
+        """
+        Streams every certificate of both tiers as stored, ``(when_added,
+        email, password, enrollment_id, questions, archived, id)`` with the
+        answers still JSON encoded. A single statement reads both tiers, so
+        the rows are a consistent snapshot while writers carry on.
+        """
+        self._catch_up()
+        c = self.conn.cursor()
+        selects = ["SELECT when_added, email, password, enrollment_id, questions, %s, id FROM %scertificates"
+                   % (int(bool(schema)), schema) for schema in self._schemas()]
+        c.execute(' UNION ALL '.join(selects) + ';')
+        while True:
+            records = c.fetchmany(self.FETCH_SIZE)
+            if not records:
+                break
+            for record in records:
+                yield record
+
+    def is_empty(self):
+        self._catch_up()
+        return not any(self.conn.execute("SELECT 1 FROM %scertificates LIMIT 1;" % schema).fetchone()
+                       for schema in self._schemas())
+
+    @timed('db.existing_emails', rows=len)
+    def existing_emails(self, emails):
+        self._catch_up()
+        membership = self._current_membership()
+        emails = [email for email in map(decode_text, emails) if membership is None or email in membership]
+        if not emails:
+            return set()
+        c = self.conn.cursor()
+        existing = set()
+        for schema in self._schemas():
+            c.execute("SELECT email FROM %scertificates WHERE email IN (%s);" % (schema, ', '.join('?' * len(emails))),
+                      emails)
+            existing.update(row[0] for row in c.fetchall())
+        return existing
+
+    def begin(self):
+        """
+        Opens a write transaction holding the write lock, waiting for other
+        writers to finish.
+        """
+        self._find_archive()
+        for attempt in range(self.BUSY_RETRIES):
+            try:
+                self.conn.execute('BEGIN IMMEDIATE;')
+                self._writing = True
+                return
+            except sqlite3.OperationalError as e:
+                if 'locked' not in str(e) or attempt == self.BUSY_RETRIES - 1:
+                    raise
+            time.sleep(self.BUSY_BACKOFF * 2 ** attempt * (1 + random.random()))
+
+    def commit(self):
         self.conn.commit()
+        self._writing = False
+
+    def rollback(self):
+        self.conn.rollback()
+        self._writing = False
+        # Lookups made inside the transaction may have cached rolled back rows
+        if self.cache is not None:
+            self.cache.clear()
 
-    def save(self, certificate):
+    def _invalidating(self, certificates):
+        for certificate in certificates:
+            if self.cache is not None:
+                self.cache.invalidate(certificate.email)
+            yield certificate
+
+    def open_intent(self, email, commit=True):
+        """
+        Journals an add of ``email`` before it is written anywhere, returns
+        the journal entry to close once the add is complete. With
+        ``commit=False`` the entry stays in the currently open transaction.
+        """
+        if commit:
+            self.begin()
+        c = self.conn.cursor()
+        c.execute("INSERT INTO certificate_intents VALUES (NULL, ?, ?, ?);",
+                  (email, os.getpid(), datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+        if commit:
+            self.commit()
+        return c.lastrowid
+
+    def close_intent(self, intent_id, commit=True):
+        self.conn.execute("DELETE FROM certificate_intents WHERE id=?;", (intent_id,))
+        if commit:
+            self.commit()
+
+    def pending_intents(self):
         c = self.conn.cursor()
+        c.execute("SELECT id, email, pid FROM certificate_intents ORDER BY id;")
+        return c.fetchall()
+
+    def cache_info(self):
+        return self.cache.info() if self.cache is not None else None
+
+    def membership_info(self):
+        return self.membership.info() if self.membership is not None else None
+
+    def _data_version(self):
+        # Changes when another connection commits, read from shared memory.
+        # Python 2's sqlite3 commits the open transaction before a PRAGMA
+        # statement, the function form is a SELECT and leaves it alone.
+        return self.conn.execute('SELECT data_version FROM pragma_data_version();').fetchone()[0]
+
+    def _catch_up(self):
+        """
+        Brings what is kept in memory up to date with the commits of other
+        connections: cached lookups are dropped, the last archived day and
+        the email filter are refreshed. Reads call this once before anything
+        else, cache hits included; it costs a read of shared memory when
+        nothing changed.
+        """
+        version = self._data_version()
+        if version == self._seen_version:
+            return
+        self._seen_version = version
+        # Other connections don't say which rows they changed
+        if self.cache is not None:
+            self.cache.clear()
+        if not self._writing:
+            self._find_archive()
+        if self.archive_attached:
+            self._update_archived_until()
+        if self.membership is not None:
+            self._sync_membership()
+
+    @timed('db.load_membership')
+    def _load_membership(self):
+        """
+        Builds the email filter with one scan of the email index, sized for
+        twice the current rows. Writes committed by other connections after
+        the scan starts are picked up from the change log.
+        """
+        self._membership_seq = self.last_change()
+        c = self.conn.cursor()
+        capacity = 0
+        for schema in self._schemas():
+            c.execute('SELECT COALESCE(MAX(id), 0) FROM %scertificates;' % schema)
+            capacity += c.fetchone()[0]
+        self.membership = EmailFilter(capacity * 2, self.membership_error_rate)
+        for schema in self._schemas():
+            c.execute("SELECT email FROM %scertificates;" % schema)
+            while True:
+                records = c.fetchmany(self.FETCH_SIZE)
+                if not records:
+                    break
+                self.membership.update(record[0] for record in records)
+
+    def _sync_membership(self):
+        c = self.conn.cursor()
+        c.execute('SELECT seq, op, email FROM certificate_changes WHERE seq > ? ORDER BY seq;',
+                  (self._membership_seq,))
+        for seq, op, email in c.fetchall():
+            if op == Change.INSERT:
+                self.membership.add(email)
+            self._membership_seq = seq
+
+    def _current_membership(self, build=True):
+        """
+        The email filter, up to date with writes of other connections, or
+        None when disabled. Loading it reads every email, so single lookups
+        pass ``build=False`` and only use a filter batch calls loaded.
+        """
+        if self.membership_error_rate is None:
+            return None
+        if self.membership is None or self.membership.full():
+            if not build:
+                return None
+            self._load_membership()
+        return self.membership
+
+    def might_exist(self, email):
+        """
+        False when ``email`` is definitely not stored, True when it may be.
+        Only the filter is consulted, unless other processes wrote since the
+        last call.
+        """
+        self._catch_up()
+        membership = self._current_membership()
+        return membership is None or email in membership
+
+    def _remember(self, emails):
+        if self.membership is not None:
+            self.membership.update(emails)
+
+    def _certificate_to_db(self, certificate):
         if certificate.date_obtained:
             date_string = certificate.date_obtained.strftime('%Y-%m-%d')
         else:
             date_string = datetime.now().date().strftime('%Y-%m-%d')
-        params = {
-            'email': certificate.email,
-            'password': certificate.password,
-            'enrollment_id': certificate.enrollment_id,
-            'questions': self.format_questions(certificate.questions),
-            'date_string': date_string
-        }
-        c.execute("INSERT INTO certificates VALUES (NULL, date('%(date_string)s'), '%(email)s', '%(password)s', '%(enrollment_id)s', '%(questions)s');" % params)
-        self.conn.commit()
+        return (date_string, decode_text(certificate.email), decode_text(certificate.password),
+                decode_text(certificate.enrollment_id), self.encode_questions(certificate.questions))
+
+    @timed('db.save', rows=1)
+    def save(self, certificate, commit=True):
+        """
+        Inserts a certificate, raising ``CertificateExists`` when its email
+        is taken. With ``commit=False`` the row stays in the currently open
+        transaction.
+        """
+        if commit:
+            self.begin()
+        c = self.conn.cursor()
+        if self.cache is not None:
+            self.cache.invalidate(certificate.email)
+        self._catch_up()
+        row = self._certificate_to_db(certificate)
+        try:
+            # The unique index only covers the hot tier. A loaded filter
+            # saves probing the archive for new emails.
+            if self.archived_until is not None and \
+                    (self.membership is None or row[1] in self.membership) and \
+                    c.execute("SELECT 1 FROM archive.certificates WHERE email=?;", (row[1],)).fetchone():
+                raise sqlite3.IntegrityError(certificate.email)
+            c.execute(self.INSERT, row)
+        except sqlite3.IntegrityError:
+            if commit:
+                self.rollback()
+            raise CertificateExists(certificate.email)
+        c.execute(self.LOG_INSERT, (row[1],))
+        self._remember((row[1],))
+        if commit:
+            self.commit()
 
     def _certificate_from_db(self, fetched):
         email, password, enrollment_id, questions_str, when_added = fetched
-        questions = self.parse_questions(questions_str)
-        when_added = datetime.strptime(when_added, '%Y-%m-%d').date()
+        questions = self.decode_questions(questions_str)
+        when_added = parse_date(when_added)
         return Certificate(email, password, questions, enrollment_id, when_added)
 
+    def _fetch_one(self, where, params):
+        c = self.conn.cursor()
+        for schema in self._schemas():
+            c.execute("SELECT email, password, enrollment_id, questions, when_added FROM %scertificates WHERE %s;"
+                      % (schema, where), params)
+            db_row = c.fetchone()
+            if db_row:
+                return db_row
+        return None
+
+    @timed('db.get_by_email', rows=found)
     def get_by_email(self, email):
         if not email:
             return None
+        self._catch_up()
 
-        c = self.conn.cursor()
-        c.execute("SELECT email, password, enrollment_id, questions, when_added FROM certificates WHERE email='%s';" % email)
-        db_row = c.fetchone()
+        if self.cache is not None:
+            certificate = self.cache.get(('email', email))
+            if certificate is not None:
+                return certificate
+
+        db_row = self._fetch_one("email=?", (email,))
         if not db_row:
             return None
         certificate = self._certificate_from_db(db_row)
+        if self.cache is not None:
+            self.cache.put(('email', email), certificate)
         return certificate
 
+    def _match_expression(self, text):
+        terms = text.split()
+        if not terms:
+            raise ValueError('Nothing to search for')
+        # Every term is quoted, so FTS query syntax in the input is literal.
+        # FTS4 has no escape for quotes inside a phrase.
+        if self.search_kind == 'fts4':
+            return ' '.join('"%s*"' % term.replace('"', ' ') for term in terms)
+        return ' '.join('"%s"*' % term.replace('"', '""') for term in terms)
+
+    @timed('db.search', rows=len)
+    def search(self, text, limit=20, offset=0):
+        """
+        Certificates whose email, enrollment ID or answers have words
+        starting with all the whitespace separated terms of ``text``, best
+        matches first. Only the ``SEARCH_WINDOW`` most recent matches are
+        ranked, so terms matching most of the table stay fast.
+        """
+        if self.search_kind is None:
+            raise ValueError('This SQLite build has no full-text search')
+        rank = 'rank' if self.search_kind == 'fts5' else '0'
+        c = self.conn.cursor()
+        c.execute('''SELECT c.email, c.password, c.enrollment_id, c.questions, c.when_added
+            FROM (SELECT rowid, %s AS rank FROM certificates_search WHERE certificates_search MATCH ?
+                  ORDER BY rowid DESC LIMIT ?) AS matches
+            JOIN certificates c ON c.id = matches.rowid
+            ORDER BY matches.rank, matches.rowid DESC LIMIT ? OFFSET ?;''' % rank,
+                  (self._match_expression(text), max(self.SEARCH_WINDOW, offset + limit), limit, offset))
+        return [self._certificate_from_db(row) for row in c.fetchall()]
+
+    @timed('db.get_by_id', rows=found)
     def get_by_id(self, cert_id):
         if not cert_id:
             return None
+        self._catch_up()
 
-        c = self.conn.cursor()
-        c.execute("SELECT email, password, enrollment_id, questions, when_added FROM certificates WHERE id='%s';" % cert_id)
-        db_row = c.fetchone()
+        if self.cache is not None:
+            certificate = self.cache.get(('id', str(cert_id)))
+            if certificate is not None:
+                return certificate
+
+        db_row = self._fetch_one("id=?", (cert_id,))
         if not db_row:
             return None
         certificate = self._certificate_from_db(db_row)
+        if self.cache is not None:
+            self.cache.put(('id', str(cert_id)), certificate)
         return certificate
 
+    @timed('db.get_by_date')
     def get_by_date(self, start, end):
         start_str = start.strftime('%Y-%m-%d')
         end_str = end.strftime('%Y-%m-%d')
+        self._catch_up()
+
+        c = self.conn.cursor()
+
+        selects = ["SELECT email, password, enrollment_id, questions, when_added FROM %scertificates "
+                   "WHERE when_added >= ? AND when_added <= ?" % schema for schema in self._schemas(start)]
+        c.execute(' UNION ALL '.join(selects) + ' ORDER BY when_added ASC;', (start_str, end_str) * len(selects))
+        while True:
+            records = c.fetchmany(self.FETCH_SIZE)
+            if not records:
+                break
+            for record in records:
+                yield self._certificate_from_db(record)
+
+    @timed('db.count_by_date')
+    def count_by_date(self, start, end):
+        self._catch_up()
+        c = self.conn.cursor()
+        total = 0
+        for schema in self._schemas(start):
+            c.execute("SELECT COALESCE(SUM(total), 0) FROM %scertificate_counts WHERE day >= ? AND day <= ?;" % schema,
+                      (start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+            total += c.fetchone()[0]
+        return total
+
+    # strftime() formats grouping daily counts into periods
+    PERIODS = {
+        'day': '%Y-%m-%d',
+        'week': '%Y-W%W',
+        'month': '%Y-%m',
+        'year': '%Y',
+    }
 
+    @timed('db.count_by_period', rows=len)
+    def count_by_period(self, period, start, end):
+        """
+        Returns ``[(period, total)]`` for every period with certificates in
+        the range, answered from the daily counts alone.
+        """
+        if period not in self.PERIODS:
+            raise ValueError("Unknown period '%s'" % period)
+        self._catch_up()
+        counts = ' UNION ALL '.join("SELECT day, total FROM %scertificate_counts" % schema
+                                    for schema in self._schemas(start))
         c = self.conn.cursor()
+        c.execute("SELECT strftime(?, day) AS period, SUM(total) FROM (%s) "
+                  "WHERE day >= ? AND day <= ? GROUP BY period ORDER BY period;" % counts,
+                  (self.PERIODS[period], start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')))
+        return c.fetchall()
 
-        c.execute("SELECT email, password, enrollment_id, questions, when_added FROM certificates WHERE when_added >= '%s' AND when_added <= '%s' ORDER BY when_added ASC;" % (start_str, end_str))
-        records = c.fetchall()
-        for record in records:
-            yield self._certificate_from_db(record)
+    def rebuild_counts(self):
+        rebuild_counts(self.conn.cursor())
+        self.commit()
 
+    @timed('db.delete', rows=found)
     def delete(self, id_num):
         try:
             certificate = self.get_by_id(id_num) or self.get_by_email(id_num)
             c = self.conn.cursor()
-            c.execute("DELETE FROM certificates WHERE email='%s';" % certificate.email)
-            self.conn.commit()
+            for schema in self._schemas():
+                c.execute("DELETE FROM %scertificates WHERE email=?;" % schema, (certificate.email,))
+            c.execute(self.LOG_DELETE, (certificate.email,))
+            self.commit()
+            if self.cache is not None:
+                self.cache.invalidate(certificate.email)
             return certificate
         except Exception as e:
             return None
 
+    @timed('db.delete_many', rows=len)
+    def delete_many(self, emails=None, start=None, end=None, dry_run=False):
+        """
+        Deletes the certificates with the given emails and added between
+        ``start`` and ``end`` (each filter is optional, but one is required)
+        with set-based statements in a single transaction. Returns the
+        deleted emails, with ``dry_run`` the ones that would be deleted.
+        """
+        if emails is None and start is None and end is None:
+            raise ValueError('Give emails or a date range to delete')
+
+        c = self.conn.cursor()
+        conditions = []
+        params = []
+        if emails is not None:
+            c.execute('CREATE TEMP TABLE IF NOT EXISTS delete_emails (email text primary key);')
+            conditions.append('email IN (SELECT email FROM delete_emails)')
+        if start is not None:
+            conditions.append('when_added >= ?')
+            params.append(start.strftime('%Y-%m-%d'))
+        if end is not None:
+            conditions.append('when_added <= ?')
+            params.append(end.strftime('%Y-%m-%d'))
+
+        where = ' AND '.join(conditions)
+        self.begin()
+        try:
+            if emails is not None:
+                c.execute('DELETE FROM delete_emails;')
+                c.executemany('INSERT OR IGNORE INTO delete_emails VALUES (?);', ((email,) for email in emails))
+            self._catch_up()
+            schemas = self._schemas(start)
+            c.execute(' UNION ALL '.join('SELECT email FROM %scertificates WHERE %s' % (schema, where)
+                                         for schema in schemas) + ';', params * len(schemas))
+            deleted = []
+            while True:
+                records = c.fetchmany(self.FETCH_SIZE)
+                if not records:
+                    break
+                deleted.extend(record[0] for record in records)
+            if not dry_run:
+                for schema in schemas:
+                    c.execute('DELETE FROM %scertificates WHERE %s;' % (schema, where), params)
+                c.executemany(self.LOG_DELETE, ((email,) for email in deleted))
+        except:
+            self.rollback()
+            raise
+
+        if dry_run:
+            self.rollback()
+            return deleted
+        self.commit()
+        if self.cache is not None:
+            for email in deleted:
+                self.cache.invalidate(email)
+        return deleted
+
+    @timed('db.archive_before', rows=lambda count: count)
+    def archive_before(self, day):
+        """
+        Moves the certificates added before ``day`` into the archive DB,
+        creating it on first use, and returns how many were moved.
+        """
+        if not self.archive:
+            raise ValueError('No archive DB configured')
+        self.attach_archive()
+        cutoff = day.strftime('%Y-%m-%d')
+
+        # Under WAL a transaction over attached DBs isn't atomic as a whole,
+        # so rows are copied and deleted in separate transactions. A crash in
+        # between leaves rows in both tiers, which the next run clears up.
+        c = self.conn.cursor()
+        self.begin()
+        try:
+            c.execute("INSERT OR IGNORE INTO archive.certificates SELECT * FROM certificates WHERE when_added < ?;",
+                      (cutoff,))
+            self.commit()
+            self.begin()
+            c.execute('''DELETE FROM certificates WHERE when_added < ?
+                AND email IN (SELECT email FROM archive.certificates);''', (cutoff,))
+            moved = c.rowcount
+            self.commit()
+        except:
+            self.rollback()
+            raise
+        self._update_archived_until()
+        return moved
+
+    @timed('db.changes')
+    def changes(self, since=0, limit=None):
+        """
+        Streams the changes logged after sequence number ``since``, oldest
+        first. Writers hold the write lock until they commit, so changes
+        become visible in sequence order and none is skipped by a reader
+        resuming from the last number it saw. The log only keeps emails,
+        inserted certificates are read from the tier holding them now.
+        """
+        self._catch_up()
+        columns = ('email', 'password', 'enrollment_id', 'questions', 'when_added')
+        joins = "LEFT JOIN certificates h ON l.op = 'insert' AND h.email = l.email"
+        if len(self._schemas()) > 1:
+            joins += " LEFT JOIN archive.certificates a ON l.op = 'insert' AND h.id IS NULL AND a.email = l.email"
+            columns = ['COALESCE(h.%s, a.%s)' % (column, column) for column in columns]
+        else:
+            columns = ['h.%s' % column for column in columns]
+        c = self.conn.cursor()
+        c.execute('''SELECT l.seq, l.op, l.changed_at, l.email, %s FROM certificate_changes l %s
+            WHERE l.seq > ? ORDER BY l.seq LIMIT ?;''' % (', '.join(columns), joins),
+                  (since, -1 if limit is None else limit))
+        while True:
+            records = c.fetchmany(self.FETCH_SIZE)
+            if not records:
+                break
+            for record in records:
+                seq, op, changed_at = record[:3]
+                if op == Change.INSERT and record[4] is not None:
+                    yield Change(seq, op, record[3], self._certificate_from_db(record[4:]), changed_at)
+                else:
+                    yield Change(seq, op, record[3], changed_at=changed_at)
+
+    def last_change(self):
+        return self.conn.execute('SELECT COALESCE(MAX(seq), 0) FROM certificate_changes;').fetchone()[0]
+
+    @timed('db.prune_changes', rows=lambda count: count)
+    def prune_changes(self, before):
+        """
+        Drops the changes logged before the ``before`` datetime and returns
+        how many were dropped. The last insert of every stored row is kept,
+        so a consumer reading the log from the beginning still sees the
+        whole table; one further behind than that misses the deletes
+        dropped.
+        """
+        c = self.conn.cursor()
+        self.begin()
+        try:
+            c.execute('''DELETE FROM certificate_changes WHERE changed_at < ? AND seq NOT IN
+                (SELECT seq FROM (SELECT MAX(seq) AS seq, op FROM certificate_changes GROUP BY email)
+                 WHERE op = 'insert');''', (before.strftime('%Y-%m-%d %H:%M:%S'),))
+            pruned = c.rowcount
+            self.commit()
+        except:
+            self.rollback()
+            raise
+        return pruned
+
+    def replication_position(self, source):
+        """
+        Sequence number of the last change applied from ``source``.
+        """
+        row = self.conn.execute('SELECT seq FROM replication_state WHERE source=?;', (source,)).fetchone()
+        return row[0] if row else 0
+
+    @timed('db.apply_changes', rows=lambda count: count)
+    def apply_changes(self, changes, source):
+        """
+        Replays changes read from the log of ``source`` in a single
+        transaction, along with the position reached, and returns how many
+        were applied. Applied changes are logged again, so a replica can be
+        the source of another one.
+        """
+        c = self.conn.cursor()
+        count = 0
+        self.begin()
+        try:
+            for change in changes:
+                if self.cache is not None:
+                    self.cache.invalidate(change.email)
+                c.execute("DELETE FROM certificates WHERE email=?;", (change.email,))
+                if change.certificate is not None:
+                    c.execute(self.INSERT, self._certificate_to_db(change.certificate))
+                    c.execute(self.LOG_INSERT, (change.email,))
+                    self._remember((change.email,))
+                elif c.rowcount:
+                    c.execute(self.LOG_DELETE, (change.email,))
+                position = change.seq
+                count += 1
+            if count:
+                c.execute('INSERT OR REPLACE INTO replication_state VALUES (?, ?);', (source, position))
+            self.commit()
+        except:
+            self.rollback()
+            raise
+        return count
+
+    def replicate_from(self, source_storage, source, batch_size=1000):
+        """
+        Applies the changes logged by ``source_storage`` since the last run,
+        ``batch_size`` per transaction, and returns how many were applied.
+        """
+        applied = 0
+        while True:
+            count = self.apply_changes(list(source_storage.changes(self.replication_position(source), batch_size)),
+                                       source)
+            if not count:
+                return applied
+            applied += count
+
+    def vacuum(self):
+        """
+        Rebuilds the hot DB file without the free pages left by deletes.
+        The search index is merged first, as deleted rows stay in it as
+        tombstones until then. Under WAL the file only shrinks once the log
+        is checkpointed.
+        """
+        if self.search_kind is not None:
+            self.begin()
+            try:
+                self.conn.execute("INSERT INTO certificates_search (certificates_search) VALUES ('optimize');")
+            except:
+                self.rollback()
+                raise
+            self.commit()
+        self.conn.execute('VACUUM main;')
+        self.conn.execute('PRAGMA main.wal_checkpoint(TRUNCATE);')
+
+    @timed('db.check_exist', rows=hit)
     def check_exist(self, certificate):
         try:
+            self._catch_up()
+            email = decode_text(certificate.email)
+            if self.cache is not None and self.cache.get(('email', email)) is not None:
+                return True
+            membership = self._current_membership(build=False)
+            if membership is not None and email not in membership:
+                return False
             c = self.conn.cursor()
-            c.execute("SELECT * FROM certificates WHERE email='%s'" % certificate.email)
-            certificate = c.fetchone()
-            return certificate is not None
+            for schema in self._schemas():
+                c.execute("SELECT 1 FROM %scertificates WHERE email=?;" % schema, (email,))
+                if c.fetchone() is not None:
+                    return True
+            return False
         except Exception as e:
             return None
 
 
 class Reporter(object):
+    """
+    Builds reports over a date range, the current week by default. Rows are
+    streamed from the DB cursor and the total is counted by the DB, so the
+    size of the range doesn't affect memory use.
+    """
+
+    HEADER = ['Date obtained', 'E-mail', 'Password', 'Enrollment ID', 'Answers to secret questions']
+    FORMATS = ('table', 'csv', 'ndjson')
+
     def __init__(self, db_storage):
         self.storage = db_storage
 
-    def generate_report(self):
-        week_start, week_end = get_current_week()
+    def generate_report(self, start=None, end=None):
+        if start is None or end is None:
+            start, end = get_current_week()
 
-        certificates = self.storage.get_by_date(week_start, week_end)
-        result = [[cert.date_obtained.strftime('%d.%m.%Y'), cert.email, cert.password, cert.enrollment_id, CertificateDBStorage.format_questions(cert.questions)] for cert in certificates]
-        total = len(result)
+        certificates = self.storage.get_by_date(start, end)
+        result = ([cert.date_obtained.strftime('%d.%m.%Y'), cert.email, cert.password, cert.enrollment_id, CertificateDBStorage.format_questions(cert.questions)] for cert in certificates)
+        total = self.storage.count_by_date(start, end)
         return result, total
 
+    def write_report(self, out, fmt='table', start=None, end=None):
+        from certman import formats
+
+        if start is None or end is None:
+            start, end = get_current_week()
+
+        if fmt == 'table':
+            rows, total = self.generate_report(start, end)
+            title = 'Certificates obtained %s-%s' % (start.strftime('%d.%m.%Y'), end.strftime('%d.%m.%Y'))
+            formats.write_table(rows, self.HEADER, title, out)
+        elif fmt == 'csv':
+            total = self.storage.count_by_date(start, end)
+            formats.write_csv(self.storage.get_by_date(start, end), out)
+        elif fmt == 'ndjson':
+            total = self.storage.count_by_date(start, end)
+            formats.write_ndjson(self.storage.get_by_date(start, end), out)
+        else:
+            raise ValueError("Unknown report format '%s'" % fmt)
+        return total
+
+
+class ImportResult(object):
+    def __init__(self):
+        self.imported = 0
+        self.rejects = []
+        self.elapsed = 0.0
+
+    @property
+    def rate(self):
+        if not self.elapsed:
+            return 0.0
+        return self.imported / self.elapsed
+
+    def reject(self, line_num, email, reason):
+        self.rejects.append((line_num, email, reason))
+
+
+class Importer(object):
+    """
+    Loads certificates from a stream of ``(line_number, record)`` pairs.
+    Valid rows are inserted in chunks within a single DB transaction and
+    written to the file storage in the same pass; invalid rows and
+    duplicates end up in the reject list of the result.
+    """
+
+    def __init__(self, db_storage, file_storage, chunk_size=500, default_password=None):
+        self.db_storage = db_storage
+        self.file_storage = file_storage
+        self.chunk_size = chunk_size
+        self.default_password = default_password
+
+    def certificate_from_record(self, record):
+        date_obtained = record.get('date_obtained') or record.get('when_added')
+        if isinstance(date_obtained, basestring):
+            date_obtained = datetime.strptime(date_obtained.strip(), '%Y-%m-%d').date()
+        elif isinstance(date_obtained, datetime):
+            date_obtained = date_obtained.date()
+        questions = record.get('questions')
+        if isinstance(questions, basestring):
+            questions = [questions]
+        certificate = Certificate(email=(record.get('email') or '').strip(),
+                                  password=record.get('password') or self.default_password,
+                                  questions=questions,
+                                  enrollment_id=record.get('enrollment_id'),
+                                  date_obtained=date_obtained)
+        # Stored as text, so a row in another encoding is rejected on its own
+        values = [certificate.email, certificate.password, certificate.enrollment_id]
+        for value in values + (questions if isinstance(questions, list) else []):
+            if isinstance(value, str):
+                try:
+                    value.decode('utf-8')
+                except UnicodeDecodeError:
+                    raise ValueError('%r is not UTF-8' % value)
+        return certificate
+
+    def run(self, records):
+        result = ImportResult()
+        seen = set()
+        written = []
+        failed = set()
+        chunk = []
+        started = time.time()
+
+        # Holding the write lock for the whole import keeps the duplicate
+        # checks valid until commit; other writers wait for the import
+        self.db_storage.begin()
+        try:
+            for line_num, record in records:
+                if isinstance(record, Exception):
+                    result.reject(line_num, None, str(record))
+                    continue
+                try:
+                    certificate = self.certificate_from_record(record)
+                except (ValueError, TypeError) as e:
+                    result.reject(line_num, record.get('email'), str(e))
+                    continue
+
+                if not certificate.is_bound():
+                    result.reject(line_num, certificate.email, 'invalid certificate')
+                elif certificate.email in seen:
+                    result.reject(line_num, certificate.email, 'duplicate in input')
+                else:
+                    seen.add(certificate.email)
+                    chunk.append((line_num, certificate))
+
+                if len(chunk) >= self.chunk_size:
+                    self._flush(chunk, result, written)
+                    chunk = []
+
+            self._flush(chunk, result, written)
+            if hasattr(self.file_storage, 'written'):
+                # Store writes run behind the parsing, but have to land
+                # before the rows commit
+                self.file_storage.flush()
+                failures = self.file_storage.failures()
+                failed.update(certificate.email for certificate, _, _ in failures)
+                if failures:
+                    certificate, _, error = failures[0]
+                    raise IOError("Couldn't write %s to the store: %s" % (certificate.email, error))
+            self.db_storage.commit()
+        except:
+            error = sys.exc_info()
+            self.db_storage.rollback()
+            if hasattr(self.file_storage, 'written'):
+                self.file_storage.flush()
+                failed.update(certificate.email for certificate, _, _ in self.file_storage.failures())
+            # Entries that never got written are skipped
+            for _ in self.file_storage.delete_many(email for email in written if email not in failed):
+                pass
+            raise error[0], error[1], error[2]
+
+        result.elapsed = time.time() - started
+        return result
+
+    def _flush(self, chunk, result, written):
+        existing = self.db_storage.existing_emails(certificate.email for _, certificate in chunk)
+        accepted = []
+        for line_num, certificate in chunk:
+            if certificate.email in existing or self.file_storage.check_exist(certificate):
+                result.reject(line_num, certificate.email, 'already exists')
+                continue
+            self.file_storage.save(certificate)
+            written.append(certificate.email)
+            accepted.append(certificate)
+
+        self.db_storage.save_many(accepted, commit=False)
+        result.imported += len(accepted)
+
 
 class Manager(object):
+    """
+    Runs CLI commands. Storages are opened on first use and shared by every
+    command for the lifetime of the manager, so the DB connection, its page
+    cache and its prepared statements are reused.
+    """
+
+    def __init__(self, db_storage=None, file_storage=None):
+        self._db_storage = db_storage
+        self._file_storage = file_storage
+        self._trace_file = None
+
+    @property
+    def db_storage(self):
+        if self._db_storage is None:
+            db = require('db')
+            self._db_storage = CertificateDBStorage(db=db,
+                                                    cache_size=SETTINGS['cache_size'] if SETTINGS['cache_enabled'] else 0,
+                                                    trace=self._sql_trace(),
+                                                    timeout=SETTINGS['busy_timeout'],
+                                                    archive=SETTINGS['archive_db'] or db + '.archive',
+                                                    membership_error_rate=SETTINGS['membership_error_rate']
+                                                    if SETTINGS['membership_filter'] else None)
+        return self._db_storage
+
+    def _sql_trace(self):
+        path = SETTINGS['sql_trace']
+        if not path:
+            return None
+        if path == '-':
+            return sys.stderr
+        self._trace_file = open(path, 'a')
+        return self._trace_file
+
+    @property
+    def file_storage(self):
+        if self._file_storage is None:
+            if SETTINGS['store_backend'] == 'pack':
+                from certman.packstore import CertificatePackStorage
+                self._file_storage = CertificatePackStorage(store_path=require('store_path'),
+                                                            codec=SETTINGS['store_codec'])
+            else:
+                self._file_storage = CertificateFileStorage(store_path=require('store_path'),
+                                                            shard_levels=SETTINGS['store_shard_levels'],
+                                                            codec=SETTINGS['store_codec'])
+                if SETTINGS['write_behind']:
+                    from certman.writebehind import WriteBehindStorage
+                    self._file_storage = WriteBehindStorage(self._file_storage,
+                                                            queue_size=SETTINGS['write_behind_queue'])
+        return self._file_storage
+
+    def _write_behind(self):
+        return self._file_storage is not None and hasattr(self._file_storage, 'written')
+
+    def _close_written(self):
+        """
+        Closes the journal entries of adds whose store entries got written
+        behind, in the open transaction. Returns the failed writes.
+        """
+        for intent in self._file_storage.written():
+            self.db_storage.close_intent(intent, commit=False)
+        return self._file_storage.failures()
+
+    def _report_failures(self, failures):
+        for certificate, intent, error in failures:
+            sys.stderr.write("certman: couldn't write %s to the store (%s), "
+                             "it is rewritten on the next start\n" % (certificate.email, error))
+
+    def flush_writes(self):
+        """
+        Waits for the store writes queued by adds and closes their journal
+        entries. Returns ``(certificate, intent, error)`` for the writes
+        that failed, which ``recover`` redoes once this process is gone.
+        """
+        if not self._write_behind():
+            return []
+        self._file_storage.flush()
+        self.db_storage.begin()
+        try:
+            failures = self._close_written()
+            self.db_storage.commit()
+        except:
+            self.db_storage.rollback()
+            raise
+        return failures
+
+    def close(self):
+        if self._write_behind():
+            self._report_failures(self.flush_writes())
+        if self._db_storage is not None:
+            self._db_storage.close()
+            self._db_storage = None
+        if self._file_storage is not None and hasattr(self._file_storage, 'close'):
+            self._file_storage.close()
+        self._file_storage = None
+        if self._trace_file is not None:
+            self._trace_file.close()
+            self._trace_file = None
+
+    @timed('manager.add_certificate', rows=hit)
+    def add_certificate(self, certificate):
+        """
+        Writes a certificate to the DB and the file store as one unit, returns
+        False when it already exists in either. The add is journaled first,
+        and the journal entry is closed in the transaction inserting the row,
+        so an add interrupted by a crash is undone by ``recover``. Other
+        writers wait while the row is uncommitted, which makes the DB's
+        unique email index the only duplicate check needed.
+
+        With a write-behind store the add returns once the row commits. The
+        journal entry stays open until the entry is written, and a crash
+        before then has ``recover`` write it from the row.
+        """
+        db_storage = self.db_storage
+        file_storage = self.file_storage
+
+        intent = db_storage.open_intent(certificate.email)
+        db_storage.begin()
+        try:
+            db_storage.save(certificate, commit=False)
+            if file_storage.check_exist(certificate):
+                raise CertificateExists(certificate.email)
+        except CertificateExists:
+            db_storage.rollback()
+            db_storage.close_intent(intent)
+            return False
+        except:
+            db_storage.rollback()
+            db_storage.close_intent(intent)
+            raise
+
+        try:
+            if self._write_behind():
+                file_storage.save(certificate, intent)
+                self._report_failures(self._close_written())
+            else:
+                file_storage.save(certificate)
+                db_storage.close_intent(intent, commit=False)
+            db_storage.commit()
+        except:
+            db_storage.rollback()
+            if file_storage.check_exist(certificate):
+                file_storage.delete(certificate.email)
+            db_storage.close_intent(intent)
+            raise
+        return True
+
+    @timed('manager.recover', rows=len)
+    def recover(self):
+        """
+        Finishes adds left half way by processes that died, returns their
+        emails. An add whose row never committed is undone; one whose row
+        committed had its store write queued, which is redone. Runs with
+        the DB write lock held, so no live add is between its insert and
+        its commit. A redone write written behind keeps its journal entry
+        open until it's on disk, so a failing one is tried again next time.
+        """
+        db_storage = self.db_storage
+        file_storage = self.file_storage
+        db_storage.begin()
+        recovered = []
+        try:
+            intents = db_storage.pending_intents()
+            live = set(email for _, email, pid in intents if pid_alive(pid))
+            for intent, email, pid in intents:
+                if pid_alive(pid):
+                    continue
+                certificate = Certificate(email=email)
+                in_store = file_storage.check_exist(certificate)
+                recovered.append(email)
+                if not db_storage.check_exist(certificate):
+                    if in_store:
+                        file_storage.delete(email)
+                # A live add of the same email writes the entry itself
+                elif not in_store and email not in live:
+                    if self._write_behind():
+                        file_storage.save(db_storage.get_by_email(email), intent)
+                        continue
+                    file_storage.save(db_storage.get_by_email(email))
+                db_storage.close_intent(intent, commit=False)
+            if self._write_behind():
+                file_storage.flush()
+                self._report_failures(self._close_written())
+            db_storage.commit()
+        except:
+            db_storage.rollback()
+            raise
+        return recovered
+
+    def _ask_text(self, prompt):
+        # The terminal hands over bytes in its own encoding
+        return raw_input(prompt).decode(getattr(sys.stdin, 'encoding', None) or 'utf-8')
+
+    @timed('manager.command_addcert')
     def command_addcert(self):
-        file_storage = CertificateFileStorage(store_path=SETTINGS['store_path'])
-        db_storage = CertificateDBStorage(db=SETTINGS['db'])
+        self.recover()
         count = 0
         ask = True
         while ask:
-            certificate = Certificate(email=(raw_input('E-mail: ')).strip(),
-                                      questions=[raw_input('Question %s: ' % i) for i in range(1,5)],
-                                      enrollment_id=raw_input('Enrollment: '),
-                                      password=raw_input('Password: ') or SETTINGS['default_password'])
-            if certificate.is_bound():
-                if file_storage.check_exist(certificate) or db_storage.check_exist(certificate):
-                    print "\tThis certificate is already exist in file system and/or database"
-                else:
-                    file_storage.save(certificate)
-                    db_storage.save(certificate)
+            try:
+                certificate = Certificate(email=self._ask_text('E-mail: ').strip(),
+                                          questions=[self._ask_text('Question %s: ' % i) for i in range(1,5)],
+                                          enrollment_id=self._ask_text('Enrollment: '),
+                                          password=self._ask_text('Password: ') or require('default_password'))
+            except UnicodeDecodeError:
+                certificate = None
+            if certificate is not None and certificate.is_bound():
+                if self.add_certificate(certificate):
                     count += 1
+                else:
+                    print "\tThis certificate is already exist in file system and/or database"
                 ask = raw_input('Add new one? (y/n): ') == 'y'
             else:
                 print "\tInvalid input, try again"
         return count
 
-    def command_report(self):
-        db_storage = CertificateDBStorage(db=SETTINGS['db'])
-        reporter = Reporter(db_storage)
-        report_rows, total = reporter.generate_report()
-        week_start, week_end = get_current_week()
+    @timed('manager.command_report')
+    def command_report(self, start=None, end=None, fmt='table', out=sys.stdout):
+        reporter = Reporter(self.db_storage)
+        return reporter.write_report(out, fmt, start, end)
+
+    SEARCH_HEADER = ['E-mail', 'Enrollment ID', 'Date obtained']
 
-        report_rows.insert(0, ['Date obtained', 'E-mail', 'Password', 'Enrollment ID', 'Answers to secret questions'])
-        return report_rows, week_start, week_end, total
+    @timed('manager.command_search', rows=len)
+    def command_search(self, text, page=1, per_page=20, fmt='table', out=sys.stdout):
+        """
+        Writes a page of search results, returns the certificates on it.
+        """
+        from certman import formats
 
-    def command_delete(self):
-        email = raw_input("Please enter E-mail: ")
+        certificates = self.db_storage.search(text, per_page, (page - 1) * per_page)
+        if fmt == 'table':
+            rows = ([certificate.email, certificate.enrollment_id, certificate.date_obtained.strftime('%d.%m.%Y')]
+                    for certificate in certificates)
+            formats.write_table(rows, self.SEARCH_HEADER, "Search results for '%s', page %s" % (text, page), out)
+        elif fmt == 'csv':
+            formats.write_csv(certificates, out)
+        elif fmt == 'ndjson':
+            formats.write_ndjson(certificates, out)
+        else:
+            raise ValueError("Unknown output format '%s'" % fmt)
+        return certificates
 
-        db_storage = CertificateDBStorage(db=SETTINGS['db'])
-        file_storage = CertificateFileStorage(store_path=SETTINGS['store_path'])
+    @timed('manager.command_stats')
+    def command_stats(self, period='week', start=None, end=None):
+        if start is None or end is None:
+            end = date.today()
+            start = date(end.year, 1, 1)
+        return self.db_storage.count_by_period(period, start, end)
 
-        exist = db_storage.check_exist(Certificate(email=email))
-        if not exist:
-            print "No certificates with E-mail '%s' found." % id_num
-            return
+    @timed('manager.command_archive')
+    def command_archive(self, days=None, vacuum=True):
+        """
+        Moves certificates older than ``days`` (the archive age setting by
+        default) into the archive DB, returns how many were moved. Changes
+        logged before the retention setting are pruned along the way.
+        """
+        if days is None:
+            days = SETTINGS['archive_after_days']
+        moved = self.db_storage.archive_before(date.today() - timedelta(days=days))
+        pruned = self.db_storage.prune_changes(datetime.now() - timedelta(days=SETTINGS['change_log_days']))
+        if (moved or pruned) and vacuum:
+            self.db_storage.vacuum()
+        return moved
+
+    @timed('manager.command_changes')
+    def command_changes(self, since=0, limit=None, out=sys.stdout):
+        """
+        Writes the changes logged after ``since`` as NDJSON, returns the
+        sequence number to pass as ``since`` next time.
+        """
+        from certman.formats import write_changes
+
+        return write_changes(self.db_storage.changes(since, limit), out) or since
+
+    @timed('manager.command_replicate')
+    def command_replicate(self, replica_path, batch_size=1000, follow=False, interval=5.0, log=None):
+        """
+        Brings the DB at ``replica_path`` up to date with the changes logged
+        here, creating it on first use, and returns how many changes were
+        applied. With ``follow`` it keeps polling every ``interval`` seconds
+        until interrupted.
+        """
+        source = os.path.abspath(require('db'))
+        replica = CertificateDBStorage(replica_path, timeout=SETTINGS['busy_timeout'])
+        applied = 0
+        try:
+            while True:
+                count = replica.replicate_from(self.db_storage, source, batch_size)
+                applied += count
+                if count and log:
+                    log('Applied %s changes, at %s' % (count, replica.replication_position(source)))
+                if not follow:
+                    return applied
+                time.sleep(interval)
+        finally:
+            replica.close()
+
+    @timed('manager.command_snapshot')
+    def command_snapshot(self, path):
+        """
+        Writes every certificate to a compressed snapshot at ``path``,
+        returns how many were written.
+        """
+        from certman.snapshot import write_snapshot
+
+        return write_snapshot(self.db_storage, path)
+
+    @timed('manager.command_restore')
+    def command_restore(self, path):
+        """
+        Rebuilds the empty DB and the store from the snapshot at ``path``,
+        returns how many certificates were restored.
+        """
+        from certman.snapshot import restore_snapshot
+
+        return restore_snapshot(self.db_storage, self.file_storage, path)
+
+    @timed('manager.command_rebuild_stats')
+    def command_rebuild_stats(self):
+        self.db_storage.rebuild_counts()
+
+    @timed('manager.command_import', rows=lambda result: result.imported)
+    def command_import(self, path=None):
+        from certman.formats import reader_for
+
+        path = path or raw_input('Path to file (csv, ndjson or yaml): ').strip()
+        read = reader_for(path)
+
+        importer = Importer(db_storage=self.db_storage,
+                            file_storage=self.file_storage,
+                            default_password=require('default_password'))
+        with open(path, 'r') as f:
+            return importer.run(read(f))
+
+    @timed('manager.command_migrate_store')
+    def command_migrate_store(self, progress_every=1000):
+        if not hasattr(self.file_storage, 'migrate_layout'):
+            raise ValueError('Store backend has no directory layout to migrate')
+        moved = 0
+        for email in self.file_storage.migrate_layout():
+            moved += 1
+            if moved % progress_every == 0:
+                print "\tMoved %s certificates..." % moved
+        return moved
+
+    @timed('manager.command_compact_store')
+    def command_compact_store(self):
+        if not hasattr(self.file_storage, 'compact'):
+            raise ValueError('Store backend does not support compaction')
+        return self.file_storage.compact()
+
+    @timed('manager.command_verify')
+    def command_verify(self, incremental=None, repair=None, orphans=None):
+        """
+        Checks the DB against the file store. Options left as None are
+        asked for interactively.
+        """
+        from certman.verify import Verifier
+
+        self.recover()
+        verifier = Verifier(self.db_storage, self.file_storage)
+        if incremental is None:
+            incremental = raw_input('Only check changes since the last run? (y/n): ') == 'y'
+        since = verifier.last_verified() if incremental else None
+
+        started = time.time()
+        if since is None:
+            result = verifier.verify()
+        else:
+            result = verifier.verify_incremental(since)
+
+        for kind, email in result.issues:
+            print "\t%s: %s" % (email, kind)
+        print "Checked %s entries, %s issues found" % (result.checked, len(result.issues))
+
+        if result.issues:
+            if repair is None:
+                repair = raw_input('Repair? (y/n): ') == 'y'
+            if repair and result.orphaned_in_store and orphans is None:
+                orphans = raw_input('Restore orphaned store entries into the DB or delete them? (restore/delete): ')
+            if repair:
+                verifier.repair(result, orphans or 'restore')
+                print "Repaired %s entries" % result.repaired
+
+        # Unrepaired issues must be seen again by the next incremental run
+        if not result.issues or repair:
+            verifier.save_manifest(started)
+        return result
+
+    @timed('manager.command_delete_many', rows=len)
+    def command_delete_many(self, emails=None, start=None, end=None, dry_run=False, workers=8,
+                            progress_every=1000):
+        """
+        Deletes certificates by email and/or ``when_added`` range in one DB
+        transaction, then removes their store entries concurrently. Returns
+        the deleted emails, or those that would be deleted on a dry run.
+        """
+        deleted = self.db_storage.delete_many(emails, start, end, dry_run)
+        if dry_run:
+            return deleted
+
+        # A crash past this point leaves orphaned store entries, which
+        # verify reports and repairs
+        removed = 0
+        for email in self.file_storage.delete_many(deleted, workers):
+            removed += 1
+            if removed % progress_every == 0:
+                print "\tRemoved %s/%s store entries..." % (removed, len(deleted))
+        return deleted
+
+    @timed('manager.command_delete')
+    def command_delete(self, emails=None, confirm=True):
+        """
+        Deletes certificates by email, asking for one when no emails are
+        given. Returns the emails that were not found.
+        """
+        if emails is None:
+            emails = [raw_input("Please enter E-mail: ")]
+
+        db_storage = self.db_storage
+        file_storage = self.file_storage
+
+        missing = []
+        for email in emails:
+            if not db_storage.check_exist(Certificate(email=email)):
+                print "No certificates with E-mail '%s' found." % email
+                missing.append(email)
+                continue
 
-        if raw_input('Are you sure that you want to delete the certificate? (y/n): ') == 'y':
-            certificate = db_storage.delete(email)
-            file_storage.delete(email)
-            print "Certificate with e-mail '%s' deleted successfully." % email
+            if not confirm or raw_input('Are you sure that you want to delete the certificate? (y/n): ') == 'y':
+                db_storage.delete(email)
+                file_storage.delete(email)
+                print "Certificate with e-mail '%s' deleted successfully." % email
+        return missing
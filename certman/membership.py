@@ -0,0 +1,74 @@
+#!coding: utf-8
+"""
+In-memory Bloom filter of stored emails. An email the filter doesn't
+contain is definitely not stored, so most duplicate checks of new emails
+are answered without touching the DB; a possible hit still needs an exact
+check. Emails can't be removed from the filter, deleted ones just stay as
+possible hits until the filter is rebuilt.
+
+Positions are derived from Python's own string hash, which is much faster
+than a digest but may differ between processes, so a filter is only valid
+in the process that built it.
+"""
+import math
+
+
+class EmailFilter(object):
+    # Smallest number of emails a filter is sized for
+    MIN_CAPACITY = 1024
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+        Sized to keep false positives at ``error_rate`` until ``capacity``
+        emails are added.
+        """
+        self.capacity = max(int(capacity), self.MIN_CAPACITY)
+        self.error_rate = error_rate
+        bits = -self.capacity * math.log(error_rate) / math.log(2) ** 2
+        self.size = int(math.ceil(bits / 8)) * 8
+        self.hashes = max(1, int(round(self.size / float(self.capacity) * math.log(2))))
+        self.bits = bytearray(self.size // 8)
+        self.count = 0
+
+    def add(self, email):
+        # Double hashing, the halves of one 64-bit hash give every position
+        value = hash(email) & 0xffffffffffffffff
+        first, second = value & 0xffffffff, value >> 32 | 1
+        bits, size = self.bits, self.size
+        for i in xrange(self.hashes):
+            position = (first + i * second) % size
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def update(self, emails):
+        for email in emails:
+            self.add(email)
+
+    def __contains__(self, email):
+        value = hash(email) & 0xffffffffffffffff
+        first, second = value & 0xffffffff, value >> 32 | 1
+        bits, size = self.bits, self.size
+        for i in xrange(self.hashes):
+            position = (first + i * second) % size
+            if not bits[position >> 3] & 1 << (position & 7):
+                return False
+        return True
+
+    def full(self):
+        return self.count > self.capacity
+
+    def false_positive_rate(self):
+        """
+        Expected share of unknown emails reported as possible hits, for the
+        emails added so far.
+        """
+        return (1 - math.exp(-self.hashes * self.count / float(self.size))) ** self.hashes
+
+    def info(self):
+        return {
+            'count': self.count,
+            'capacity': self.capacity,
+            'bytes': len(self.bits),
+            'hashes': self.hashes,
+            'false_positive_rate': self.false_positive_rate(),
+        }
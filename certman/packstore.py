@@ -0,0 +1,303 @@
+#!coding: utf-8
+"""
+Append-only packed storage for certificate credentials, an alternative to
+one directory and ``credentials.yaml`` per certificate.
+
+Records are appended to numbered segment files. Every record is framed as::
+
+    crc32 (4) | kind (1) | key length (2) | value length (4) | key | value
+
+where kind is PUT or DELETE (a tombstone). An append-only ``index`` file
+holds the position of the latest record for every key and is loaded into
+memory when the store is opened; records that reached the active segment
+but not the index before a crash are recovered by scanning its tail.
+Values are read back through read-only mmaps of the segments. Deleted and
+overwritten records keep taking space until ``compact`` rewrites the live
+records into fresh segments.
+
+The index is only kept in memory by the process that opened the store, so
+a store is locked by one process at a time; opening it in another fails
+with ``StoreLocked`` until the first one closes it.
+"""
+import errno
+import fcntl
+import mmap
+import os
+import struct
+import zlib
+
+from certman.instrument import found, hit, timed
+from certman.serializers import get_codec, sniff_codec
+
+
+PUT = 1
+DELETE = 2
+
+RECORD_HEADER = struct.Struct('>IBHI')
+INDEX_ENTRY = struct.Struct('>BIQIH')
+
+
+class StoreLocked(IOError):
+    pass
+
+
+def _key(email):
+    return email.encode('utf-8') if isinstance(email, unicode) else email
+
+
+class CertificatePackStorage(object):
+    SEGMENT_PREFIX = 'segment-'
+    INDEX_NAME = 'index'
+    LOCK_NAME = 'lock'
+
+    def __init__(self, store_path, segment_size=64 * 1024 * 1024, codec='yaml'):
+        self.store_path = store_path
+        self.segment_size = segment_size
+        self.codec = get_codec(codec)
+        self.index = {}
+        self._maps = {}
+        if not os.path.isdir(store_path):
+            os.makedirs(store_path)
+        self._lock()
+        self._open()
+
+    # Segment and index files
+
+    def _segment_path(self, number):
+        return os.path.join(self.store_path, '%s%06d.log' % (self.SEGMENT_PREFIX, number))
+
+    def _segment_numbers(self):
+        numbers = []
+        for name in os.listdir(self.store_path):
+            if name.startswith(self.SEGMENT_PREFIX) and name.endswith('.log'):
+                numbers.append(int(name[len(self.SEGMENT_PREFIX):-len('.log')]))
+        return sorted(numbers)
+
+    def _lock(self):
+        self._lock_file = open(os.path.join(self.store_path, self.LOCK_NAME), 'a')
+        try:
+            fcntl.flock(self._lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError as e:
+            self._lock_file.close()
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            raise StoreLocked('%s is in use by another process' % self.store_path)
+
+    def _open(self):
+        index_path = os.path.join(self.store_path, self.INDEX_NAME)
+        indexed_end = {}
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as f:
+                for kind, segment, offset, length, key in self._read_index(f):
+                    self._apply(kind, key, segment, offset, length)
+                    indexed_end[segment] = max(indexed_end.get(segment, 0), offset + length)
+
+        numbers = self._segment_numbers()
+        self.active = numbers[-1] if numbers else 1
+        self._segment = open(self._segment_path(self.active), 'ab')
+        self._index_file = open(index_path, 'ab')
+        self._recover(indexed_end.get(self.active, 0))
+
+    def _read_index(self, f):
+        while True:
+            header = f.read(INDEX_ENTRY.size)
+            if len(header) < INDEX_ENTRY.size:
+                return
+            kind, segment, offset, length, key_length = INDEX_ENTRY.unpack(header)
+            key = f.read(key_length)
+            if len(key) < key_length:
+                return
+            yield kind, segment, offset, length, key
+
+    def _scan(self, number, start=0):
+        """
+        Yields ``(kind, key, offset, length)`` for every intact record of a
+        segment from ``start`` on, stopping at the first torn record.
+        """
+        with open(self._segment_path(number), 'rb') as f:
+            f.seek(start)
+            offset = start
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    return
+                crc, kind, key_length, value_length = RECORD_HEADER.unpack(header)
+                body = f.read(key_length + value_length)
+                if len(body) < key_length + value_length or zlib.crc32(body) & 0xffffffff != crc:
+                    return
+                length = RECORD_HEADER.size + key_length + value_length
+                yield kind, body[:key_length], offset, length
+                offset += length
+
+    def _recover(self, start):
+        end = start
+        for kind, key, offset, length in self._scan(self.active, start):
+            self._apply(kind, key, self.active, offset, length)
+            self._write_index(kind, key, self.active, offset, length)
+            end = offset + length
+        if os.path.getsize(self._segment_path(self.active)) > end:
+            # Drop a torn record left by a crash mid-append
+            self._segment.truncate(end)
+        self._index_file.flush()
+
+    def _apply(self, kind, key, segment, offset, length):
+        if kind == PUT:
+            self.index[key] = (segment, offset, length)
+        else:
+            self.index.pop(key, None)
+
+    def _write_index(self, kind, key, segment, offset, length):
+        self._index_file.write(INDEX_ENTRY.pack(kind, segment, offset, length, len(key)) + key)
+
+    def _append(self, kind, key, value=''):
+        self._segment.seek(0, os.SEEK_END)
+        if self._segment.tell() >= self.segment_size:
+            self._segment.close()
+            self.active += 1
+            self._segment = open(self._segment_path(self.active), 'ab')
+
+        body = key + value
+        offset = self._segment.tell()
+        self._segment.write(RECORD_HEADER.pack(zlib.crc32(body) & 0xffffffff, kind, len(key), len(value)) + body)
+        self._segment.flush()
+
+        length = RECORD_HEADER.size + len(body)
+        self._apply(kind, key, self.active, offset, length)
+        self._write_index(kind, key, self.active, offset, length)
+        self._index_file.flush()
+
+    def _read(self, segment, offset, length):
+        segment_map = self._maps.get(segment)
+        if segment_map is None or len(segment_map) < offset + length:
+            if segment_map is not None:
+                segment_map.close()
+            with open(self._segment_path(segment), 'rb') as f:
+                segment_map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._maps[segment] = segment_map
+        key_length = RECORD_HEADER.unpack_from(segment_map, offset)[2]
+        return segment_map[offset + RECORD_HEADER.size + key_length:offset + length]
+
+    def _close_maps(self):
+        for segment_map in self._maps.values():
+            segment_map.close()
+        self._maps = {}
+
+    def close(self):
+        self._close_maps()
+        self._segment.close()
+        self._index_file.close()
+        self._lock_file.close()
+
+    # Storage interface
+
+    @timed('pack.save', rows=1)
+    def save(self, certificate):
+        store_obj = {
+            'certificate': certificate.as_dict()
+        }
+        self._append(PUT, _key(certificate.email), self.codec.dumps(store_obj))
+
+    @timed('pack.save_many', rows=lambda count: count)
+    def save_many(self, certificates, workers=None):
+        """
+        Appends the ``certificates`` not stored yet, returns how many were
+        written. Appends all go to the active segment, so ``workers`` is
+        accepted for the directory store's interface only.
+        """
+        count = 0
+        for certificate in certificates:
+            if _key(certificate.email) not in self.index:
+                self.save(certificate)
+                count += 1
+        return count
+
+    @timed('pack.delete', rows=1)
+    def delete(self, email):
+        key = _key(email)
+        if key not in self.index:
+            raise KeyError(email)
+        self._append(DELETE, key)
+
+    @timed('pack.delete_many')
+    def delete_many(self, emails, workers=None):
+        """
+        Writes tombstones for the stored ``emails``, yielding each deleted
+        one. Appends all go to the active segment, so ``workers`` is accepted
+        for the directory store's interface only.
+        """
+        for email in emails:
+            key = _key(email)
+            if key in self.index:
+                self._append(DELETE, key)
+                yield email
+
+    @timed('pack.check_exist', rows=hit)
+    def check_exist(self, certificate):
+        return _key(certificate.email) in self.index
+
+    def _decode(self, position):
+        from certman.manager import Certificate
+
+        data = self._read(*position)
+        store_obj = sniff_codec(data).loads(data)
+        return Certificate(**store_obj['certificate'])
+
+    @timed('pack.load', rows=found)
+    def load(self, email):
+        position = self.index.get(_key(email))
+        if position is None:
+            return None
+        return self._decode(position)
+
+    def iter_emails(self, workers=None, since=None):
+        """
+        Yields all stored emails in sorted order. The index is in memory, so
+        the arguments of the directory store's version are accepted but
+        don't change anything.
+        """
+        for key in sorted(self.index):
+            yield key
+
+    @timed('pack.iter_all')
+    def iter_all(self):
+        """
+        Loads every stored certificate in segment order, which keeps the
+        reads sequential within each mmap.
+        """
+        for position in sorted(self.index.values()):
+            yield self._decode(position)
+
+    @timed('pack.compact')
+    def compact(self):
+        """
+        Rewrites live records into new segments and drops the old ones.
+        The new index replaces the old one with an atomic rename, so a
+        crash leaves either the old or the new store intact. Returns the
+        number of bytes reclaimed.
+        """
+        old_numbers = self._segment_numbers()
+        size_before = sum(os.path.getsize(self._segment_path(n)) for n in old_numbers)
+
+        self._segment.close()
+        self.active += 1
+        self._segment = open(self._segment_path(self.active), 'ab')
+        index_path = os.path.join(self.store_path, self.INDEX_NAME)
+        self._index_file.close()
+        self._index_file = open(index_path + '.tmp', 'wb')
+
+        live = sorted(self.index.items(), key=lambda item: item[1])
+        for key, position in live:
+            self._append(PUT, key, self._read(*position))
+
+        self._segment.flush()
+        os.fsync(self._segment.fileno())
+        os.fsync(self._index_file.fileno())
+        self._index_file.close()
+        os.rename(index_path + '.tmp', index_path)
+        self._index_file = open(index_path, 'ab')
+
+        self._close_maps()
+        for number in old_numbers:
+            os.remove(self._segment_path(number))
+        size_after = sum(os.path.getsize(self._segment_path(n)) for n in self._segment_numbers())
+        return size_before - size_after
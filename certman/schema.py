@@ -0,0 +1,270 @@
+#!coding: utf-8
+"""
+Versioned schema for the certificates database. Every migration is applied
+once, in order, inside its own transaction, and recorded in the
+``schema_migrations`` table, so databases created by older versions are
+upgraded in place when they are opened.
+"""
+import json
+import re
+import sqlite3
+
+from datetime import datetime
+
+
+def _create_certificates(c):
+    c.execute('''CREATE TABLE IF NOT EXISTS certificates
+        (id integer primary key, when_added date, email text, password text, enrollment_id text, questions text);''')
+
+
+def _index_certificates(c):
+    # Older versions could store the same email twice. Keep the first row
+    # and set the rest aside so the unique index can be built.
+    c.execute('''CREATE TABLE IF NOT EXISTS certificates_duplicates
+        (id integer primary key, when_added date, email text, password text, enrollment_id text, questions text);''')
+    c.execute('''INSERT INTO certificates_duplicates SELECT * FROM certificates
+        WHERE id NOT IN (SELECT MIN(id) FROM certificates GROUP BY email);''')
+    c.execute('DELETE FROM certificates WHERE id IN (SELECT id FROM certificates_duplicates);')
+    c.execute('CREATE UNIQUE INDEX IF NOT EXISTS certificates_email ON certificates (email);')
+    c.execute('CREATE INDEX IF NOT EXISTS certificates_when_added ON certificates (when_added);')
+
+
+def _count_certificates_by_day(c):
+    # Kept up to date by triggers, so every write to certificates updates
+    # the counts within the same transaction.
+    c.execute('CREATE TABLE IF NOT EXISTS certificate_counts (day date primary key, total integer not null);')
+    _create_count_triggers(c)
+    rebuild_counts(c)
+
+
+def _create_count_triggers(c):
+    c.execute('''CREATE TRIGGER IF NOT EXISTS certificate_counts_insert
+        AFTER INSERT ON certificates WHEN NEW.when_added IS NOT NULL BEGIN
+            INSERT OR IGNORE INTO certificate_counts VALUES (NEW.when_added, 0);
+            UPDATE certificate_counts SET total = total + 1 WHERE day = NEW.when_added;
+        END;''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS certificate_counts_delete
+        AFTER DELETE ON certificates WHEN OLD.when_added IS NOT NULL BEGIN
+            UPDATE certificate_counts SET total = total - 1 WHERE day = OLD.when_added;
+            DELETE FROM certificate_counts WHERE day = OLD.when_added AND total <= 0;
+        END;''')
+    c.execute('''CREATE TRIGGER IF NOT EXISTS certificate_counts_update
+        AFTER UPDATE OF when_added ON certificates BEGIN
+            UPDATE certificate_counts SET total = total - 1 WHERE day = OLD.when_added;
+            DELETE FROM certificate_counts WHERE day = OLD.when_added AND total <= 0;
+            INSERT OR IGNORE INTO certificate_counts SELECT NEW.when_added, 0 WHERE NEW.when_added IS NOT NULL;
+            UPDATE certificate_counts SET total = total + 1 WHERE day = NEW.when_added;
+        END;''')
+
+
+def rebuild_counts(c):
+    c.execute('DELETE FROM certificate_counts;')
+    c.execute('''INSERT INTO certificate_counts
+        SELECT when_added, COUNT(*) FROM certificates WHERE when_added IS NOT NULL GROUP BY when_added;''')
+
+
+def _legacy_questions_to_json(questions_str):
+    if questions_str is None:
+        return None
+    return json.dumps([m.group(1) for m in re.finditer(r'"([^"]+)"', questions_str)])
+
+
+def _store_questions_as_json(c):
+    # Answers used to be kept as 'questionN: "answer"' lines, which break on
+    # answers containing quotes. They are now a JSON list.
+    c.connection.create_function('legacy_questions_to_json', 1, _legacy_questions_to_json)
+    c.execute('UPDATE certificates SET questions = legacy_questions_to_json(questions);')
+    c.execute('UPDATE certificates_duplicates SET questions = legacy_questions_to_json(questions);')
+
+
+def _journal_certificate_writes(c):
+    # A row is committed before a certificate is written to the DB and the
+    # file store, and deleted in the transaction inserting the certificate.
+    # Rows left behind belong to adds that died half way.
+    c.execute('''CREATE TABLE IF NOT EXISTS certificate_intents
+        (id integer primary key, email text not null, pid integer not null, created_at text not null);''')
+
+
+# Full-text index kinds, best first. Both match the start of words, emails
+# being split into words at dots and the @. SQLite builds without FTS5
+# still have FTS4, which gets prefix indexes instead of FTS5's term scans.
+SEARCH_INDEXES = (
+    ('fts5', "fts5(email, enrollment_id, questions, content='certificates', content_rowid='id')"),
+    ('fts4', "fts4(email, enrollment_id, questions, content='certificates', prefix='2,3,4')"),
+)
+
+
+def _index_certificates_for_search(c):
+    for kind, definition in SEARCH_INDEXES:
+        try:
+            c.execute('CREATE VIRTUAL TABLE certificates_search USING %s;' % definition)
+        except sqlite3.OperationalError:
+            continue
+        break
+    else:
+        return
+    _create_search_triggers(c, kind)
+    c.execute("INSERT INTO certificates_search (certificates_search) VALUES ('rebuild');")
+
+
+def _create_search_triggers(c, kind):
+    # The index only keeps tokens, rows are read from certificates. Rows
+    # must leave the index with the values they were indexed with.
+    if kind == 'fts4':
+        remove = 'DELETE FROM certificates_search WHERE docid = OLD.id;'
+        add = '''INSERT INTO certificates_search (docid, email, enrollment_id, questions)
+            VALUES (NEW.id, NEW.email, NEW.enrollment_id, NEW.questions);'''
+    else:
+        remove = '''INSERT INTO certificates_search (certificates_search, rowid, email, enrollment_id, questions)
+            VALUES ('delete', OLD.id, OLD.email, OLD.enrollment_id, OLD.questions);'''
+        add = '''INSERT INTO certificates_search (rowid, email, enrollment_id, questions)
+            VALUES (NEW.id, NEW.email, NEW.enrollment_id, NEW.questions);'''
+    c.execute('CREATE TRIGGER certificates_search_insert AFTER INSERT ON certificates BEGIN %s END;' % add)
+    c.execute('CREATE TRIGGER certificates_search_delete BEFORE DELETE ON certificates BEGIN %s END;' % remove)
+    c.execute('CREATE TRIGGER certificates_search_update_before BEFORE UPDATE ON certificates BEGIN %s END;'
+              % remove)
+    c.execute('CREATE TRIGGER certificates_search_update_after AFTER UPDATE ON certificates BEGIN %s END;' % add)
+
+
+def search_index_kind(conn):
+    """
+    The kind of full-text index from ``SEARCH_INDEXES`` the DB was built
+    with, None when the SQLite build has none.
+    """
+    row = conn.execute("SELECT sql FROM sqlite_master WHERE name = 'certificates_search';").fetchone()
+    if row is None:
+        return None
+    for kind, definition in SEARCH_INDEXES:
+        if row[0].endswith(definition):
+            return kind
+
+
+def _log_certificate_changes(c):
+    # Inserts and deletes are appended by the storage in the transaction
+    # making them, under sequence numbers that are never reused. Only keys
+    # are logged, readers take the row from the certificate tables. The
+    # log starts with the rows already stored, so a consumer reading it
+    # from the beginning sees the whole table. Replicas record how far they
+    # got in every source's log.
+    c.execute('''CREATE TABLE IF NOT EXISTS certificate_changes
+        (seq integer primary key autoincrement, op text not null, email text not null,
+         changed_at text not null default (datetime('now', 'localtime')));''')
+    c.execute("INSERT INTO certificate_changes (op, email) SELECT 'insert', email FROM certificates ORDER BY id;")
+    c.execute('CREATE TABLE IF NOT EXISTS replication_state (source text primary key, seq integer not null);')
+
+
+def _never_reuse_certificate_ids(c):
+    # Rows moved to the archive keep their IDs. Without AUTOINCREMENT an
+    # emptied table hands the IDs out again, so the table is rebuilt with
+    # it; indexes and triggers go with the old table. IDs stay the same,
+    # which keeps the search index valid.
+    c.execute('''CREATE TABLE certificates_rebuilt
+        (id integer primary key autoincrement, when_added date, email text, password text, enrollment_id text,
+         questions text);''')
+    c.execute('INSERT INTO certificates_rebuilt SELECT * FROM certificates;')
+    c.execute('DROP TABLE certificates;')
+    c.execute('ALTER TABLE certificates_rebuilt RENAME TO certificates;')
+    c.execute('CREATE UNIQUE INDEX certificates_email ON certificates (email);')
+    c.execute('CREATE INDEX certificates_when_added ON certificates (when_added);')
+    _create_count_triggers(c)
+    kind = search_index_kind(c.connection)
+    if kind is not None:
+        _create_search_triggers(c, kind)
+
+
+def _log_changes_by_key(c):
+    # The log used to copy every row, passwords included. Entries keep
+    # their sequence numbers, and so does the sequence itself.
+    columns = [row[1] for row in c.execute('PRAGMA table_info(certificate_changes);')]
+    if 'password' not in columns:
+        return
+    c.execute('''CREATE TABLE certificate_changes_rebuilt
+        (seq integer primary key autoincrement, op text not null, email text not null,
+         changed_at text not null default (datetime('now', 'localtime')));''')
+    c.execute('''INSERT INTO certificate_changes_rebuilt (seq, op, email, changed_at)
+        SELECT seq, op, email, changed_at FROM certificate_changes;''')
+    c.execute("SELECT seq FROM sqlite_sequence WHERE name = 'certificate_changes';")
+    row = c.fetchone()
+    c.execute('DROP TABLE certificate_changes;')
+    c.execute('ALTER TABLE certificate_changes_rebuilt RENAME TO certificate_changes;')
+    if row is not None:
+        c.execute("DELETE FROM sqlite_sequence WHERE name = 'certificate_changes';")
+        c.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('certificate_changes', ?);", row)
+
+
+MIGRATIONS = (
+    (1, 'create certificates table', _create_certificates),
+    (2, 'index certificates by email and when_added', _index_certificates),
+    (3, 'count certificates by day', _count_certificates_by_day),
+    (4, 'store questions as JSON', _store_questions_as_json),
+    (5, 'journal certificate writes', _journal_certificate_writes),
+    (6, 'index certificates for search', _index_certificates_for_search),
+    (7, 'log certificate changes', _log_certificate_changes),
+    (8, 'never reuse certificate IDs', _never_reuse_certificate_ids),
+    (9, 'log certificate changes by key only', _log_changes_by_key),
+)
+
+
+def _strip_archive(c):
+    # Archives used to get the whole schema of the hot DB. Their search
+    # index was kept up to date by the triggers but never queried.
+    for name in ('insert', 'delete', 'update_before', 'update_after'):
+        c.execute('DROP TRIGGER IF EXISTS certificates_search_%s;' % name)
+    for table in ('certificates_search', 'certificate_changes', 'replication_state', 'certificate_intents'):
+        c.execute('DROP TABLE IF EXISTS %s;' % table)
+
+
+# The archive DB holds rows moved out of the hot DB and their daily counts.
+# It is never searched, and changes are logged by the hot DB. Stripping
+# comes after the last migration of the hot DB's schema, so archives
+# created with all of it get stripped too.
+ARCHIVE_MIGRATIONS = MIGRATIONS[:4] + (
+    (10, 'strip search index and change log from the archive', _strip_archive),
+)
+
+
+def current_version(conn):
+    c = conn.cursor()
+    c.execute('''CREATE TABLE IF NOT EXISTS schema_migrations
+        (version integer primary key, name text, applied_at text);''')
+    c.execute('SELECT MAX(version) FROM schema_migrations;')
+    return c.fetchone()[0] or 0
+
+
+def migrate(conn, migrations=MIGRATIONS):
+    """
+    Applies pending migrations and returns the list of applied versions.
+    """
+    applied = []
+    version = current_version(conn)
+    pending = [m for m in migrations if m[0] > version]
+    if not pending:
+        return applied
+
+    # sqlite3 commits implicitly before DDL statements unless transactions
+    # are controlled by hand, which would leave half-applied migrations.
+    isolation_level = conn.isolation_level
+    conn.commit()
+    conn.isolation_level = None
+    try:
+        for number, name, apply_migration in pending:
+            c = conn.cursor()
+            c.execute('BEGIN IMMEDIATE;')
+            try:
+                # Another process opening the DB may have applied it while
+                # this one waited for the write lock
+                c.execute('SELECT 1 FROM schema_migrations WHERE version = ?;', (number,))
+                if c.fetchone() is not None:
+                    c.execute('ROLLBACK;')
+                    continue
+                apply_migration(c)
+                c.execute('INSERT INTO schema_migrations VALUES (?, ?, ?);',
+                          (number, name, datetime.now().strftime('%Y-%m-%d %H:%M:%S')))
+                c.execute('COMMIT;')
+            except:
+                c.execute('ROLLBACK;')
+                raise
+            applied.append(number)
+    finally:
+        conn.isolation_level = isolation_level
+    return applied
@@ -0,0 +1,88 @@
+#!coding: utf-8
+"""
+Codecs for the plain-file copies of certificates. A codec turns the
+``{'certificate': {...}}`` mapping kept in the store into bytes and back.
+The YAML codec uses the libyaml C loader and dumper when PyYAML was built
+with them. PyYAML is imported on first use, so commands that never touch
+YAML data don't pay for it at startup.
+"""
+import json
+
+from datetime import date, datetime
+
+
+_yaml = None
+
+
+def load_yaml():
+    """
+    Returns ``(yaml, SafeLoader, SafeDumper)``, importing PyYAML once.
+    """
+    global _yaml
+    if _yaml is None:
+        import yaml
+        try:
+            from yaml import CSafeLoader as SafeLoader, CSafeDumper as BaseDumper
+        except ImportError:
+            from yaml import SafeLoader, SafeDumper as BaseDumper
+
+        class SafeDumper(BaseDumper):
+            pass
+
+        # The safe dumper only knows the exact date type, accept its subclasses too
+        SafeDumper.add_multi_representer(date, SafeDumper.represent_date)
+        _yaml = yaml, SafeLoader, SafeDumper
+    return _yaml
+
+
+class YAMLCodec(object):
+    name = 'yaml'
+    extension = 'yaml'
+
+    def dumps(self, store_obj):
+        yaml, _, SafeDumper = load_yaml()
+        return yaml.dump(store_obj, Dumper=SafeDumper, default_flow_style=False)
+
+    def loads(self, data):
+        yaml, SafeLoader, _ = load_yaml()
+        return yaml.load(data, Loader=SafeLoader)
+
+
+class JSONCodec(object):
+    name = 'json'
+    extension = 'json'
+
+    def _default(self, value):
+        if isinstance(value, date):
+            return value.strftime('%Y-%m-%d')
+        raise TypeError('%r is not JSON serializable' % value)
+
+    def dumps(self, store_obj):
+        return json.dumps(store_obj, default=self._default, sort_keys=True)
+
+    def loads(self, data):
+        store_obj = json.loads(data)
+        certificate = store_obj.get('certificate') or {}
+        if isinstance(certificate.get('date_obtained'), basestring):
+            certificate['date_obtained'] = datetime.strptime(certificate['date_obtained'], '%Y-%m-%d').date()
+        return store_obj
+
+
+CODECS = {
+    'yaml': YAMLCodec(),
+    'json': JSONCodec(),
+}
+
+
+def get_codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError("Unknown store codec '%s'" % name)
+
+
+def sniff_codec(data):
+    """
+    Picks the codec of an encoded value, JSON values are always objects.
+    """
+    return CODECS['json'] if data[:1] == '{' else CODECS['yaml']
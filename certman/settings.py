@@ -2,8 +2,46 @@
 import os
 
 
+class SettingsError(Exception):
+	pass
+
+
+# Settings without a default, written by certman-config
+REQUIRED = {
+	'store_path': 'CERTMAN_STORE_PATH',
+	'default_password': 'CERTMAN_DEFAULT_PASSWORD',
+	'db': 'CERTMAN_DB',
+}
+
+
 SETTINGS = {
-	'store_path': os.environ['CERTMAN_STORE_PATH'],
-	'default_password': os.environ['CERTMAN_DEFAULT_PASSWORD'],
-	'db': os.environ['CERTMAN_DB']
+	'store_path': os.environ.get('CERTMAN_STORE_PATH'),
+	'default_password': os.environ.get('CERTMAN_DEFAULT_PASSWORD'),
+	'db': os.environ.get('CERTMAN_DB'),
+	'store_shard_levels': int(os.environ.get('CERTMAN_STORE_SHARD_LEVELS', 0)),
+	'store_backend': os.environ.get('CERTMAN_STORE_BACKEND', 'directory'),
+	'store_codec': os.environ.get('CERTMAN_STORE_CODEC', 'yaml'),
+	'cache_enabled': os.environ.get('CERTMAN_CACHE', '1') == '1',
+	'cache_size': int(os.environ.get('CERTMAN_CACHE_SIZE', 1024)),
+	'write_behind': os.environ.get('CERTMAN_WRITE_BEHIND', '1') == '1',
+	'write_behind_queue': int(os.environ.get('CERTMAN_WRITE_BEHIND_QUEUE', 256)),
+	'membership_filter': os.environ.get('CERTMAN_MEMBERSHIP_FILTER', '0') == '1',
+	'membership_error_rate': float(os.environ.get('CERTMAN_MEMBERSHIP_ERROR_RATE', 0.01)),
+	'busy_timeout': float(os.environ.get('CERTMAN_BUSY_TIMEOUT', 30)),
+	'archive_db': os.environ.get('CERTMAN_ARCHIVE_DB', ''),
+	'archive_after_days': int(os.environ.get('CERTMAN_ARCHIVE_AFTER_DAYS', 365)),
+	'change_log_days': int(os.environ.get('CERTMAN_CHANGE_LOG_DAYS', 30)),
+	'instrument': os.environ.get('CERTMAN_INSTRUMENT', '1') == '1',
+	'sql_trace': os.environ.get('CERTMAN_SQL_TRACE', '')
 }
+
+
+def require(key):
+	"""
+	Returns a required setting, settings are only checked when a command
+	needs them so that e.g. ``certman --help`` works without any.
+	"""
+	value = SETTINGS[key]
+	if value is None:
+		raise SettingsError('%s is not set, run certman-config' % REQUIRED[key])
+	return value
@@ -0,0 +1,212 @@
+#!coding: utf-8
+"""
+Snapshots of the whole certificate set in one compressed file, for backups
+that don't copy a live DB file or tar a directory per certificate.
+
+A snapshot is NDJSON split into chunks, each compressed on its own as a
+gzip member. Chunks are compressed on a pool of threads while the next
+ones are read, and concatenated members are a valid gzip file, so
+``zcat snapshot.gz`` shows the records. The first line is a header and the
+last one a trailer with the record count, so a truncated snapshot is
+rejected instead of restored partially. Records look like the
+``certificate`` mapping of a store entry, plus the row ``id`` and
+``archived`` for rows of the archive DB. Rows are restored under their
+IDs, which the hot and archive DBs must not share.
+
+The store holds the same certificates as the DB, so restoring writes the
+store entries from the DB rows; ``verify`` before a snapshot reports
+entries the DB doesn't know about.
+"""
+import json
+import os
+import zlib
+
+from collections import deque
+from datetime import datetime
+
+from certman.instrument import timed
+from certman.manager import Certificate, parse_date
+
+
+FORMAT_VERSION = 1
+
+# Records compressed as one gzip member, and read per DB transaction chunk
+# on restore.
+CHUNK_SIZE = 5000
+
+# zlib window bits producing and accepting a gzip wrapper
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+RECORD = '{"id": %s, "email": %s, "password": %s, "enrollment_id": %s, "questions": %s, "date_obtained": "%s"%s}'
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+def _compress(data, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+def _encode(row):
+    when_added, email, password, enrollment_id, questions, archived, row_id = row
+    # Answers are stored as JSON already
+    return RECORD % (row_id, json.dumps(email), json.dumps(password), json.dumps(enrollment_id), questions, when_added,
+                     ', "archived": true' if archived else '')
+
+
+def _chunks(rows, size):
+    chunk = []
+    for row in rows:
+        chunk.append(_encode(row))
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+@timed('snapshot.write', rows=lambda count: count)
+def write_snapshot(db_storage, path, chunk_size=CHUNK_SIZE, workers=4, level=6):
+    """
+    Writes every certificate of ``db_storage`` to a snapshot at ``path``,
+    returns how many were written. The snapshot is written under a
+    temporary name and renamed into place once synced, so ``path`` never
+    holds a partial one.
+    """
+    from multiprocessing.pool import ThreadPool
+
+    header = json.dumps({'snapshot': FORMAT_VERSION, 'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')})
+    temp_path = '%s.tmp-%s' % (path, os.urandom(4).encode('hex'))
+    pool = ThreadPool(workers)
+    count = 0
+    try:
+        with open(temp_path, 'wb') as f:
+            f.write(_compress(header + '\n', level))
+            # Rows are read on this thread, the cursor being bound to it;
+            # at most two chunks per worker wait to be written
+            pending = deque()
+            for chunk in _chunks(db_storage.iter_rows(), chunk_size):
+                count += len(chunk)
+                pending.append(pool.apply_async(_compress, ('\n'.join(chunk) + '\n', level)))
+                if len(pending) >= workers * 2:
+                    f.write(pending.popleft().get())
+            while pending:
+                f.write(pending.popleft().get())
+            f.write(_compress(json.dumps({'snapshot_end': True, 'certificates': count}) + '\n', level))
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_path, path)
+    except:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    finally:
+        pool.terminate()
+    return count
+
+
+def _decompress(f, block_size=1024 * 1024):
+    decompressor = zlib.decompressobj(GZIP_WBITS)
+    while True:
+        data = f.read(block_size)
+        if not data:
+            return
+        while data:
+            yield decompressor.decompress(data)
+            # Input past the end of a member starts the next one
+            data = decompressor.unused_data
+            if data:
+                decompressor = zlib.decompressobj(GZIP_WBITS)
+
+
+def _lines(f):
+    rest = ''
+    for data in _decompress(f):
+        lines = (rest + data).split('\n')
+        rest = lines.pop()
+        for line in lines:
+            yield line
+    if rest:
+        yield rest
+
+
+def read_snapshot(path):
+    """
+    Yields ``(certificate, archived, id)`` for every record of the snapshot
+    at ``path``, ``id`` being None in snapshots written before IDs were
+    kept. Raises ``SnapshotError`` for files that aren't snapshots and
+    for truncated or corrupt ones, after yielding the records before the
+    damage.
+    """
+    count = 0
+    with open(path, 'rb') as f:
+        lines = _lines(f)
+        try:
+            try:
+                header = json.loads(next(lines))
+            except (StopIteration, ValueError, zlib.error):
+                raise SnapshotError('%s is not a certman snapshot' % path)
+            if not isinstance(header, dict) or header.get('snapshot') != FORMAT_VERSION:
+                raise SnapshotError('%s is not a version %s certman snapshot' % (path, FORMAT_VERSION))
+
+            for line in lines:
+                record = json.loads(line)
+                if 'snapshot_end' in record:
+                    if record['certificates'] != count:
+                        raise SnapshotError('%s holds %s certificates, %s expected'
+                                            % (path, count, record['certificates']))
+                    return
+                count += 1
+                yield Certificate(record['email'], record['password'], record['questions'],
+                                  record['enrollment_id'], parse_date(record['date_obtained'])), \
+                    record.get('archived', False), record.get('id')
+        except (zlib.error, ValueError, KeyError) as e:
+            if isinstance(e, SnapshotError):
+                raise
+            raise SnapshotError('%s is corrupt after %s certificates: %s' % (path, count, e))
+    raise SnapshotError('%s is truncated after %s certificates' % (path, count))
+
+
+@timed('snapshot.restore', rows=lambda count: count)
+def restore_snapshot(db_storage, file_storage, path, chunk_size=CHUNK_SIZE, workers=8):
+    """
+    Loads the snapshot at ``path`` into an empty DB and writes the store
+    entries, returns how many certificates were restored. Rows are bulk
+    inserted in a single transaction, so a failed restore leaves the DB
+    empty; store entries already there are kept, so it can just be run
+    again. Entries aren't synced one by one, ``verify --repair`` rewrites
+    any lost to a crash after the rows commit.
+    """
+    if not db_storage.is_empty():
+        raise SnapshotError('Snapshots are only restored into an empty DB')
+    db_storage.attach_archive()
+
+    count = 0
+    db_storage.begin()
+    try:
+        chunk = []
+        for certificate, archived, row_id in read_snapshot(path):
+            # Older snapshots get IDs in file order, unique across tiers
+            chunk.append((certificate, archived, row_id or count + len(chunk) + 1))
+            if len(chunk) >= chunk_size:
+                count += _restore_chunk(db_storage, file_storage, chunk, workers)
+                chunk = []
+        count += _restore_chunk(db_storage, file_storage, chunk, workers)
+        db_storage.commit()
+    except:
+        db_storage.rollback()
+        raise
+    return count
+
+
+def _restore_chunk(db_storage, file_storage, chunk, workers):
+    certificates = [certificate for certificate, _, _ in chunk]
+    file_storage.save_many(certificates, workers)
+    for tier in (False, True):
+        rows = [(certificate, row_id) for certificate, archived, row_id in chunk if archived == tier]
+        if rows:
+            db_storage.save_many([certificate for certificate, _ in rows], commit=False, archived=tier,
+                                 ids=[row_id for _, row_id in rows])
+    return len(chunk)
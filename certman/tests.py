@@ -1,15 +1,38 @@
 #!coding: utf-8
 import unittest
 import datetime
+import errno
+import gzip
 import tempfile
 import shutil
+import sqlite3
 import os
+import time
+import json
+import multiprocessing
+import random
+import StringIO
+import sys
 import yaml
 
 from freezegun import freeze_time
 
 from certman.manager import Certificate, CertificateFileStorage, \
- CertificateDBStorage, Reporter, Manager, get_current_week
+ CertificateDBStorage, CertificateExists, Reporter, Manager, Importer, get_current_week
+from certman import benchmarks, cli
+from certman.asyncstorage import AsyncCertificateDBStorage, AsyncCertificateFileStorage, AsyncManager, Future
+from certman.benchmarks.data import generate_certificates
+from certman.benchmarks.scenarios import Workspace, concurrent_writes
+from certman.formats import read_csv, read_ndjson, read_yaml, write_table
+from certman.instrument import INSTRUMENTATION, profile_call, timed
+from certman.membership import EmailFilter
+from certman.packstore import CertificatePackStorage, StoreLocked
+from certman import schema
+from certman.schema import MIGRATIONS, current_version, migrate
+from certman.settings import SETTINGS, SettingsError, require
+from certman.snapshot import SnapshotError, read_snapshot, restore_snapshot, write_snapshot
+from certman.verify import Verifier
+from certman.writebehind import WriteBehindStorage
 
 class TestCertificate(unittest.TestCase):
     def test_certificate_should_bound(self):
@@ -72,6 +95,15 @@ class TestCertificate(unittest.TestCase):
 
         self.assertFalse(bad_certificate.is_bound())
 
+    def test_certificate_should_have_no_instance_dict(self):
+        certificate = Certificate(email='someemail@mail.ru')
+
+        self.assertFalse(hasattr(certificate, '__dict__'))
+        self.assertEqual(sorted(certificate.as_dict()),
+                         ['date_obtained', 'email', 'enrollment_id', 'password', 'questions'])
+        self.assertEqual(certificate, Certificate(email='someemail@mail.ru'))
+        self.assertNotEqual(certificate, Certificate(email='other@mail.ru'))
+
 
 class TestUtils(unittest.TestCase):
     @freeze_time("2016-01-07")
@@ -143,6 +175,19 @@ class TestCertificateFileStorage(unittest.TestCase):
         storage.delete(certificate.email)
         self.assertFalse(os.path.isdir(os.path.join(self.store_path, 'testemail@mail.ru')))
 
+    def test_should_delete_many_dirs_concurrently(self):
+        # Given
+        storage = CertificateFileStorage(store_path=self.store_path, shard_levels=2)
+        for i in range(20):
+            storage.save(Certificate(email='user%s@mail.ru' % i))
+
+        # When
+        deleted = list(storage.delete_many(['user%s@mail.ru' % i for i in range(10)] + ['missing@mail.ru'], workers=4))
+
+        # Then
+        self.assertEqual(sorted(deleted), sorted('user%s@mail.ru' % i for i in range(10)))
+        self.assertEqual(sorted(storage.iter_emails()), sorted('user%s@mail.ru' % i for i in range(10, 20)))
+
     def test_check_exist_should_be_true(self):
         # Given
         storage = CertificateFileStorage(store_path=self.store_path)
@@ -178,13 +223,252 @@ class TestCertificateFileStorage(unittest.TestCase):
         storage.delete(certificate.email)
         self.assertFalse(storage.check_exist(certificate))
 
+    def test_should_load_saved_certificate(self):
+        # Given
+        storage = CertificateFileStorage(store_path=self.store_path)
+        certificate = self.createValidCertificate()
+
+        # When
+        storage.save(certificate)
+
+        # Then
+        self.assertEqual(storage.load(certificate.email), certificate)
+        self.assertIsNone(storage.load('missing@mail.ru'))
+
+    def test_should_save_and_load_with_json_codec(self):
+        # Given
+        storage = CertificateFileStorage(store_path=self.store_path, codec='json')
+        certificate = self.createValidCertificate()
+
+        # When
+        storage.save(certificate)
+
+        # Then
+        path = os.path.join(self.store_path, 'testemail@mail.ru', 'credentials.json')
+        with open(path) as f:
+            self.assertEqual(json.load(f)['certificate']['email'], 'testemail@mail.ru')
+        self.assertEqual(storage.load(certificate.email), certificate)
+        self.assertEqual(CertificateFileStorage(store_path=self.store_path).load(certificate.email), certificate)
+
+    def test_should_iterate_over_all_certificates(self):
+        # Given
+        flat = CertificateFileStorage(store_path=self.store_path)
+        flat.save(Certificate(email='flat@mail.ru', password='p', enrollment_id='1', questions=['a']))
+        storage = CertificateFileStorage(store_path=self.store_path, shard_levels=2)
+        for i in range(10):
+            storage.save(Certificate(email='user%s@mail.ru' % i, password='p', enrollment_id='1', questions=['a']))
+
+        # When
+        certificates = list(storage.iter_all(workers=3, chunksize=2))
+
+        # Then
+        self.assertEqual(sorted(c.email for c in certificates),
+                         ['flat@mail.ru'] + ['user%s@mail.ru' % i for i in range(10)])
+
+
+class TestShardedCertificateFileStorage(unittest.TestCase):
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def createCertificate(self, email):
+        return Certificate(email=email, password='pass', enrollment_id='1', questions=['a'])
+
+    def test_should_save_into_hash_prefix_directories(self):
+        # Given
+        storage = CertificateFileStorage(store_path=self.store_path, shard_levels=2)
+        certificate = self.createCertificate('testemail@mail.ru')
+
+        # When
+        storage.save(certificate)
+
+        # Then
+        path = storage.sharded_path('testemail@mail.ru')
+        self.assertEqual(len(os.path.relpath(path, self.store_path).split(os.sep)), 3)
+        self.assertTrue(os.path.isfile(os.path.join(path, 'credentials.yaml')))
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, 'testemail@mail.ru')))
+        self.assertTrue(storage.check_exist(certificate))
+        storage.delete(certificate.email)
+        self.assertFalse(storage.check_exist(certificate))
+
+    def test_should_migrate_flat_store_and_resume(self):
+        # Given
+        flat = CertificateFileStorage(store_path=self.store_path)
+        for i in range(5):
+            flat.save(self.createCertificate('user%s@mail.ru' % i))
+        storage = CertificateFileStorage(store_path=self.store_path, shard_levels=2)
+        migration = storage.migrate_layout()
+
+        # When
+        moved = [next(migration), next(migration)]
+
+        # Then
+        self.assertTrue(all(storage.check_exist(self.createCertificate('user%s@mail.ru' % i)) for i in range(5)))
+        self.assertTrue(storage.legacy_fallback)
+
+        # When
+        resumed = CertificateFileStorage(store_path=self.store_path, shard_levels=2)
+        moved += list(resumed.migrate_layout())
+
+        # Then
+        self.assertEqual(sorted(moved), ['user%s@mail.ru' % i for i in range(5)])
+        self.assertFalse(resumed.legacy_fallback)
+        self.assertFalse(CertificateFileStorage(store_path=self.store_path, shard_levels=2).legacy_fallback)
+        for i in range(5):
+            self.assertTrue(os.path.isdir(resumed.sharded_path('user%s@mail.ru' % i)))
+            self.assertFalse(os.path.exists(os.path.join(self.store_path, 'user%s@mail.ru' % i)))
+
+    def test_should_not_copy_flat_entries_before_migration(self):
+        # Given
+        flat = CertificateFileStorage(store_path=self.store_path)
+        flat.save(self.createCertificate('user0@mail.ru'))
+        storage = CertificateFileStorage(store_path=self.store_path, shard_levels=2)
+
+        # When
+        written = storage.save_many([self.createCertificate('user0@mail.ru'), self.createCertificate('user1@mail.ru')])
+
+        # Then
+        self.assertEqual(written, 1)
+        self.assertFalse(os.path.exists(storage.sharded_path('user0@mail.ru')))
+        self.assertRaises(OSError, storage.save, self.createCertificate('user0@mail.ru'))
+
+    def test_migration_should_drop_flat_copies_of_sharded_entries(self):
+        # Given
+        flat = CertificateFileStorage(store_path=self.store_path)
+        flat.save(self.createCertificate('user0@mail.ru'))
+        sharded = CertificateFileStorage(store_path=self.store_path, shard_levels=2)
+        sharded.legacy_fallback = False
+        sharded.save(self.createCertificate('user0@mail.ru'))
+        flat.save(self.createCertificate('user1@mail.ru'))
+        storage = CertificateFileStorage(store_path=self.store_path, shard_levels=2)
+
+        # When
+        moved = list(storage.migrate_layout())
+
+        # Then
+        self.assertEqual(moved, ['user1@mail.ru'])
+        self.assertEqual(sorted(storage.iter_emails()), ['user0@mail.ru', 'user1@mail.ru'])
+        self.assertFalse(os.path.exists(os.path.join(self.store_path, 'user0@mail.ru')))
+
+
+class TestCertificatePackStorage(unittest.TestCase):
+    def setUp(self):
+        self.store_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.store_path)
+
+    def createCertificate(self, email):
+        return Certificate(email=email, password='pass', enrollment_id='1', questions=['answer1', 'answer2'],
+                           date_obtained=datetime.date(2016, 1, 7))
+
+    def test_should_save_load_and_delete(self):
+        # Given
+        storage = CertificatePackStorage(self.store_path)
+        certificate = self.createCertificate('testemail@mail.ru')
+
+        # When
+        storage.save(certificate)
+
+        # Then
+        self.assertTrue(storage.check_exist(certificate))
+        self.assertEqual(storage.load('testemail@mail.ru'), certificate)
+        storage.delete(certificate.email)
+        self.assertFalse(storage.check_exist(certificate))
+        self.assertIsNone(storage.load('testemail@mail.ru'))
+
+    def test_should_reopen_and_recover_unindexed_records(self):
+        # Given
+        storage = CertificatePackStorage(self.store_path, segment_size=200)
+        for i in range(5):
+            storage.save(self.createCertificate('user%s@mail.ru' % i))
+        storage.delete('user1@mail.ru')
+        storage.close()
+
+        # When the index lost its last entries and the segment has a torn tail
+        index_path = os.path.join(self.store_path, CertificatePackStorage.INDEX_NAME)
+        with open(index_path, 'r+b') as f:
+            f.truncate(os.path.getsize(index_path) - 20)
+        segment = sorted(os.listdir(self.store_path))[-1]
+        with open(os.path.join(self.store_path, segment), 'ab') as f:
+            f.write('garbage')
+        reopened = CertificatePackStorage(self.store_path, segment_size=200)
+
+        # Then
+        self.assertEqual(sorted(reopened.index), ['user0@mail.ru', 'user2@mail.ru', 'user3@mail.ru', 'user4@mail.ru'])
+        self.assertEqual(reopened.load('user4@mail.ru').email, 'user4@mail.ru')
+        reopened.save(self.createCertificate('user5@mail.ru'))
+        self.assertEqual(reopened.load('user5@mail.ru').email, 'user5@mail.ru')
+
+    def test_should_iterate_over_records_of_any_codec(self):
+        # Given
+        CertificatePackStorage(self.store_path).save(self.createCertificate('yaml@mail.ru'))
+        storage = CertificatePackStorage(self.store_path, codec='json')
+        storage.save(self.createCertificate('json@mail.ru'))
+
+        # When
+        certificates = list(storage.iter_all())
+
+        # Then
+        self.assertEqual(certificates, [self.createCertificate('yaml@mail.ru'), self.createCertificate('json@mail.ru')])
+
+    def test_compaction_should_reclaim_space(self):
+        # Given
+        storage = CertificatePackStorage(self.store_path, segment_size=1000)
+        for i in range(20):
+            storage.save(self.createCertificate('user%s@mail.ru' % i))
+        for i in range(15):
+            storage.delete('user%s@mail.ru' % i)
+
+        # When
+        reclaimed = storage.compact()
+
+        # Then
+        self.assertTrue(reclaimed > 0)
+        storage.close()
+        reopened = CertificatePackStorage(self.store_path, segment_size=1000)
+        self.assertEqual(sorted(reopened.index), ['user%s@mail.ru' % i for i in range(15, 20)])
+        self.assertEqual(reopened.load('user17@mail.ru'), self.createCertificate('user17@mail.ru'))
+
+    def test_store_should_be_locked_by_one_process(self):
+        # Given
+        storage = CertificatePackStorage(self.store_path)
+
+        def open_store():
+            try:
+                CertificatePackStorage(self.store_path)
+            except StoreLocked:
+                sys.exit(3)
+        process = multiprocessing.Process(target=open_store)
+
+        # When
+        process.start()
+        process.join()
+
+        # Then
+        self.assertEqual(process.exitcode, 3)
+        self.assertRaises(StoreLocked, CertificatePackStorage, self.store_path)
+        storage.close()
+        CertificatePackStorage(self.store_path).close()
+
 
 class TestCertificateDBStorage(unittest.TestCase):
     def setUp(self):
-        _, self.db_file = tempfile.mkstemp()
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        self.storages = []
 
     def tearDown(self):
-        os.remove(self.db_file)
+        for storage in self.storages:
+            storage.close()
+        shutil.rmtree(self.path)
+
+    def createStorage(self, **options):
+        storage = CertificateDBStorage(self.db_file, **options)
+        self.storages.append(storage)
+        return storage
 
     def createValidCertificate(self, email=None, date_obtained=None):
         return Certificate(email=email or 'testemail@mail.ru',
@@ -197,7 +481,7 @@ class TestCertificateDBStorage(unittest.TestCase):
     @freeze_time("2016-01-07")
     def test_should_save_certificate_credentials(self):
         # Given
-        storage = CertificateDBStorage(self.db_file)
+        storage = self.createStorage()
         certificate = self.createValidCertificate()
 
         # When
@@ -225,7 +509,7 @@ class TestCertificateDBStorage(unittest.TestCase):
 
     def test_check_exist_should_be_true(self):
         # Given
-        storage = CertificateDBStorage(self.db_file)
+        storage = self.createStorage()
         certificate = self.createValidCertificate()
 
         # When
@@ -236,7 +520,7 @@ class TestCertificateDBStorage(unittest.TestCase):
 
     def test_check_exist_should_be_false(self):
         # Given
-        storage = CertificateDBStorage(self.db_file)
+        storage = self.createStorage()
         certificate = self.createValidCertificate()
 
         # When
@@ -247,7 +531,7 @@ class TestCertificateDBStorage(unittest.TestCase):
 
     def test_should_delete_certificate(self):
         # Given
-        storage = CertificateDBStorage(self.db_file)
+        storage = self.createStorage()
         certificate = self.createValidCertificate()
 
         # When
@@ -259,9 +543,65 @@ class TestCertificateDBStorage(unittest.TestCase):
         # Then
         self.assertFalse(storage.check_exist(certificate))
 
+    def test_should_delete_many_by_emails_and_date_range(self):
+        # Given
+        storage = self.createStorage(cache_size=10)
+        for day in range(1, 6):
+            storage.save(self.createValidCertificate('day%s@mail.ru' % day, datetime.date(2016, 1, day)))
+        storage.get_by_email('day1@mail.ru')
+
+        # When
+        counted = storage.delete_many(start=datetime.date(2016, 1, 1), end=datetime.date(2016, 1, 2), dry_run=True)
+        by_range = storage.delete_many(start=datetime.date(2016, 1, 1), end=datetime.date(2016, 1, 2))
+        by_email = storage.delete_many(emails=iter(['day3@mail.ru', 'missing@mail.ru']))
+
+        # Then
+        self.assertEqual(sorted(counted), ['day1@mail.ru', 'day2@mail.ru'])
+        self.assertEqual(sorted(by_range), ['day1@mail.ru', 'day2@mail.ru'])
+        self.assertEqual(by_email, ['day3@mail.ru'])
+        self.assertIsNone(storage.get_by_email('day1@mail.ru'))
+        self.assertEqual(sorted(storage.iter_emails()), ['day4@mail.ru', 'day5@mail.ru'])
+        self.assertEqual(storage.count_by_date(datetime.date(2016, 1, 1), datetime.date(2016, 1, 5)), 2)
+        self.assertRaises(ValueError, storage.delete_many)
+
+    def test_should_store_values_with_quotes(self):
+        # Given
+        storage = self.createStorage()
+        certificate = self.createValidCertificate(email="o'neil@mail.ru")
+        certificate.password = "pass'word"
+
+        # When
+        storage.save(certificate)
+
+        # Then
+        self.assertTrue(storage.check_exist(certificate))
+        self.assertEqual(storage.get_by_email("o'neil@mail.ru").password, "pass'word")
+
+    def test_should_keep_answers_with_quotes(self):
+        # Given
+        storage = self.createStorage()
+        certificate = self.createValidCertificate()
+        certificate.questions = ['He said "yes"', '', 'line\nbreak']
+
+        # When
+        storage.save(certificate)
+
+        # Then
+        self.assertEqual(storage.get_by_email(certificate.email).questions, certificate.questions)
+
+    def test_should_open_database_in_wal_mode(self):
+        # Given
+        storage = self.createStorage()
+
+        # When
+        journal_mode = storage.conn.execute('PRAGMA journal_mode;').fetchone()[0]
+
+        # Then
+        self.assertEqual(journal_mode, 'wal')
+
     def test_should_select_all_certificates_by_date(self):
         # Given
-        storage = CertificateDBStorage(self.db_file)
+        storage = self.createStorage()
         certificate1 = self.createValidCertificate(email='first@mail.ru')
         certificate2 = self.createValidCertificate(email='second@mail.ru')
 
@@ -276,7 +616,7 @@ class TestCertificateDBStorage(unittest.TestCase):
 
     def test_should_select_zero_certificates_by_date(self):
         # Given
-        storage = CertificateDBStorage(self.db_file)
+        storage = self.createStorage()
         certificate1 = self.createValidCertificate(email='first@mail.ru')
         certificate2 = self.createValidCertificate(email='second@mail.ru')
 
@@ -298,7 +638,1674 @@ class TestCertificateDBStorage(unittest.TestCase):
 
 
 
+class TestSearch(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        self.storages = []
+        self.search_indexes = schema.SEARCH_INDEXES
+
+    def tearDown(self):
+        schema.SEARCH_INDEXES = self.search_indexes
+        for storage in self.storages:
+            storage.close()
+        shutil.rmtree(self.path)
+
+    def createStorage(self):
+        storage = CertificateDBStorage(self.db_file)
+        self.storages.append(storage)
+        storage.save(Certificate(email='john.doe@mail.ru', password='p', enrollment_id='ENR0042',
+                                 questions=['blue', 'Rex']))
+        storage.save(Certificate(email='jane@doe.com', password='p', enrollment_id='ENR0043',
+                                 questions=['red', 'Max']))
+        return storage
+
+    def test_should_find_by_partial_email_enrollment_and_answer(self):
+        # Given
+        storage = self.createStorage()
+
+        # Then
+        self.assertEqual(storage.search_kind, 'fts5')
+        self.assertEqual([c.email for c in storage.search('john')], ['john.doe@mail.ru'])
+        self.assertEqual(sorted(c.email for c in storage.search('do')), ['jane@doe.com', 'john.doe@mail.ru'])
+        self.assertEqual([c.email for c in storage.search('ENR0043')], ['jane@doe.com'])
+        self.assertEqual([c.email for c in storage.search('doe rex')], ['john.doe@mail.ru'])
+        self.assertEqual(storage.search('"OR john'), [])
+
+    def test_should_paginate_results(self):
+        # Given
+        storage = self.createStorage()
+
+        # When
+        pages = [storage.search('do', limit=1, offset=offset) for offset in range(3)]
+
+        # Then
+        self.assertEqual(sorted(page[0].email for page in pages[:2]), ['jane@doe.com', 'john.doe@mail.ru'])
+        self.assertEqual(pages[2], [])
+
+    def test_index_should_follow_deletes(self):
+        # Given
+        storage = self.createStorage()
+
+        # When
+        storage.delete('john.doe@mail.ru')
+        storage.delete_many(emails=['jane@doe.com'])
+
+        # Then
+        self.assertEqual(storage.search('doe'), [])
+
+    def test_should_fall_back_to_fts4_prefix_index(self):
+        # Given
+        schema.SEARCH_INDEXES = self.search_indexes[1:]
+
+        # When
+        storage = self.createStorage()
+
+        # Then
+        self.assertEqual(storage.search_kind, 'fts4')
+        self.assertEqual([c.email for c in storage.search('ja')], ['jane@doe.com'])
+        self.assertEqual([c.email for c in storage.search('do', limit=1)], ['jane@doe.com'])
+
+
+class TestArchive(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        self.archive_file = os.path.join(self.path, 'archive.db')
+        self.storages = []
+        storage = self.createStorage()
+        for day in range(1, 11):
+            storage.save(Certificate(email='day%s@mail.ru' % day, password='p', enrollment_id=str(day),
+                                     questions=['a'], date_obtained=datetime.date(2016, 1, day)))
+        self.ids = dict((email, id_num) for id_num, email in storage.conn.execute('SELECT id, email FROM certificates;'))
+        storage.close()
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+        shutil.rmtree(self.path)
+
+    def createStorage(self):
+        storage = CertificateDBStorage(self.db_file, archive=self.archive_file)
+        self.storages.append(storage)
+        return storage
+
+    def test_should_move_old_rows_and_still_read_both_tiers(self):
+        # Given
+        storage = self.createStorage()
+
+        # When
+        moved = storage.archive_before(datetime.date(2016, 1, 6))
+        storage.close()
+        storage = self.createStorage()
+
+        # Then
+        self.assertEqual(moved, 5)
+        self.assertEqual(storage.conn.execute('SELECT COUNT(*) FROM main.certificates;').fetchone()[0], 5)
+        self.assertEqual(storage.archived_until, datetime.date(2016, 1, 5))
+        self.assertEqual(storage.get_by_email('day2@mail.ru').date_obtained, datetime.date(2016, 1, 2))
+        self.assertEqual(storage.get_by_id(self.ids['day3@mail.ru']).email, 'day3@mail.ru')
+        self.assertTrue(storage.check_exist(Certificate(email='day4@mail.ru')))
+        self.assertEqual([c.email for c in storage.get_by_date(datetime.date(2016, 1, 4), datetime.date(2016, 1, 7))],
+                         ['day4@mail.ru', 'day5@mail.ru', 'day6@mail.ru', 'day7@mail.ru'])
+        self.assertEqual(storage.count_by_date(datetime.date(2016, 1, 1), datetime.date(2016, 1, 31)), 10)
+        self.assertEqual(storage.count_by_period('month', datetime.date(2016, 1, 1), datetime.date(2016, 1, 31)),
+                         [('2016-01', 10)])
+        self.assertEqual(list(storage.iter_emails()), sorted('day%s@mail.ru' % day for day in range(1, 11)))
+
+    def test_archived_emails_should_stay_unique_and_deletable(self):
+        # Given
+        storage = self.createStorage()
+        storage.archive_before(datetime.date(2016, 1, 6))
+
+        # When
+        self.assertRaises(sqlite3.IntegrityError, storage.save, Certificate(email='day1@mail.ru'))
+        storage.delete('day1@mail.ru')
+        deleted = storage.delete_many(start=datetime.date(2016, 1, 5), end=datetime.date(2016, 1, 6))
+
+        # Then
+        self.assertEqual(sorted(deleted), ['day5@mail.ru', 'day6@mail.ru'])
+        self.assertIsNone(storage.get_by_email('day1@mail.ru'))
+        self.assertEqual(storage.count_by_date(datetime.date(2016, 1, 1), datetime.date(2016, 1, 31)), 7)
+
+    def test_interrupted_move_should_be_finished_by_next_run(self):
+        # Given
+        storage = self.createStorage()
+        storage.archive_before(datetime.date(2016, 1, 2))
+        storage.conn.execute("INSERT INTO archive.certificates SELECT * FROM certificates WHERE when_added < '2016-01-04';")
+        storage.commit()
+
+        # When
+        moved = storage.archive_before(datetime.date(2016, 1, 4))
+
+        # Then
+        self.assertEqual(moved, 2)
+        self.assertEqual(list(storage.iter_emails()), sorted('day%s@mail.ru' % day for day in range(1, 11)))
+
+    def test_hot_only_queries_should_skip_archive(self):
+        # Given
+        storage = self.createStorage()
+        storage.archive_before(datetime.date(2016, 1, 6))
+
+        # Then
+        self.assertEqual(storage._schemas(datetime.date(2016, 1, 6)), ('',))
+        self.assertEqual(storage._schemas(datetime.date(2016, 1, 5)), ('', 'archive.'))
+
+    def test_ids_should_not_be_reused_once_everything_is_archived(self):
+        # Given
+        storage = self.createStorage()
+        storage.archive_before(datetime.date(2016, 2, 1))
+        storage.save(Certificate(email='late@mail.ru', password='p', enrollment_id='11', questions=['a'],
+                                 date_obtained=datetime.date(2012, 1, 1)))
+
+        # When
+        moved = storage.archive_before(datetime.date(2016, 2, 1))
+
+        # Then
+        self.assertEqual(moved, 1)
+        self.assertEqual(storage.conn.execute('SELECT COUNT(DISTINCT id) FROM archive.certificates;').fetchone()[0], 11)
+        self.assertEqual(storage.get_by_id(self.ids['day1@mail.ru']).email, 'day1@mail.ru')
+
+    def test_should_see_archiving_done_by_another_connection(self):
+        # Given
+        storage = self.createStorage()
+        storage.get_by_email('day1@mail.ru')
+        archiver = self.createStorage()
+
+        # When
+        archiver.archive_before(datetime.date(2016, 1, 6))
+        archiver.close()
+
+        # Then
+        self.assertEqual(storage.get_by_email('day2@mail.ru').enrollment_id, '2')
+        self.assertEqual(storage.count_by_date(datetime.date(2016, 1, 1), datetime.date(2016, 1, 31)), 10)
+        self.assertRaises(CertificateExists, storage.save, Certificate(email='day3@mail.ru', password='p',
+                                                                      enrollment_id='3', questions=['a']))
+
+    def test_archive_should_be_created_by_archiving_without_search_and_log(self):
+        # Given
+        storage = self.createStorage()
+        self.assertFalse(os.path.exists(self.archive_file))
+
+        # When
+        storage.archive_before(datetime.date(2016, 1, 6))
+
+        # Then
+        tables = [row[0] for row in storage.conn.execute("SELECT name FROM archive.sqlite_master WHERE type='table';")]
+        self.assertIn('certificate_counts', tables)
+        self.assertNotIn('certificate_changes', tables)
+        self.assertFalse([table for table in tables if table.startswith('certificates_search')])
+
+    def test_archives_created_with_the_whole_schema_should_be_stripped(self):
+        # Given
+        conn = sqlite3.connect(self.archive_file)
+        migrate(conn)
+        conn.close()
+
+        # When
+        storage = self.createStorage()
+
+        # Then
+        tables = [row[0] for row in storage.conn.execute("SELECT name FROM archive.sqlite_master WHERE type='table';")]
+        self.assertNotIn('certificate_changes', tables)
+        self.assertNotIn('certificates_search', tables)
+        self.assertEqual(storage.archive_before(datetime.date(2016, 1, 6)), 5)
+
+    def test_vacuum_should_merge_the_search_index(self):
+        # Given
+        storage = self.createStorage()
+        if storage.search_kind is None:
+            self.skipTest('This SQLite build has no full-text search')
+        table = 'certificates_search_data' if storage.search_kind == 'fts5' else 'certificates_search_segments'
+        storage.save_many(Certificate(email='old%s@mail.ru' % i, password='p', enrollment_id=str(i),
+                                      questions=['answer %s' % i], date_obtained=datetime.date(2015, 6, 1))
+                          for i in range(500))
+        storage.archive_before(datetime.date(2016, 1, 6))
+        size = 'SELECT SUM(LENGTH(block)) FROM %s;' % table
+        archived_size = storage.conn.execute(size).fetchone()[0]
+
+        # When
+        storage.vacuum()
+
+        # Then
+        self.assertLess(storage.conn.execute(size).fetchone()[0] * 4, archived_size)
+        self.assertEqual([c.email for c in storage.search('day9')], ['day9@mail.ru'])
+
+    def test_upgrade_should_keep_ids_and_search(self):
+        # Given
+        path = os.path.join(self.path, 'legacy.db')
+        conn = sqlite3.connect(path)
+        migrate(conn, [migration for migration in MIGRATIONS if migration[0] < 8])
+        conn.execute("INSERT INTO certificates VALUES (5, '2016-01-07', 'legacy@mail.ru', 'p', '1', '[\"x\"]');")
+        conn.commit()
+        conn.close()
+
+        # When
+        storage = CertificateDBStorage(path)
+        storage.save(Certificate(email='new@mail.ru', password='p', enrollment_id='2', questions=['a']))
+
+        # Then
+        self.assertEqual(storage.get_by_id(5).email, 'legacy@mail.ru')
+        self.assertEqual([c.email for c in storage.search('legacy')], ['legacy@mail.ru'])
+        self.assertEqual(storage.get_by_id(6).email, 'new@mail.ru')
+        self.assertEqual(storage.count_by_date(datetime.date(2016, 1, 7), datetime.date(2016, 1, 7)), 1)
+        storage.close()
+
+
+class TestChangeLog(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = CertificateDBStorage(os.path.join(self.path, 'certman.db'))
+        self.storage.save(Certificate(email='first@mail.ru', password='p', enrollment_id='1', questions=['a'],
+                                      date_obtained=datetime.date(2016, 1, 4)))
+        self.storage.save_many([Certificate(email='second@mail.ru', password='p', enrollment_id='2', questions=['b']),
+                                Certificate(email='third@mail.ru', password='p', enrollment_id='3', questions=['c'])])
+        self.storage.delete('first@mail.ru')
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.path)
+
+    def test_should_log_inserts_and_deletes_in_order(self):
+        # When
+        changes = list(self.storage.changes())
+
+        # Then
+        self.assertEqual([(c.seq, c.op, c.email) for c in changes],
+                         [(1, 'insert', 'first@mail.ru'), (2, 'insert', 'second@mail.ru'),
+                          (3, 'insert', 'third@mail.ru'), (4, 'delete', 'first@mail.ru')])
+        self.assertIsNone(changes[0].certificate)
+        self.assertEqual(changes[1].certificate.questions, ['b'])
+        self.assertIsNone(changes[3].certificate)
+        self.assertEqual([c.seq for c in self.storage.changes(since=2, limit=1)], [3])
+        self.assertEqual(self.storage.last_change(), 4)
+
+    def test_failed_writes_should_leave_no_changes(self):
+        # When
+        self.assertRaises(sqlite3.IntegrityError, self.storage.save, Certificate(email='second@mail.ru'))
+        self.storage.delete_many(emails=['second@mail.ru'], dry_run=True)
+        self.storage.delete_many(emails=['second@mail.ru', 'third@mail.ru'])
+
+        # Then
+        self.assertEqual([(c.seq, c.op) for c in self.storage.changes(since=4)], [(5, 'delete'), (6, 'delete')])
+
+    def test_replica_should_apply_only_new_changes(self):
+        # Given
+        replica = CertificateDBStorage(os.path.join(self.path, 'replica.db'))
+
+        # When
+        first = replica.replicate_from(self.storage, 'primary', batch_size=3)
+        self.storage.delete('second@mail.ru')
+        self.storage.save(Certificate(email='first@mail.ru', password='new', enrollment_id='4', questions=['d']))
+        second = replica.replicate_from(self.storage, 'primary')
+
+        # Then
+        self.assertEqual((first, second), (4, 2))
+        self.assertEqual(replica.replication_position('primary'), 6)
+        self.assertEqual(list(replica.iter_emails()), ['first@mail.ru', 'third@mail.ru'])
+        self.assertEqual(replica.get_by_email('first@mail.ru').password, 'new')
+        self.assertEqual(replica.count_by_date(datetime.date(2016, 1, 1), datetime.date.today()), 2)
+        self.assertEqual(replica.replicate_from(self.storage, 'primary'), 0)
+        replica.close()
+
+    def test_existing_rows_should_be_logged_on_upgrade(self):
+        # Given
+        path = os.path.join(self.path, 'legacy.db')
+        conn = sqlite3.connect(path)
+        migrate(conn, [migration for migration in MIGRATIONS if migration[0] < 7])
+        conn.execute("INSERT INTO certificates VALUES (NULL, '2016-01-07', 'a@mail.ru', 'p1', '1', '[\"x\"]');")
+        conn.commit()
+        conn.close()
+
+        # When
+        storage = CertificateDBStorage(path)
+
+        # Then
+        self.assertEqual([(c.op, c.email, c.certificate.questions) for c in storage.changes()],
+                         [('insert', 'a@mail.ru', ['x'])])
+        storage.close()
 
+    def test_log_should_keep_keys_only(self):
+        # When
+        columns = [row[1] for row in self.storage.conn.execute('PRAGMA table_info(certificate_changes);')]
+
+        # Then
+        self.assertEqual(columns, ['seq', 'op', 'email', 'changed_at'])
+
+    def test_full_row_log_should_be_slimmed_on_upgrade(self):
+        # Given
+        path = os.path.join(self.path, 'legacy.db')
+        conn = sqlite3.connect(path)
+        migrate(conn, [migration for migration in MIGRATIONS if migration[0] < 7])
+        conn.executescript('''
+            CREATE TABLE certificate_changes (seq integer primary key autoincrement, op text not null,
+                when_added date, email text not null, password text, enrollment_id text, questions text,
+                changed_at text not null default (datetime('now', 'localtime')));
+            CREATE TABLE replication_state (source text primary key, seq integer not null);
+            INSERT INTO schema_migrations VALUES (7, 'log certificate changes', NULL);
+            INSERT INTO certificates VALUES (NULL, '2016-01-07', 'a@mail.ru', 'p1', '1', '["x"]');
+            INSERT INTO certificate_changes (op, when_added, email, password, enrollment_id, questions)
+                VALUES ('insert', '2016-01-07', 'b@mail.ru', 'p2', '2', '["y"]');
+            INSERT INTO certificate_changes (op, email) VALUES ('delete', 'b@mail.ru');
+            INSERT INTO certificate_changes (op, when_added, email, password, enrollment_id, questions)
+                VALUES ('insert', '2016-01-07', 'a@mail.ru', 'p1', '1', '["x"]');
+            DELETE FROM certificate_changes WHERE seq = 3;
+        ''')
+        conn.close()
+
+        # When
+        storage = CertificateDBStorage(path)
+        storage.save(Certificate(email='c@mail.ru'))
+
+        # Then
+        columns = [row[1] for row in storage.conn.execute('PRAGMA table_info(certificate_changes);')]
+        self.assertEqual(columns, ['seq', 'op', 'email', 'changed_at'])
+        self.assertEqual([(c.seq, c.op, c.email) for c in storage.changes()],
+                         [(1, 'insert', 'b@mail.ru'), (2, 'delete', 'b@mail.ru'), (4, 'insert', 'c@mail.ru')])
+        storage.close()
+
+    def test_changes_should_read_archived_certificates(self):
+        # Given
+        storage = CertificateDBStorage(os.path.join(self.path, 'tiered.db'),
+                                       archive=os.path.join(self.path, 'archive.db'))
+        storage.save(Certificate(email='old@mail.ru', password='p', date_obtained=datetime.date(2016, 1, 4)))
+        storage.save(Certificate(email='new@mail.ru', password='p'))
+        storage.archive_before(datetime.date(2016, 2, 1))
+
+        # When
+        changes = list(storage.changes())
+
+        # Then
+        self.assertEqual([(c.email, c.certificate.date_obtained) for c in changes],
+                         [('old@mail.ru', datetime.date(2016, 1, 4)), ('new@mail.ru', datetime.date.today())])
+        storage.close()
+
+    def test_pruning_should_keep_inserts_of_stored_rows(self):
+        # Given
+        self.storage.delete('second@mail.ru')
+
+        # When
+        pruned = self.storage.prune_changes(datetime.datetime.now() + datetime.timedelta(minutes=1))
+        replica = CertificateDBStorage(os.path.join(self.path, 'replica.db'))
+        replica.replicate_from(self.storage, 'primary')
+
+        # Then
+        self.assertEqual(pruned, 4)
+        self.assertEqual([(c.op, c.email) for c in self.storage.changes()], [('insert', 'third@mail.ru')])
+        self.assertEqual(list(replica.iter_emails()), ['third@mail.ru'])
+        self.assertEqual(self.storage.prune_changes(datetime.datetime.now() - datetime.timedelta(days=1)), 0)
+        replica.close()
+
+    def test_cli_should_write_changes_as_ndjson(self):
+        # Given
+        settings = dict(SETTINGS)
+        SETTINGS['db'] = os.path.join(self.path, 'certman.db')
+        out = StringIO.StringIO()
+
+        # When
+        try:
+            manager = Manager()
+            seq = manager.command_changes(since=2, out=out)
+            manager.close()
+        finally:
+            SETTINGS.update(settings)
+
+        # Then
+        records = [json.loads(line) for line in out.getvalue().splitlines()]
+        self.assertEqual(seq, 4)
+        self.assertEqual([(r['seq'], r['op']) for r in records], [(3, 'insert'), (4, 'delete')])
+        self.assertEqual(records[0]['certificate']['enrollment_id'], '3')
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.snapshot_file = os.path.join(self.path, 'snapshot.gz')
+        self.storage = self.createStorage('source')
+        for day in range(1, 11):
+            self.storage.save(Certificate(email=u'day%s@mail.ru' % day, password='p', enrollment_id=str(day),
+                                          questions=[u'a "quoted" \u0431'], date_obtained=datetime.date(2016, 1, day)))
+        self.storage.archive_before(datetime.date(2016, 1, 6))
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.path)
+
+    def createStorage(self, name):
+        return CertificateDBStorage(os.path.join(self.path, name + '.db'),
+                                    archive=os.path.join(self.path, name + '.archive.db'))
+
+    def test_should_restore_both_tiers_and_the_store(self):
+        # Given
+        written = write_snapshot(self.storage, self.snapshot_file, chunk_size=3)
+        restored_storage = self.createStorage('restored')
+        store = CertificateFileStorage(os.path.join(self.path, 'store'), shard_levels=1)
+        os.mkdir(store.store_path)
+
+        # When
+        restored = restore_snapshot(restored_storage, store, self.snapshot_file, chunk_size=4)
+
+        # Then
+        self.assertEqual((written, restored), (10, 10))
+        self.assertEqual(len(gzip.open(self.snapshot_file).read().splitlines()), 12)
+        self.assertEqual(sorted(row[1:] for row in restored_storage.iter_rows()),
+                         sorted(row[1:] for row in self.storage.iter_rows()))
+        self.assertEqual(restored_storage.conn.execute('SELECT COUNT(*) FROM main.certificates;').fetchone()[0], 5)
+        self.assertEqual(restored_storage.archived_until, datetime.date(2016, 1, 5))
+        self.assertEqual(restored_storage.get_by_email('day2@mail.ru'), self.storage.get_by_email('day2@mail.ru'))
+        self.assertEqual(restored_storage.count_by_date(datetime.date(2016, 1, 1), datetime.date(2016, 1, 31)), 10)
+        self.assertEqual(restored_storage.last_change(), 10)
+        self.assertEqual(store.load('day9@mail.ru'), self.storage.get_by_email('day9@mail.ru'))
+        self.assertEqual(len(list(store.iter_emails())), 10)
+        self.assertEqual(os.listdir(self.path).count('snapshot.gz'), 1)
+        restored_storage.close()
+
+    def test_restored_rows_should_keep_ids_and_archive_again(self):
+        # Given
+        write_snapshot(self.storage, self.snapshot_file)
+        restored_storage = self.createStorage('restored')
+        store = CertificateFileStorage(os.path.join(self.path, 'store'))
+        os.mkdir(store.store_path)
+        restore_snapshot(restored_storage, store, self.snapshot_file)
+
+        # When
+        restored_storage.save(Certificate(email='new@mail.ru', date_obtained=datetime.date(2016, 1, 8)))
+        moved = restored_storage.archive_before(datetime.date(2016, 1, 9))
+
+        # Then
+        self.assertEqual(moved, 4)
+        self.assertEqual(restored_storage.get_by_id(11).email, 'new@mail.ru')
+        self.assertEqual([restored_storage.get_by_id(i).email for i in range(1, 11)],
+                         [self.storage.get_by_id(i).email for i in range(1, 11)])
+        self.assertEqual(restored_storage.conn.execute('SELECT COUNT(*) FROM main.certificates;').fetchone()[0], 2)
+        restored_storage.close()
+
+    def test_should_reject_damaged_snapshots_and_full_dbs(self):
+        # Given
+        write_snapshot(self.storage, self.snapshot_file, chunk_size=3)
+        with open(self.snapshot_file, 'rb') as f:
+            data = f.read()
+        truncated_file = os.path.join(self.path, 'truncated.gz')
+        with open(truncated_file, 'wb') as f:
+            f.write(data[:len(data) // 2])
+        restored_storage = self.createStorage('restored')
+        store = CertificateFileStorage(self.path)
+
+        # Then
+        self.assertRaises(SnapshotError, restore_snapshot, restored_storage, store, truncated_file)
+        self.assertTrue(restored_storage.is_empty())
+        self.assertRaises(SnapshotError, list, read_snapshot(os.path.join(self.path, 'source.db')))
+        self.assertRaises(SnapshotError, restore_snapshot, self.storage, store, self.snapshot_file)
+        restored_storage.close()
+
+
+class TestVerifier(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        self.store_path = os.path.join(self.path, 'store')
+        os.mkdir(self.store_path)
+        self.db_storage = CertificateDBStorage(self.db_file)
+        self.file_storage = CertificateFileStorage(store_path=self.store_path, shard_levels=1)
+        for i in range(10):
+            certificate = self.createCertificate('user%s@mail.ru' % i)
+            self.db_storage.save(certificate)
+            self.file_storage.save(certificate)
+        # Drift: one row only in the DB, one entry only in the store
+        self.db_storage.save(self.createCertificate('dbonly@mail.ru'))
+        self.file_storage.save(self.createCertificate('storeonly@mail.ru'))
+
+    def tearDown(self):
+        self.db_storage.close()
+        shutil.rmtree(self.path)
+
+    def createCertificate(self, email):
+        return Certificate(email=email, password='pass', enrollment_id='1', questions=['a'])
+
+    def test_should_find_missing_and_orphaned_entries(self):
+        # Given
+        verifier = Verifier(self.db_storage, self.file_storage, run_size=3, workers=2)
+
+        # When
+        result = verifier.verify()
+
+        # Then
+        self.assertEqual(result.missing_in_store, ['dbonly@mail.ru'])
+        self.assertEqual(result.orphaned_in_store, ['storeonly@mail.ru'])
+        self.assertEqual(result.checked, 12)
+
+    def test_should_repair_by_restoring_orphans(self):
+        # Given
+        verifier = Verifier(self.db_storage, self.file_storage)
+
+        # When
+        verifier.repair(verifier.verify())
+
+        # Then
+        self.assertTrue(self.file_storage.check_exist(self.createCertificate('dbonly@mail.ru')))
+        self.assertTrue(self.db_storage.check_exist(self.createCertificate('storeonly@mail.ru')))
+        self.assertEqual(verifier.verify().issues, [])
+
+    def test_should_repair_by_deleting_orphans(self):
+        # Given
+        verifier = Verifier(self.db_storage, self.file_storage)
+
+        # When
+        verifier.repair(verifier.verify(), orphans='delete')
+
+        # Then
+        self.assertFalse(self.file_storage.check_exist(self.createCertificate('storeonly@mail.ru')))
+        self.assertFalse(self.db_storage.check_exist(self.createCertificate('storeonly@mail.ru')))
+        self.assertEqual(verifier.verify().issues, [])
+
+    def test_incremental_check_should_only_look_at_changes(self):
+        # Given
+        verifier = Verifier(self.db_storage, self.file_storage)
+        verifier.repair(verifier.verify())
+        since = time.time() + 1
+        verifier.save_manifest(since)
+        for path in self.file_storage.iter_paths():
+            os.utime(path, (since - 10, since - 10))
+            os.utime(os.path.dirname(path), (since - 10, since - 10))
+
+        # When
+        new_entry = self.createCertificate('new@mail.ru')
+        self.file_storage.save(new_entry)
+        os.utime(self.file_storage.path_for('new@mail.ru'), (since + 10, since + 10))
+        os.utime(os.path.dirname(self.file_storage.path_for('new@mail.ru')), (since + 10, since + 10))
+        result = verifier.verify_incremental(verifier.last_verified())
+
+        # Then
+        self.assertEqual(result.orphaned_in_store, ['new@mail.ru'])
+        self.assertEqual(result.missing_in_store, [])
+
+
+class TestReporter(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        self.storage = CertificateDBStorage(self.db_file)
+        for day in range(1, 8):
+            self.storage.save(Certificate(email='user%s@mail.ru' % day,
+                                          password='pass',
+                                          enrollment_id='enr%s' % day,
+                                          questions=['answer1', 'answer2'],
+                                          date_obtained=datetime.date(2016, 1, day)))
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.path)
+
+    def test_should_stream_rows_in_chunks(self):
+        # Given
+        self.storage.FETCH_SIZE = 2
+
+        # When
+        certificates = list(self.storage.get_by_date(datetime.date(2016, 1, 2), datetime.date(2016, 1, 6)))
+
+        # Then
+        self.assertEqual([c.email for c in certificates], ['user%s@mail.ru' % day for day in range(2, 7)])
+        self.assertEqual(self.storage.count_by_date(datetime.date(2016, 1, 2), datetime.date(2016, 1, 6)), 5)
+
+    def test_should_report_arbitrary_range_as_ndjson(self):
+        # Given
+        out = StringIO.StringIO()
+
+        # When
+        total = Reporter(self.storage).write_report(out, 'ndjson', datetime.date(2016, 1, 1), datetime.date(2016, 1, 3))
+
+        # Then
+        lines = out.getvalue().splitlines()
+        self.assertEqual(total, 3)
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0]), {'date_obtained': '2016-01-01', 'email': 'user1@mail.ru',
+                                                'password': 'pass', 'enrollment_id': 'enr1',
+                                                'questions': ['answer1', 'answer2']})
+
+    def test_should_report_as_csv_and_table(self):
+        # Given
+        csv_out = StringIO.StringIO()
+        table_out = StringIO.StringIO()
+        reporter = Reporter(self.storage)
+
+        # When
+        reporter.write_report(csv_out, 'csv', datetime.date(2016, 1, 7), datetime.date(2016, 1, 31))
+        reporter.write_report(table_out, 'table', datetime.date(2016, 1, 7), datetime.date(2016, 1, 31))
+
+        # Then
+        self.assertEqual(csv_out.getvalue().splitlines()[1], '2016-01-07,user7@mail.ru,pass,enr7,"answer1')
+        self.assertIn('Certificates obtained 07.01.2016-31.01.2016', table_out.getvalue())
+        self.assertIn('user7@mail.ru', table_out.getvalue())
+
+    def test_should_reject_unknown_format(self):
+        self.assertRaises(ValueError, Reporter(self.storage).write_report, StringIO.StringIO(), 'xml')
+
+    def test_table_should_stream_pages_of_capped_width(self):
+        # Given
+        consumed = []
+        flushed_at = []
+
+        def rows():
+            for i in range(1000):
+                consumed.append(i)
+                yield ['user%s@mail.ru' % i, 'question1: "%s"\n' % ('long answer ' * 20)]
+
+        class Out(StringIO.StringIO):
+            def flush(self):
+                flushed_at.append(len(consumed))
+
+        out = Out()
+
+        # When
+        write_table(rows(), ['E-mail', 'Answers'], 'Title', out, page_size=50, max_width=30, max_lines=3)
+
+        # Then
+        self.assertEqual(flushed_at[0], 100)
+        self.assertEqual(len(flushed_at), 20)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(max(len(line) for line in lines), len(' user99@mail.ru | ') + 30 + 1)
+        self.assertTrue(lines[6].endswith('... '))
+
+
+class TestCertificateCounts(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        self.storage = CertificateDBStorage(self.db_file)
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.path)
+
+    def createCertificate(self, email, day):
+        return Certificate(email=email, password='pass', enrollment_id='1', questions=['a'], date_obtained=day)
+
+    def counts(self):
+        return self.storage.conn.execute('SELECT day, total FROM certificate_counts ORDER BY day;').fetchall()
+
+    def test_should_count_saved_and_deleted_certificates(self):
+        # Given
+        self.storage.save(self.createCertificate('a@mail.ru', datetime.date(2016, 1, 4)))
+        self.storage.save_many([self.createCertificate('b@mail.ru', datetime.date(2016, 1, 4)),
+                                self.createCertificate('c@mail.ru', datetime.date(2016, 1, 5))])
+
+        # When
+        self.storage.delete('c@mail.ru')
+
+        # Then
+        self.assertEqual(self.counts(), [('2016-01-04', 2)])
+        self.assertEqual(self.storage.count_by_date(datetime.date(2016, 1, 1), datetime.date(2016, 1, 31)), 2)
+
+    def test_should_total_by_period(self):
+        # Given
+        for i, day in enumerate([datetime.date(2016, 1, 4), datetime.date(2016, 1, 10), datetime.date(2016, 1, 11),
+                                 datetime.date(2016, 2, 1), datetime.date(2017, 3, 1)]):
+            self.storage.save(self.createCertificate('user%s@mail.ru' % i, day))
+        start, end = datetime.date(2016, 1, 1), datetime.date(2017, 12, 31)
+
+        # When / Then
+        self.assertEqual(self.storage.count_by_period('week', start, end),
+                         [('2016-W01', 2), ('2016-W02', 1), ('2016-W05', 1), ('2017-W09', 1)])
+        self.assertEqual(self.storage.count_by_period('month', start, end),
+                         [('2016-01', 3), ('2016-02', 1), ('2017-03', 1)])
+        self.assertEqual(self.storage.count_by_period('year', start, end), [('2016', 4), ('2017', 1)])
+        self.assertRaises(ValueError, self.storage.count_by_period, 'decade', start, end)
+
+    def test_should_rebuild_counts(self):
+        # Given
+        self.storage.save(self.createCertificate('a@mail.ru', datetime.date(2016, 1, 4)))
+        self.storage.conn.execute('DELETE FROM certificate_counts;')
+
+        # When
+        self.storage.rebuild_counts()
+
+        # Then
+        self.assertEqual(self.counts(), [('2016-01-04', 1)])
+
+
+class TestManager(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        self.settings = dict(SETTINGS)
+        SETTINGS['db'] = self.db_file
+
+    def tearDown(self):
+        SETTINGS.update(self.settings)
+        shutil.rmtree(self.path)
+
+    def test_should_share_db_storage_between_commands(self):
+        # Given
+        manager = Manager()
+
+        # When
+        first = manager.db_storage
+        manager.command_report(out=StringIO.StringIO())
+
+        # Then
+        self.assertIs(manager.db_storage, first)
+        manager.close()
+        self.assertIsNot(manager.db_storage, first)
+
+
+class TestConcurrentWriters(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.manager = Manager(CertificateDBStorage(os.path.join(self.path, 'certman.db')),
+                               CertificateFileStorage(os.path.join(self.path, 'store'), shard_levels=1))
+        os.mkdir(os.path.join(self.path, 'store'))
+
+    def tearDown(self):
+        self.manager.close()
+        shutil.rmtree(self.path)
+
+    def createCertificate(self, email='writer@mail.ru'):
+        return Certificate(email=email, password='pass', enrollment_id='1', questions=['a'])
+
+    def test_should_add_certificate_once(self):
+        # When
+        added = [self.manager.add_certificate(self.createCertificate()) for _ in range(2)]
+
+        # Then
+        self.assertEqual(added, [True, False])
+        self.assertTrue(self.manager.file_storage.check_exist(self.createCertificate()))
+        self.assertEqual(self.manager.db_storage.pending_intents(), [])
+
+    def test_failed_store_write_should_roll_back_db_row(self):
+        # Given
+        def fail(certificate):
+            raise IOError('disk full')
+        self.manager.file_storage.save = fail
+
+        # When
+        self.assertRaises(IOError, self.manager.add_certificate, self.createCertificate())
+
+        # Then
+        self.assertFalse(self.manager.db_storage.check_exist(self.createCertificate()))
+        self.assertEqual(self.manager.db_storage.pending_intents(), [])
+
+    def test_failed_db_write_should_end_transaction_and_close_intent(self):
+        # Given
+        save = self.manager.db_storage.save
+
+        def fail(certificate, commit=True):
+            raise sqlite3.OperationalError('disk I/O error')
+        self.manager.db_storage.save = fail
+
+        # When
+        self.assertRaises(sqlite3.OperationalError, self.manager.add_certificate, self.createCertificate())
+
+        # Then
+        self.assertEqual(self.manager.db_storage.pending_intents(), [])
+        self.manager.db_storage.save = save
+        self.assertTrue(self.manager.add_certificate(self.createCertificate()))
+
+    def test_interactive_add_should_accept_non_ascii_input(self):
+        # Given
+        stdin, stdout = sys.stdin, sys.stdout
+        sys.stdin = StringIO.StringIO('writer@mail.ru\n\xc3\xa4\nb\nc\nd\n1\np\xc3\xa4ssw\xc3\xb6rd\nn\n')
+        sys.stdout = StringIO.StringIO()
+
+        # When
+        try:
+            count = self.manager.command_addcert()
+        finally:
+            sys.stdin, sys.stdout = stdin, stdout
+
+        # Then
+        self.assertEqual(count, 1)
+        certificate = self.manager.db_storage.get_by_email('writer@mail.ru')
+        self.assertEqual((certificate.password, certificate.questions[0]), (u'p\xe4ssw\xf6rd', u'\xe4'))
+        self.assertEqual(self.manager.file_storage.load('writer@mail.ru').password, u'p\xe4ssw\xf6rd')
+
+    def test_recover_should_undo_adds_of_dead_processes(self):
+        # Given
+        process = multiprocessing.Process(target=int)
+        process.start()
+        process.join()
+        self.manager.db_storage.open_intent('crashed@mail.ru')
+        self.manager.db_storage.open_intent('running@mail.ru')
+        self.manager.db_storage.conn.execute("UPDATE certificate_intents SET pid=? WHERE email='crashed@mail.ru';",
+                                             (process.pid,))
+        self.manager.db_storage.commit()
+        self.manager.file_storage.save(self.createCertificate('crashed@mail.ru'))
+
+        # When
+        recovered = self.manager.recover()
+
+        # Then
+        self.assertEqual(recovered, ['crashed@mail.ru'])
+        self.assertFalse(self.manager.file_storage.check_exist(self.createCertificate('crashed@mail.ru')))
+        self.assertEqual([email for _, email, _ in self.manager.db_storage.pending_intents()], ['running@mail.ru'])
+
+    def test_parallel_writers_should_keep_db_and_store_in_sync(self):
+        # Given
+        workspace = Workspace(10)
+
+        # When
+        try:
+            result = concurrent_writes(workspace, random.Random(0), processes=3, calls=40)
+        finally:
+            workspace.close()
+
+        # Then
+        self.assertGreater(result['writes_per_sec'], 0)
+
+
+class TestWriteBehind(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.path, 'store')
+        os.mkdir(self.store_path)
+        self.store = CertificateFileStorage(self.store_path, shard_levels=1)
+        self.manager = Manager(CertificateDBStorage(os.path.join(self.path, 'certman.db')),
+                               WriteBehindStorage(self.store, backoff=0))
+
+    def tearDown(self):
+        self.manager.close()
+        shutil.rmtree(self.path)
+
+    def createCertificate(self, email='writer@mail.ru'):
+        return Certificate(email=email, password='pass', enrollment_id='1', questions=['a'])
+
+    def test_queued_saves_should_be_visible_and_written_on_flush(self):
+        # Given
+        storage = self.manager.file_storage
+
+        # When
+        storage.save(self.createCertificate('first@mail.ru'), 1)
+        storage.save(self.createCertificate('second@mail.ru'), 2)
+        queued = storage.check_exist(self.createCertificate('first@mail.ru'))
+        storage.flush()
+
+        # Then
+        self.assertTrue(queued)
+        self.assertEqual(sorted(storage.written()), [1, 2])
+        self.assertEqual(self.store.load('second@mail.ru').enrollment_id, '1')
+        self.assertEqual(sorted(storage.iter_emails()), ['first@mail.ru', 'second@mail.ru'])
+        self.assertEqual([name for name in os.listdir(os.path.dirname(self.store.sharded_path('first@mail.ru')))
+                          if name.startswith('.tmp-')], [])
+
+    def test_failing_writes_should_be_retried_then_reported(self):
+        # Given
+        attempts = []
+        save = self.store.save
+
+        def flaky(certificate):
+            attempts.append(certificate.email)
+            if certificate.email == 'broken@mail.ru' or len(attempts) < 3:
+                raise IOError('disk full')
+            save(certificate)
+        self.store.save = flaky
+        storage = self.manager.file_storage
+
+        # When
+        storage.save(self.createCertificate('flaky@mail.ru'), 1)
+        storage.save(self.createCertificate('broken@mail.ru'), 2)
+        storage.flush()
+
+        # Then
+        self.assertEqual(storage.written(), [1])
+        self.assertEqual([(c.email, token, str(e)) for c, token, e in storage.failures()],
+                         [('broken@mail.ru', 2, 'disk full')])
+        self.assertEqual(attempts.count('broken@mail.ru'), storage.retries)
+        self.assertFalse(storage.check_exist(self.createCertificate('broken@mail.ru')))
+
+    def test_add_should_close_intent_once_written(self):
+        # When
+        added = [self.manager.add_certificate(self.createCertificate()) for _ in range(2)]
+        pending = self.manager.db_storage.pending_intents()
+        failures = self.manager.flush_writes()
+
+        # Then
+        self.assertEqual(added, [True, False])
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(failures, [])
+        self.assertEqual(self.manager.db_storage.pending_intents(), [])
+        self.assertTrue(self.store.check_exist(self.createCertificate()))
+
+    def test_recover_should_redo_writes_of_dead_processes(self):
+        # Given
+        process = multiprocessing.Process(target=int)
+        process.start()
+        process.join()
+        db_storage = self.manager.db_storage
+        db_storage.open_intent('crashed@mail.ru')
+        db_storage.conn.execute("UPDATE certificate_intents SET pid=?;", (process.pid,))
+        db_storage.save(self.createCertificate('crashed@mail.ru'))
+
+        # When
+        recovered = self.manager.recover()
+
+        # Then
+        self.assertEqual(recovered, ['crashed@mail.ru'])
+        self.assertEqual(self.store.load('crashed@mail.ru').password, 'pass')
+        self.assertEqual(db_storage.pending_intents(), [])
+
+    def test_failed_import_should_remove_the_written_entries(self):
+        # Given
+        save = self.store.save
+
+        def failing(certificate):
+            if certificate.email == 'b@mail.ru':
+                raise IOError('disk full')
+            save(certificate)
+        self.store.save = failing
+        importer = Importer(self.manager.db_storage, self.manager.file_storage, default_password='default')
+        data = StringIO.StringIO(''.join('{"email": "%s@mail.ru", "enrollment_id": "1", "questions": ["a"]}\n' % name
+                                         for name in 'abc'))
+
+        # When
+        with self.assertRaises(IOError) as raised:
+            importer.run(read_ndjson(data))
+
+        # Then
+        self.assertIn("Couldn't write b@mail.ru", str(raised.exception))
+        self.assertEqual(list(self.store.iter_emails()), [])
+        self.assertTrue(self.manager.db_storage.is_empty())
+
+    def test_recover_should_keep_intent_of_failed_redo(self):
+        # Given
+        process = multiprocessing.Process(target=int)
+        process.start()
+        process.join()
+        db_storage = self.manager.db_storage
+        db_storage.open_intent('crashed@mail.ru')
+        db_storage.conn.execute("UPDATE certificate_intents SET pid=?;", (process.pid,))
+        db_storage.save(self.createCertificate('crashed@mail.ru'))
+
+        def broken(certificate):
+            raise IOError('disk full')
+        self.store.save = broken
+
+        # When
+        self.manager.recover()
+        del self.store.save
+        pending = db_storage.pending_intents()
+        recovered = self.manager.recover()
+
+        # Then
+        self.assertEqual([email for _, email, _ in pending], ['crashed@mail.ru'])
+        self.assertEqual(recovered, ['crashed@mail.ru'])
+        self.assertEqual(self.store.load('crashed@mail.ru').password, 'pass')
+        self.assertEqual(db_storage.pending_intents(), [])
+
+    def test_save_should_refuse_existing_entry(self):
+        # Given
+        self.store.save(self.createCertificate())
+
+        # When
+        with self.assertRaises(OSError) as raised:
+            self.store.save(self.createCertificate(), sync=True)
+
+        # Then
+        self.assertEqual(raised.exception.errno, errno.EEXIST)
+
+
+class TestAsyncStorage(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.store_path = os.path.join(self.path, 'store')
+        os.mkdir(self.store_path)
+        self.db_path = os.path.join(self.path, 'certman.db')
+        self.store = CertificateFileStorage(self.store_path, shard_levels=1)
+        self.manager = AsyncManager(AsyncCertificateDBStorage(self.db_path), AsyncCertificateFileStorage(self.store))
+
+    def tearDown(self):
+        self.manager.close()
+        shutil.rmtree(self.path)
+
+    def createCertificate(self, email='async@mail.ru'):
+        return Certificate(email=email, password='pass', enrollment_id='1', questions=['a'])
+
+    def test_future_should_run_callbacks_and_raise_errors(self):
+        # Given
+        succeeded, failed = Future(), Future()
+        seen = []
+
+        # When
+        succeeded.add_done_callback(lambda f: seen.append(f.result()))
+        succeeded.set_result(1)
+        failed.set_exception(ValueError('broken'))
+        failed.add_done_callback(lambda f: seen.append(str(f.exception())))
+
+        # Then
+        self.assertEqual(seen, [1, 'broken'])
+        self.assertTrue(failed.done())
+        self.assertRaises(ValueError, failed.result)
+        self.assertRaises(RuntimeError, Future().result, 0.01)
+
+    def test_batched_saves_should_only_fail_duplicates(self):
+        # Given
+        db = self.manager.db_storage
+
+        # When
+        saved = [db.save(self.createCertificate(email))
+                 for email in ('first@mail.ru', 'second@mail.ru', 'first@mail.ru')]
+        emails = db.iter_emails().result()
+
+        # Then
+        self.assertEqual([f.exception() is None for f in saved], [True, True, False])
+        self.assertIsInstance(saved[2].exception(), CertificateExists)
+        self.assertEqual(sorted(emails), ['first@mail.ru', 'second@mail.ru'])
+
+    def test_adds_should_write_db_and_store(self):
+        # When
+        added = [self.manager.add_certificate(self.createCertificate(email))
+                 for email in ('first@mail.ru', 'second@mail.ru', 'first@mail.ru')]
+        results = [f.result(5) for f in added]
+
+        # Then
+        self.assertEqual(results, [True, True, False])
+        self.assertEqual(self.manager.db_storage.pending_intents().result(), [])
+        self.assertEqual(sorted(self.store.iter_emails()), ['first@mail.ru', 'second@mail.ru'])
+        self.assertEqual(self.manager.db_storage.get_by_email('second@mail.ru').result().enrollment_id, '1')
+
+    def test_failed_store_write_should_undo_db_row(self):
+        # Given
+        def broken(certificate):
+            raise IOError('disk full')
+        self.store.save = broken
+
+        # When
+        added = self.manager.add_certificate(self.createCertificate())
+
+        # Then
+        self.assertRaises(IOError, added.result, 5)
+        self.assertIsNone(self.manager.db_storage.get_by_email('async@mail.ru').result())
+        self.assertEqual(self.manager.db_storage.pending_intents().result(), [])
+
+    def test_store_write_should_start_after_intent_commits(self):
+        # Given
+        journaled = []
+        save = self.store.save
+
+        def journaling(certificate):
+            conn = sqlite3.connect(self.db_path)
+            journaled.append(conn.execute('SELECT 1 FROM certificate_intents WHERE email=?;',
+                                          (certificate.email,)).fetchone() is not None)
+            conn.close()
+            save(certificate)
+        self.store.save = journaling
+
+        # When
+        added = [self.manager.add_certificate(self.createCertificate('user%s@mail.ru' % i)) for i in range(20)]
+        results = [f.result(5) for f in added]
+
+        # Then
+        self.assertEqual(results, [True] * 20)
+        self.assertEqual(journaled, [True] * 20)
+
+
+class TestCli(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.settings = dict(SETTINGS)
+        SETTINGS['db'] = os.path.join(self.path, 'certman.db')
+        SETTINGS['store_path'] = self.path
+        SETTINGS['default_password'] = 'default'
+        with open(os.path.join(self.path, 'new.csv'), 'w') as f:
+            f.write('email,enrollment_id,question1\nfirst@mail.ru,1,a\nsecond@mail.ru,2,b\n')
+
+    def tearDown(self):
+        SETTINGS.update(self.settings)
+        shutil.rmtree(self.path)
+
+    def test_missing_setting_should_fail_only_when_needed(self):
+        # Given
+        SETTINGS['db'] = None
+
+        # Then
+        self.assertRaises(SettingsError, require, 'db')
+        self.assertEqual(cli.main(['report']), 1)
+
+    def test_should_snapshot_and_restore_into_a_new_db(self):
+        # Given
+        cli.main(['add', '--from-file', os.path.join(self.path, 'new.csv')])
+        snapshot_path = os.path.join(self.path, 'snapshot.gz')
+        restored_store = os.path.join(self.path, 'restored')
+        os.mkdir(restored_store)
+
+        # When
+        written = cli.main(['snapshot', snapshot_path])
+        SETTINGS['db'] = os.path.join(self.path, 'restored.db')
+        SETTINGS['store_path'] = restored_store
+        restored = cli.main(['restore', snapshot_path])
+        restored_again = cli.main(['restore', snapshot_path])
+
+        # Then
+        self.assertEqual((written, restored, restored_again), (0, 0, 1))
+        self.assertEqual(sorted(os.listdir(restored_store)), ['first@mail.ru', 'second@mail.ru'])
+
+    def test_should_add_report_and_delete_without_prompts(self):
+        # Given
+        report_path = os.path.join(self.path, 'report.csv')
+
+        # When
+        added = cli.main(['add', '--from-file', os.path.join(self.path, 'new.csv')])
+        deleted = cli.main(['delete', 'first@mail.ru'])
+        reported = cli.main(['report', '--from', '2000-01-01', '--format', 'csv', '--output', report_path])
+
+        # Then
+        self.assertEqual((added, deleted, reported), (0, 0, 0))
+        with open(report_path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[1].startswith(datetime.date.today().strftime('%Y-%m-%d') + ',second@mail.ru'))
+
+    def test_delete_should_fail_for_unknown_emails(self):
+        self.assertEqual(cli.main(['delete', 'unknown@mail.ru']), 1)
+
+    def test_should_delete_emails_from_file_with_dry_run(self):
+        # Given
+        cli.main(['add', '--from-file', os.path.join(self.path, 'new.csv')])
+        emails_path = os.path.join(self.path, 'emails.txt')
+        with open(emails_path, 'w') as f:
+            f.write('# expired\nfirst@mail.ru\n\nsecond@mail.ru\n')
+
+        manager = Manager()
+
+        # When
+        cli.main(['delete', '--from-file', emails_path, '--dry-run'])
+        kept = sorted(manager.db_storage.iter_emails())
+        deleted = cli.main(['delete', '--from-file', emails_path])
+
+        # Then
+        self.assertEqual(kept, ['first@mail.ru', 'second@mail.ru'])
+        self.assertEqual(deleted, 0)
+        self.assertEqual(list(manager.db_storage.iter_emails()), [])
+        manager.close()
+        self.assertFalse(os.path.exists(os.path.join(self.path, 'first@mail.ru')))
+
+
+class TestCertificateCache(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        self.storage = CertificateDBStorage(self.db_file, cache_size=2)
+        for i in range(3):
+            self.storage.save(Certificate(email='user%s@mail.ru' % i, password='pass',
+                                          enrollment_id='1', questions=['a']))
+
+    def tearDown(self):
+        self.storage.close()
+        shutil.rmtree(self.path)
+
+    def test_repeated_lookups_should_hit_cache(self):
+        # Given
+        first = self.storage.get_by_email('user0@mail.ru')
+
+        # When
+        second = self.storage.get_by_email('user0@mail.ru')
+        exists = self.storage.check_exist(Certificate(email='user0@mail.ru'))
+
+        # Then
+        self.assertIs(first, second)
+        self.assertTrue(exists)
+        self.assertEqual(self.storage.cache_info(), {'hits': 2, 'misses': 1, 'size': 1, 'maxsize': 2})
+
+    def test_writes_of_other_connections_should_invalidate(self):
+        # Given
+        self.storage.get_by_email('user0@mail.ru')
+        self.storage.get_by_email('user1@mail.ru')
+        other = CertificateDBStorage(self.db_file)
+
+        # When
+        other.delete('user0@mail.ru')
+        other.save(Certificate(email='user0@mail.ru', password='new', enrollment_id='1', questions=['a']))
+        other.delete('user1@mail.ru')
+        other.close()
+
+        # Then
+        self.assertEqual(self.storage.get_by_email('user0@mail.ru').password, 'new')
+        self.assertFalse(self.storage.check_exist(Certificate(email='user1@mail.ru')))
+
+    def test_delete_should_invalidate_all_keys_of_certificate(self):
+        # Given
+        self.storage.get_by_id(1)
+        self.storage.get_by_email('user0@mail.ru')
+
+        # When
+        self.storage.delete('user0@mail.ru')
+
+        # Then
+        self.assertEqual(len(self.storage.cache), 0)
+        self.assertIsNone(self.storage.get_by_id(1))
+        self.assertFalse(self.storage.check_exist(Certificate(email='user0@mail.ru')))
+
+    def test_save_and_rollback_should_invalidate(self):
+        # Given
+        self.storage.delete('user0@mail.ru')
+        self.storage.save_many([Certificate(email='user0@mail.ru', password='new', enrollment_id='1',
+                                            questions=['a'])], commit=False)
+        self.assertEqual(self.storage.get_by_email('user0@mail.ru').password, 'new')
+
+        # When
+        self.storage.rollback()
+
+        # Then
+        self.assertIsNone(self.storage.get_by_email('user0@mail.ru'))
+
+    def test_should_evict_least_recently_used(self):
+        # Given
+        self.storage.get_by_email('user0@mail.ru')
+        self.storage.get_by_email('user1@mail.ru')
+
+        # When
+        self.storage.get_by_email('user0@mail.ru')
+        self.storage.get_by_email('user2@mail.ru')
+
+        # Then
+        self.assertIsNotNone(self.storage.cache.get(('email', 'user0@mail.ru')))
+        self.assertIsNone(self.storage.cache.get(('email', 'user1@mail.ru')))
+
+
+class TestEmailFilter(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        storage = CertificateDBStorage(self.db_file)
+        storage.save_many(Certificate(email='user%s@mail.ru' % i, password='p', enrollment_id=str(i), questions=['a'])
+                          for i in range(100))
+        storage.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_filter_should_have_no_false_negatives(self):
+        # Given
+        membership = EmailFilter(10000, error_rate=0.01)
+
+        # When
+        membership.update('user%s@mail.ru' % i for i in range(10000))
+        false_positives = sum(1 for i in range(10000) if 'missing%s@mail.ru' % i in membership)
+
+        # Then
+        self.assertTrue(all('user%s@mail.ru' % i in membership for i in range(10000)))
+        self.assertLess(false_positives, 200)
+        self.assertAlmostEqual(membership.false_positive_rate(), 0.01, places=2)
+        self.assertEqual(membership.info()['bytes'], 11982)
+        self.assertFalse(membership.full())
+
+    def test_storage_should_answer_new_emails_from_filter(self):
+        # Given
+        storage = CertificateDBStorage(self.db_file, membership_error_rate=0.01)
+
+        # When
+        new = storage.check_exist(Certificate(email='new@mail.ru'))
+        existing = storage.check_exist(Certificate(email='user1@mail.ru'))
+        storage.save(Certificate(email='new@mail.ru', password='p', enrollment_id='1', questions=['a']))
+
+        # Then
+        self.assertEqual((new, existing), (False, True))
+        self.assertTrue(storage.check_exist(Certificate(email='new@mail.ru')))
+        self.assertEqual(storage.existing_emails(['new@mail.ru', 'user2@mail.ru', 'other@mail.ru']),
+                         set(['new@mail.ru', 'user2@mail.ru']))
+        self.assertEqual(storage.membership_info()['count'], 101)
+        storage.close()
+
+    def test_single_checks_should_not_build_filter(self):
+        # Given
+        storage = CertificateDBStorage(self.db_file, membership_error_rate=0.01)
+
+        # When
+        exists = storage.check_exist(Certificate(email='user1@mail.ru'))
+        unbuilt = storage.membership
+        storage.existing_emails(['user1@mail.ru'])
+
+        # Then
+        self.assertTrue(exists)
+        self.assertIsNone(unbuilt)
+        self.assertEqual(storage.membership.count, 100)
+        self.assertFalse(storage.check_exist(Certificate(email='other@mail.ru')))
+        storage.close()
+
+    def test_filter_should_see_writes_of_other_connections(self):
+        # Given
+        storage = CertificateDBStorage(self.db_file, membership_error_rate=0.01)
+        other = CertificateDBStorage(self.db_file)
+        self.assertFalse(storage.might_exist('other@mail.ru'))
+
+        # When
+        other.save(Certificate(email='other@mail.ru', password='p', enrollment_id='1', questions=['a']))
+
+        # Then
+        self.assertTrue(storage.might_exist('other@mail.ru'))
+        self.assertTrue(storage.check_exist(Certificate(email='other@mail.ru')))
+        other.close()
+        storage.close()
+
+    def test_full_filter_should_be_rebuilt(self):
+        # Given
+        storage = CertificateDBStorage(self.db_file, membership_error_rate=0.01)
+        storage.might_exist('user1@mail.ru')
+        first = storage.membership
+
+        # When
+        first.count = first.capacity + 1
+        storage.might_exist('user1@mail.ru')
+
+        # Then
+        self.assertIsNot(storage.membership, first)
+        self.assertEqual(storage.membership.count, 100)
+        storage.close()
+
+
+class TestSchema(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        self.storages = []
+
+    def tearDown(self):
+        for storage in self.storages:
+            storage.close()
+        shutil.rmtree(self.path)
+
+    def createStorage(self, **options):
+        storage = CertificateDBStorage(self.db_file, **options)
+        self.storages.append(storage)
+        return storage
+
+    def test_new_database_should_be_at_latest_version(self):
+        # Given
+        storage = self.createStorage()
+
+        # When
+        version = current_version(storage.conn)
+
+        # Then
+        self.assertEqual(version, MIGRATIONS[-1][0])
+        self.assertEqual(migrate(storage.conn), [])
+
+    def test_processes_opening_an_old_database_should_migrate_it_once(self):
+        # Given
+        conn = sqlite3.connect(self.db_file)
+        migrate(conn, MIGRATIONS[:1])
+        conn.close()
+
+        def open_storage():
+            self.createStorage().close()
+        processes = [multiprocessing.Process(target=open_storage) for _ in range(4)]
+
+        # When
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        # Then
+        self.assertEqual([process.exitcode for process in processes], [0] * 4)
+        conn = sqlite3.connect(self.db_file)
+        self.assertEqual([row[0] for row in conn.execute('SELECT version FROM schema_migrations ORDER BY version;')],
+                         [migration[0] for migration in MIGRATIONS])
+        conn.close()
+
+    def test_lookups_should_use_indexes(self):
+        # Given
+        storage = self.createStorage()
+        c = storage.conn.cursor()
+
+        # When
+        by_email = c.execute("EXPLAIN QUERY PLAN SELECT * FROM certificates WHERE email=?;", ('a@mail.ru',)).fetchall()
+        by_date = c.execute("EXPLAIN QUERY PLAN SELECT * FROM certificates WHERE when_added >= ? AND when_added <= ?;",
+                            ('2016-01-01', '2016-01-07')).fetchall()
+
+        # Then
+        self.assertIn('certificates_email', str(by_email))
+        self.assertIn('certificates_when_added', str(by_date))
+
+    def test_should_upgrade_legacy_database_in_place(self):
+        # Given
+        conn = sqlite3.connect(self.db_file)
+        conn.execute('''CREATE TABLE certificates
+            (id integer primary key, when_added date, email text, password text, enrollment_id text, questions text);''')
+        conn.execute("INSERT INTO certificates VALUES (NULL, '2016-01-07', 'a@mail.ru', 'p1', '1', 'question1: \"x\"\n');")
+        conn.execute("INSERT INTO certificates VALUES (NULL, '2016-01-08', 'a@mail.ru', 'p2', '2', 'question1: \"y\"\n');")
+        conn.commit()
+        conn.close()
+
+        # When
+        storage = self.createStorage()
+
+        # Then
+        self.assertEqual(current_version(storage.conn), MIGRATIONS[-1][0])
+        self.assertEqual(storage.get_by_email('a@mail.ru').password, 'p1')
+        self.assertEqual(storage.get_by_email('a@mail.ru').questions, ['x'])
+        self.assertEqual(storage.conn.execute('SELECT COUNT(*) FROM certificates_duplicates;').fetchone()[0], 1)
+        self.assertRaises(sqlite3.IntegrityError, storage.save,
+                          Certificate(email='a@mail.ru', password='p3', enrollment_id='3', questions=['z']))
+
+
+class TestImporter(unittest.TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.db_file = os.path.join(self.path, 'certman.db')
+        self.store_path = os.path.join(self.path, 'store')
+        os.mkdir(self.store_path)
+        self.db_storage = CertificateDBStorage(self.db_file)
+        self.file_storage = CertificateFileStorage(store_path=self.store_path)
+
+    def tearDown(self):
+        self.db_storage.close()
+        shutil.rmtree(self.path)
+
+    def createImporter(self, chunk_size=500):
+        return Importer(self.db_storage, self.file_storage, chunk_size=chunk_size,
+                        default_password='default_password')
+
+    def test_should_import_csv(self):
+        # Given
+        data = StringIO.StringIO(
+            'email,password,enrollment_id,question1,question2,date_obtained\n'
+            'first@mail.ru,pass,123abc,answer1,answer2,2016-01-07\n'
+            'second@mail.ru,,456def,answer1,answer2,2016-01-08\n')
+
+        # When
+        result = self.createImporter().run(read_csv(data))
+
+        # Then
+        self.assertEqual(result.imported, 2)
+        self.assertEqual(result.rejects, [])
+        first = self.db_storage.get_by_email('first@mail.ru')
+        self.assertEqual(first.questions, ['answer1', 'answer2'])
+        self.assertEqual(first.date_obtained, datetime.date(2016, 1, 7))
+        self.assertEqual(self.db_storage.get_by_email('second@mail.ru').password, 'default_password')
+        self.assertTrue(os.path.isfile(os.path.join(self.store_path, 'second@mail.ru', 'credentials.yaml')))
+
+    def test_should_import_ndjson_in_chunks_and_reject_bad_rows(self):
+        # Given
+        data = StringIO.StringIO(
+            '{"email": "first@mail.ru", "enrollment_id": "1", "questions": ["a"]}\n'
+            '{"email": "not an email", "enrollment_id": "2", "questions": ["a"]}\n'
+            '{broken\n'
+            '{"email": "first@mail.ru", "enrollment_id": "3", "questions": ["a"]}\n'
+            '{"email": "second@mail.ru", "enrollment_id": "4", "questions": ["a"]}\n'
+            '{"email": "third@mail.ru", "enrollment_id": "5", "questions": ["a"]}\n')
+
+        # When
+        result = self.createImporter(chunk_size=1).run(read_ndjson(data))
+
+        # Then
+        self.assertEqual(result.imported, 3)
+        self.assertEqual([line_num for line_num, _, _ in result.rejects], [2, 3, 4])
+        self.assertTrue(self.db_storage.check_exist(Certificate(email='third@mail.ru')))
+
+    def test_should_reject_already_stored_certificates(self):
+        # Given
+        existing = Certificate(email='first@mail.ru', password='pass', enrollment_id='1', questions=['a'])
+        self.db_storage.save(existing)
+        data = StringIO.StringIO(
+            'certificate: {email: first@mail.ru, enrollment_id: "1", questions: [a]}\n'
+            '---\n'
+            'certificate: {email: second@mail.ru, enrollment_id: "2", questions: [a]}\n')
+
+        # When
+        result = self.createImporter().run(read_yaml(data))
+
+        # Then
+        self.assertEqual(result.imported, 1)
+        self.assertEqual(result.rejects, [(1, 'first@mail.ru', 'already exists')])
+        self.assertFalse(os.path.isdir(os.path.join(self.store_path, 'first@mail.ru')))
+
+    def test_should_import_non_ascii_values(self):
+        # Given
+        data = StringIO.StringIO(
+            '{"email": "first@mail.ru", "password": "p\\u00e4ss", "enrollment_id": "\\u00e91", "questions": ["\\u00fc"]}\n')
+
+        # When
+        result = self.createImporter().run(read_ndjson(data))
+
+        # Then
+        self.assertEqual(result.imported, 1)
+        first = self.db_storage.get_by_email('first@mail.ru')
+        self.assertEqual((first.password, first.enrollment_id, first.questions), (u'p\xe4ss', u'\xe91', [u'\xfc']))
+        self.assertEqual(self.file_storage.load('first@mail.ru').password, u'p\xe4ss')
+
+    def test_should_reject_rows_that_are_not_utf8(self):
+        # Given
+        data = StringIO.StringIO(
+            'email,password,enrollment_id,question1\n'
+            'first@mail.ru,p\xe4ss,123abc,answer1\n'
+            'second@mail.ru,p\xc3\xa4ss,456def,answer1\n')
+
+        # When
+        result = self.createImporter().run(read_csv(data))
+
+        # Then
+        self.assertEqual(result.imported, 1)
+        self.assertEqual([(line_num, email) for line_num, email, _ in result.rejects], [(2, 'first@mail.ru')])
+        self.assertEqual(self.db_storage.get_by_email('second@mail.ru').password, u'p\xe4ss')
+
+    def test_failed_import_should_leave_nothing_with_email_filter(self):
+        # Given
+        self.db_storage.close()
+        self.db_storage = CertificateDBStorage(self.db_file, membership_error_rate=0.01)
+        save = self.file_storage.save
+
+        def failing(certificate):
+            if certificate.email == 'fourth@mail.ru':
+                raise IOError('disk full')
+            save(certificate)
+        self.file_storage.save = failing
+        data = StringIO.StringIO(''.join(
+            '{"email": "%s@mail.ru", "enrollment_id": "1", "questions": ["a"]}\n' % name
+            for name in ('first', 'second', 'third', 'fourth', 'fifth')))
+
+        # When
+        self.assertRaises(IOError, self.createImporter(chunk_size=2).run, read_ndjson(data))
+
+        # Then
+        self.assertEqual(self.db_storage.conn.execute('SELECT COUNT(*) FROM certificates;').fetchone()[0], 0)
+        self.assertEqual(os.listdir(self.store_path), [])
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_generator_should_be_reproducible(self):
+        self.assertEqual(list(generate_certificates(5, seed=3)), list(generate_certificates(5, seed=3)))
+        self.assertNotEqual(list(generate_certificates(5, seed=3)), list(generate_certificates(5, seed=4)))
+
+    def test_should_run_scenarios_and_save_json(self):
+        # When
+        results = benchmarks.run(sizes=[50], scenarios=['db_read', 'file_storage'], max_files=20)
+
+        # Then
+        self.assertEqual(sorted(results['results']), ['db_read', 'file_storage'])
+        self.assertEqual(results['results']['file_storage']['50']['files'], 20)
+        self.assertEqual(json.loads(json.dumps(results)), results)
+
+    def test_compare_should_flag_regressions(self):
+        # Given
+        baseline = {'results': {'db_read': {'10': {'get_by_email_us': 10.0, 'rows_per_sec': 100.0}}}}
+        current = {'results': {'db_read': {'10': {'get_by_email_us': 12.0, 'rows_per_sec': 105.0}}}}
+
+        # When
+        compared = list(benchmarks.compare(baseline, current, threshold=0.1))
+
+        # Then
+        self.assertEqual([(metric, regressed) for _, _, metric, _, _, _, regressed in compared],
+                         [('get_by_email_us', True), ('rows_per_sec', False)])
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        INSTRUMENTATION.reset()
+        self.db_path = tempfile.mktemp()
+
+    def tearDown(self):
+        INSTRUMENTATION.reset()
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(self.db_path + suffix):
+                os.remove(self.db_path + suffix)
+
+    def test_should_count_calls_and_rows(self):
+        # Given
+        @timed('test.call', rows=len)
+        def call(items):
+            return items
+
+        # When
+        call([1, 2])
+        call([3])
+
+        # Then
+        stats = INSTRUMENTATION.snapshot()['operations']['test.call']
+        self.assertEqual(stats['count'], 2)
+        self.assertEqual(stats['rows'], 3)
+
+    def test_should_time_generators_per_item(self):
+        # Given
+        @timed('test.generator')
+        def generator():
+            for i in range(4):
+                yield i
+
+        # When
+        items = list(generator())
+
+        # Then
+        self.assertEqual(items, [0, 1, 2, 3])
+        self.assertEqual(INSTRUMENTATION.snapshot()['operations']['test.generator']['rows'], 4)
+
+    def test_storage_calls_should_be_exported_as_json(self):
+        # Given
+        storage = CertificateDBStorage(self.db_path)
+        storage.save(Certificate(email='timed@mail.ru'))
+
+        # When
+        storage.get_by_email('timed@mail.ru')
+        storage.get_by_email('missing@mail.ru')
+        storage.close()
+
+        # Then
+        operations = json.loads(INSTRUMENTATION.to_json())['operations']
+        self.assertEqual(operations['db.get_by_email']['count'], 2)
+        self.assertEqual(operations['db.get_by_email']['rows'], 1)
+        self.assertIn('p99_ms', operations['db.save'])
+
+    def test_should_trace_sql_statements(self):
+        # Given
+        trace = StringIO.StringIO()
+        storage = CertificateDBStorage(self.db_path, trace=trace)
+
+        # When
+        storage.get_by_email('traced@mail.ru')
+        storage.close()
+
+        # Then
+        self.assertIn('FROM certificates WHERE email=?', trace.getvalue())
+        self.assertIn("'traced@mail.ru'", trace.getvalue())
+
+    def test_profile_call_should_print_stats(self):
+        # Given
+        out = StringIO.StringIO()
+
+        # When
+        result = profile_call(sorted, ([3, 1, 2],), out=out)
+
+        # Then
+        self.assertEqual(result, [1, 2, 3])
+        self.assertIn('function calls', out.getvalue())
 
 if __name__=='__main__':
     unittest.main()
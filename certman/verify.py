@@ -0,0 +1,174 @@
+#!coding: utf-8
+"""
+Consistency check between the certificates DB and the file store.
+
+A full check merge-joins the email-sorted DB rows against the emails found
+in the store. Store emails are sorted externally in bounded runs spilled to
+temporary files, so neither side is ever held in memory as a whole. An
+incremental check only looks at store entries changed and DB rows added
+since the last successful check, as recorded in the store's manifest.
+"""
+import heapq
+import json
+import os
+import tempfile
+import time
+
+from datetime import date
+
+from certman.manager import Certificate
+
+
+MISSING_IN_STORE = 'missing in store'
+ORPHANED_IN_STORE = 'orphaned in store'
+
+
+def _to_str(email):
+    return email.encode('utf-8') if isinstance(email, unicode) else email
+
+
+class VerifyResult(object):
+    def __init__(self):
+        self.checked = 0
+        self.issues = []
+        self.repaired = 0
+        self.started = time.time()
+
+    @property
+    def missing_in_store(self):
+        return [email for kind, email in self.issues if kind == MISSING_IN_STORE]
+
+    @property
+    def orphaned_in_store(self):
+        return [email for kind, email in self.issues if kind == ORPHANED_IN_STORE]
+
+
+class Verifier(object):
+    MANIFEST_NAME = '.verified'
+
+    def __init__(self, db_storage, file_storage, run_size=100000, workers=8):
+        self.db_storage = db_storage
+        self.file_storage = file_storage
+        self.run_size = run_size
+        self.workers = workers
+
+    @property
+    def manifest_path(self):
+        return os.path.join(self.file_storage.store_path, self.MANIFEST_NAME)
+
+    def last_verified(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)['last_verified']
+        except (IOError, ValueError, KeyError):
+            return None
+
+    def save_manifest(self, started):
+        with open(self.manifest_path + '.tmp', 'w') as f:
+            json.dump({'last_verified': started}, f)
+        os.rename(self.manifest_path + '.tmp', self.manifest_path)
+
+    def _sorted(self, emails):
+        """
+        External sort: sorts runs of ``run_size`` emails, spills all but the
+        last one to temporary files and merges them back lazily.
+        """
+        runs = []
+        run = []
+        try:
+            for email in emails:
+                run.append(_to_str(email))
+                if len(run) >= self.run_size:
+                    run.sort()
+                    f = tempfile.TemporaryFile()
+                    f.writelines(email + '\n' for email in run)
+                    f.seek(0)
+                    runs.append(f)
+                    run = []
+            run.sort()
+            streams = [(line.rstrip('\n') for line in f) for f in runs]
+            for email in heapq.merge(run, *streams):
+                yield email
+        finally:
+            for f in runs:
+                f.close()
+
+    def _merge_join(self, db_emails, store_emails, result):
+        db_emails = iter(db_emails)
+        store_emails = iter(store_emails)
+        db_email = next(db_emails, None)
+        store_email = next(store_emails, None)
+        while db_email is not None or store_email is not None:
+            result.checked += 1
+            if store_email is None or (db_email is not None and db_email < store_email):
+                result.issues.append((MISSING_IN_STORE, db_email))
+                db_email = next(db_emails, None)
+            elif db_email is None or store_email < db_email:
+                result.issues.append((ORPHANED_IN_STORE, store_email))
+                store_email = next(store_emails, None)
+            else:
+                db_email = next(db_emails, None)
+                store_email = next(store_emails, None)
+
+    def verify(self):
+        result = VerifyResult()
+        db_emails = (_to_str(email) for email in self.db_storage.iter_emails())
+        store_emails = self._sorted(self.file_storage.iter_emails(self.workers))
+        self._merge_join(db_emails, store_emails, result)
+        return result
+
+    def verify_incremental(self, since, chunk_size=500):
+        """
+        Checks store entries modified after the ``since`` timestamp against
+        the DB and DB rows added since that day against the store. Entries
+        whose counterpart disappeared without touching them (e.g. a DB row
+        deleted before its directory) are only found by a full check.
+        """
+        result = VerifyResult()
+
+        chunk = []
+        changed = self.file_storage.iter_emails(self.workers, since=since)
+        for email in self._sorted(changed):
+            chunk.append(email)
+            if len(chunk) >= chunk_size:
+                self._check_in_db(chunk, result)
+                chunk = []
+        self._check_in_db(chunk, result)
+
+        for email in self.db_storage.iter_emails(since=date.fromtimestamp(since)):
+            result.checked += 1
+            if not self.file_storage.check_exist(Certificate(email=email)):
+                result.issues.append((MISSING_IN_STORE, _to_str(email)))
+        return result
+
+    def _check_in_db(self, emails, result):
+        existing = set(_to_str(email) for email in self.db_storage.existing_emails(emails))
+        for email in emails:
+            result.checked += 1
+            if email not in existing:
+                result.issues.append((ORPHANED_IN_STORE, email))
+
+    def repair(self, result, orphans='restore'):
+        """
+        Rewrites missing store entries from the DB. Orphaned store entries
+        are either restored into the DB (``orphans='restore'``) or removed
+        from the store (``orphans='delete'``).
+        """
+        if orphans not in ('restore', 'delete'):
+            raise ValueError("Unknown orphan policy '%s'" % orphans)
+
+        for kind, email in result.issues:
+            if kind == MISSING_IN_STORE:
+                certificate = self.db_storage.get_by_email(email)
+                if certificate is not None:
+                    self.file_storage.save(certificate)
+                    result.repaired += 1
+            elif orphans == 'restore':
+                certificate = self.file_storage.load(email)
+                if certificate is not None:
+                    self.db_storage.save(certificate)
+                    result.repaired += 1
+            else:
+                self.file_storage.delete(email)
+                result.repaired += 1
+        return result.repaired
@@ -0,0 +1,141 @@
+#!coding: utf-8
+"""
+Write-behind wrapper for the file store. Saves are queued and written by
+a background thread, so adds return as soon as the DB row is in; the
+queue is bounded, so a slow disk holds callers back instead of piling up
+certificates in memory.
+
+Every save carries a token (the journal entry of the add) that is handed
+back through ``written`` once the entry is on disk, fsynced in batches.
+Writes are retried with exponential backoff; those failing every attempt
+end up in ``failures``, their tokens never come back, and the journal
+entries left open get the writes redone by ``Manager.recover``.
+"""
+import errno
+import threading
+import time
+import Queue
+
+from certman.instrument import timed
+
+
+class WriteBehindStorage(object):
+    def __init__(self, storage, queue_size=256, batch_size=64, retries=5, backoff=0.05):
+        self.storage = storage
+        self.batch_size = batch_size
+        self.retries = retries
+        self.backoff = backoff
+        self._queue = Queue.Queue(queue_size)
+        self._lock = threading.Lock()
+        self._pending = {}
+        self._written = []
+        self._failures = []
+        self._worker = threading.Thread(target=self._run, name='certman-write-behind')
+        self._worker.daemon = True
+        self._worker.start()
+
+    @timed('file.queue_save', rows=1)
+    def save(self, certificate, token=None):
+        with self._lock:
+            self._pending[certificate.email] = certificate
+        self._queue.put((certificate, token))
+
+    def check_exist(self, certificate):
+        with self._lock:
+            if certificate.email in self._pending:
+                return True
+        return self.storage.check_exist(certificate)
+
+    def load(self, email):
+        with self._lock:
+            certificate = self._pending.get(email)
+        return certificate if certificate is not None else self.storage.load(email)
+
+    def __getattr__(self, name):
+        # Anything else may read or remove entries still in the queue
+        self.flush()
+        return getattr(self.storage, name)
+
+    def flush(self):
+        """
+        Waits until every queued save is written or has failed.
+        """
+        self._queue.join()
+
+    def written(self):
+        """
+        Tokens of the saves written since the last call.
+        """
+        with self._lock:
+            tokens, self._written = self._written, []
+        return tokens
+
+    def failures(self):
+        """
+        ``(certificate, token, error)`` of the saves that failed every
+        attempt since the last call.
+        """
+        with self._lock:
+            failures, self._failures = self._failures, []
+        return failures
+
+    def close(self):
+        self.flush()
+        self._queue.put((None, None))
+        self._worker.join()
+        if hasattr(self.storage, 'close'):
+            self.storage.close()
+
+    def _write(self, certificate):
+        for attempt in range(self.retries):
+            try:
+                self.storage.save(certificate)
+                return None
+            except (IOError, OSError) as e:
+                # An entry already there won't go away by waiting
+                if e.errno == errno.EEXIST or attempt == self.retries - 1:
+                    return e
+            except Exception as e:
+                return e
+            time.sleep(self.backoff * 2 ** attempt)
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            stop = False
+            done = []
+            failed = []
+            for certificate, token in batch:
+                if certificate is None:
+                    stop = True
+                    continue
+                error = self._write(certificate)
+                if error is None:
+                    done.append((certificate, token))
+                else:
+                    failed.append((certificate, token, error))
+            if done and hasattr(self.storage, 'sync'):
+                try:
+                    self.storage.sync([certificate.email for certificate, _ in done])
+                except Exception as e:
+                    failed.extend((certificate, token, e) for certificate, token in done)
+                    done = []
+
+            with self._lock:
+                for certificate, token in done:
+                    self._pending.pop(certificate.email, None)
+                    if token is not None:
+                        self._written.append(token)
+                for certificate, token, error in failed:
+                    self._pending.pop(certificate.email, None)
+                    self._failures.append((certificate, token, error))
+            for _ in batch:
+                self._queue.task_done()
+            if stop:
+                return
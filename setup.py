@@ -8,8 +8,8 @@ setup(name='certman',
       author='Vladimir Ignatev',
       author_email='ya.na.pochte@gmail.com',
       url='https://www.python.org/',
-      packages=['certman'],
+      packages=['certman', 'certman.benchmarks'],
       scripts=['certman/bin/certman', 'certman/bin/certman-config'],
       test_suite='certman.tests',
-      install_requires=['terminaltables==1.1.1', 'PyYAML==3.11', 'freezegun==0.3.5']
+      install_requires=['PyYAML==3.11', 'freezegun==0.3.5']
      )